@@ -0,0 +1,205 @@
+''' asv benchmarks of the three stages of make_bgc_river_input (mouth
+snapping, plume growth and merge) and of the full pipeline, on synthetic
+grids and river tables. Run with `asv run` and compare commits with
+`asv compare`. '''
+import tracemalloc
+import numpy as np
+import xarray as xr
+from dicrivers import make_bgc_river_input
+from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+from dicrivers.geo_utils import build_ocean_index, plume_footprints_radius
+from dicrivers.plumes import make_river_plumes
+from dicrivers.remapper import RiverRemapper
+from .synthetic import grid, river_table
+
+
+_grids = {}
+
+
+def cached_grid(kind, resolution):
+    ''' synthetic grids are generated once per process '''
+    if (kind, resolution) not in _grids:
+        _grids[(kind, resolution)] = grid(kind, resolution)
+    return _grids[(kind, resolution)]
+
+
+def traced_peak(func, *args, **kwargs):
+    ''' peak memory (bytes) allocated through numpy/python during func '''
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Snapping(object):
+    params = (['regular', 'tripolar', 'llc'], [1., 0.25, 0.1],
+              [20, 1000, 10000])
+    param_names = ['grid', 'resolution', 'nriver']
+    timeout = 600
+
+    def setup(self, kind, resolution, nriver):
+        self.lon, self.lat, self.mask = cached_grid(kind, resolution)
+        self.rivers = river_table(self.lon, self.lat, self.mask, nriver)
+
+    def snap(self):
+        find_closest_ocean_cells_to_river_mouths(
+            self.rivers['mouth_lon'].values, self.rivers['mouth_lat'].values,
+            self.lon, self.lat, self.mask)
+
+    def time_snapping(self, kind, resolution, nriver):
+        self.snap()
+
+    def peakmem_snapping(self, kind, resolution, nriver):
+        self.snap()
+
+    def track_traced_peak_snapping(self, kind, resolution, nriver):
+        return traced_peak(self.snap)
+    track_traced_peak_snapping.unit = 'bytes'
+
+
+class PlumeGrowth(object):
+    params = (['regular', 'llc'], [1., 0.25], [20, 1000, 10000],
+              [2, 10, 30], ['multisource', 'perriver'])
+    param_names = ['grid', 'resolution', 'nriver', 'rspread', 'engine']
+    timeout = 600
+
+    def setup(self, kind, resolution, nriver, rspread, engine):
+        lon, lat, mask = cached_grid(kind, resolution)
+        rivers = river_table(lon, lat, mask, nriver, rspread=rspread)
+        mouths = find_closest_ocean_cells_to_river_mouths(
+            rivers['mouth_lon'].values, rivers['mouth_lat'].values,
+            lon, lat, mask)
+        # plume growth sees faces stacked along y
+        if mask.ndim == 3:
+            nface, ny, nx = mask.shape
+            fmouths, jmouths, imouths = mouths
+            jmouths = np.where(jmouths >= 0, fmouths * ny + jmouths, -1)
+            self.mask = mask.reshape((nface * ny, nx))
+            self.face_ny = ny
+        else:
+            jmouths, imouths = mouths
+            self.mask = mask
+            self.face_ny = None
+        self.jmouths, self.imouths = jmouths, imouths
+        self.rspreads = rivers['rspread'].values
+
+    def grow(self, engine):
+        from dicrivers.parallel import plume_footprints_parallel
+        plume_footprints_parallel(self.jmouths, self.imouths, self.mask,
+                                  self.rspreads, engine=engine,
+                                  face_ny=self.face_ny)
+
+    def time_plume_growth(self, kind, resolution, nriver, rspread, engine):
+        self.grow(engine)
+
+    def peakmem_plume_growth(self, kind, resolution, nriver, rspread,
+                             engine):
+        self.grow(engine)
+
+    def track_traced_peak_plume_growth(self, kind, resolution, nriver,
+                                       rspread, engine):
+        return traced_peak(self.grow, engine)
+    track_traced_peak_plume_growth.unit = 'bytes'
+
+
+class CompiledPlumeGrowth(PlumeGrowth):
+    params = (['regular', 'llc'], [1., 0.25], [1000, 10000], [10, 30],
+              ['numpy', 'numba'])
+    param_names = ['grid', 'resolution', 'nriver', 'rspread', 'backend']
+
+    def setup(self, kind, resolution, nriver, rspread, backend):
+        from dicrivers.geo_utils import plume_footprints_multisource
+        PlumeGrowth.setup(self, kind, resolution, nriver, rspread,
+                          'multisource')
+        # compile the kernels outside of the timings
+        plume_footprints_multisource([1], [1], np.ones((3, 3)), 1,
+                                     backend=backend)
+
+    def grow(self, backend):
+        from dicrivers.parallel import plume_footprints_parallel
+        plume_footprints_parallel(self.jmouths, self.imouths, self.mask,
+                                  self.rspreads, face_ny=self.face_ny,
+                                  backend=backend)
+
+
+class RadiusPlumeGrowth(object):
+    params = (['regular', 'llc'], [1., 0.25], [20, 1000, 10000],
+              [100., 500., 1500.], ['uniform', 'gaussian'])
+    param_names = ['grid', 'resolution', 'nriver', 'rspread_km', 'decay']
+    timeout = 600
+
+    def setup(self, kind, resolution, nriver, rspread_km, decay):
+        lon, lat, self.mask = cached_grid(kind, resolution)
+        rivers = river_table(lon, lat, self.mask, nriver)
+        self.index = build_ocean_index(lon, lat, self.mask)
+        mouths = find_closest_ocean_cells_to_river_mouths(
+            rivers['mouth_lon'].values, rivers['mouth_lat'].values,
+            lon, lat, self.mask, index=self.index)
+        self.mouths = np.where(mouths[0] >= 0, np.ravel_multi_index(
+            tuple(np.maximum(m, 0) for m in mouths), self.mask.shape), -1)
+
+    def grow(self, rspread_km, decay):
+        plume_footprints_radius(self.mouths, rspread_km, self.mask,
+                                self.index, decay=decay)
+
+    def time_plume_growth(self, kind, resolution, nriver, rspread_km, decay):
+        self.grow(rspread_km, decay)
+
+    def track_traced_peak_plume_growth(self, kind, resolution, nriver,
+                                       rspread_km, decay):
+        return traced_peak(self.grow, rspread_km, decay)
+    track_traced_peak_plume_growth.unit = 'bytes'
+
+
+class Merge(object):
+    params = (['regular', 'llc'], [1., 0.25], [20, 1000, 10000],
+              ['average', 'discharge', 'flux'])
+    param_names = ['grid', 'resolution', 'nriver', 'method']
+    timeout = 600
+
+    def setup(self, kind, resolution, nriver, method):
+        lon, lat, mask = cached_grid(kind, resolution)
+        self.lon, self.lat = lon, lat
+        self.rivers = river_table(lon, lat, mask, nriver, rspread=10)
+        self.plumes = make_river_plumes(self.rivers, lon, lat, mask)
+        self.area = np.cos(np.deg2rad(lat))
+        # a monthly climatology of 10 tracers
+        self.values = xr.DataArray(
+            np.random.RandomState(0).rand(10, 12, nriver),
+            dims=['variable', 'time', 'river'])
+
+    def merge(self, method):
+        remapper = RiverRemapper.from_plumes(
+            self.plumes, self.lon, self.lat, method=method,
+            discharge=self.rivers['discharge'].values, area_grid=self.area)
+        remapper.apply(self.values)
+
+    def time_merge(self, kind, resolution, nriver, method):
+        self.merge(method)
+
+    def peakmem_merge(self, kind, resolution, nriver, method):
+        self.merge(method)
+
+    def track_traced_peak_merge(self, kind, resolution, nriver, method):
+        return traced_peak(self.merge, method)
+    track_traced_peak_merge.unit = 'bytes'
+
+
+class Pipeline(object):
+    params = (['regular', 'tripolar', 'llc'], [1., 0.25], [20, 1000])
+    param_names = ['grid', 'resolution', 'nriver']
+    timeout = 600
+
+    def setup(self, kind, resolution, nriver):
+        self.lon, self.lat, self.mask = cached_grid(kind, resolution)
+        self.rivers = river_table(self.lon, self.lat, self.mask, nriver)
+
+    def time_make_bgc_river_input(self, kind, resolution, nriver):
+        make_bgc_river_input(self.rivers, ['testvar'],
+                             self.lon, self.lat, self.mask)
+
+    def peakmem_make_bgc_river_input(self, kind, resolution, nriver):
+        make_bgc_river_input(self.rivers, ['testvar'],
+                             self.lon, self.lat, self.mask)
@@ -0,0 +1,96 @@
+''' synthetic grids and river tables for the benchmarks, generated
+offline and deterministically '''
+import numpy as np
+import pandas as pd
+
+
+def land_mask(lon, lat):
+    ''' smooth continents from a sum of waves, about 30% of land '''
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+    field = np.sin(3 * lon) * np.cos(2 * lat) + \
+        0.5 * np.sin(5 * lon + 1) * np.sin(3 * lat) + \
+        0.3 * np.cos(7 * lon - 2) * np.cos(5 * lat + 1)
+    return (field < 0.45).astype(np.float64)
+
+
+def regular_grid(resolution):
+    ''' regular global lon/lat grid at resolution (in degrees) '''
+    lon, lat = np.meshgrid(np.arange(0, 360, resolution) + resolution / 2,
+                           np.arange(-90, 90, resolution) + resolution / 2)
+    return lon, lat, land_mask(lon, lat)
+
+
+def tripolar_grid(resolution):
+    ''' curvilinear grid, regular in the south and with two poles over
+    land in the north, similar to a tripolar ocean grid '''
+    lon, lat = regular_grid(resolution)[:2]
+    north = lat > 65
+    # squeeze latitude lines towards two poles at 0E and 180E
+    weight = ((lat[north] - 65) / 25.) ** 2
+    lat = lat.copy()
+    lat[north] = lat[north] - 10 * weight * np.abs(
+        np.sin(np.deg2rad(lon[north])))
+    mask = land_mask(lon, lat)
+    mask[lat > 88] = 0
+    return lon, lat, mask
+
+
+def llc_grid(nface_points):
+    ''' multi-face grid with 13 faces of nface_points x nface_points,
+    similar in layout to the MITgcm LLC grids '''
+    resolution = 90. / nface_points
+    lon_faces, lat_faces = [], []
+    base = np.arange(nface_points) * resolution + resolution / 2
+    for face in range(13):
+        if face < 12:
+            # 4 longitude sectors x 3 latitude bands
+            sector, band = face % 4, face // 4
+            lon, lat = np.meshgrid(90 * sector + base,
+                                   -80 + 50 * band + base * 50 / 90.)
+        else:
+            # arctic cap
+            x, y = np.meshgrid(base - 45, base - 45)
+            lon = np.rad2deg(np.arctan2(y, x)) % 360
+            lat = 90 - np.hypot(x, y) * 20 / 64.
+        lon_faces.append(lon)
+        lat_faces.append(lat)
+    lon = np.stack(lon_faces)
+    lat = np.stack(lat_faces)
+    return lon, lat, land_mask(lon, lat)
+
+
+def grid(kind, resolution):
+    ''' grid of given kind: regular, tripolar or llc '''
+    if kind == 'regular':
+        return regular_grid(resolution)
+    elif kind == 'tripolar':
+        return tripolar_grid(resolution)
+    elif kind == 'llc':
+        return llc_grid(int(90 / resolution))
+    raise ValueError('unknown grid kind')
+
+
+def river_table(lon, lat, mask, nriver, rspread=5, seed=0):
+    ''' nriver rivers whose mouths are on land cells next to the ocean,
+    with a small jitter so that rivers sharing a cell are distinct '''
+    rng = np.random.RandomState(seed)
+    # (face, y, x) view of all grids
+    shape = (-1,) + mask.shape[-2:]
+    land = mask.reshape(shape) == 0
+    ocean = ~land
+    coast = np.zeros(land.shape, dtype=bool)
+    coast[:, 1:] |= ocean[:, :-1]
+    coast[:, :-1] |= ocean[:, 1:]
+    coast[:, :, 1:] |= ocean[:, :, :-1]
+    coast[:, :, :-1] |= ocean[:, :, 1:]
+    coast &= land
+    candidates = np.flatnonzero(coast)
+    picked = rng.choice(candidates, size=nriver)
+    jitter = rng.uniform(-0.1, 0.1, size=(2, nriver))
+    rspreads = np.broadcast_to(np.asarray(rspread), (nriver,))
+    return pd.DataFrame({'mouth_lon': lon.ravel()[picked] + jitter[0],
+                         'mouth_lat': lat.ravel()[picked] + jitter[1],
+                         'rspread': rspreads,
+                         'testvar': rng.uniform(0, 100, size=nriver),
+                         'discharge': rng.lognormal(size=nriver)})
@@ -1 +1,48 @@
-from .dicrivers import *
+''' dicrivers: create bgc river inputs for ocean models. The functions and
+classes below are imported on first use, so that importing the package
+does not import pandas, xarray and scipy (see dicrivers.service for
+short jobs). Python < 3.7 has no module __getattr__ (PEP 562), they are
+imported with the package there. '''
+import importlib
+import sys
+
+
+# public name: module defining it
+_public = {'make_bgc_river_input': 'dicrivers.dicrivers',
+           'merge_average': 'dicrivers.dicrivers',
+           'make_river_plumes': 'dicrivers.plumes',
+           'RiverRemapper': 'dicrivers.remapper',
+           'long_to_river_dataset': 'dicrivers.remapper',
+           'expand_compressed': 'dicrivers.remapper',
+           'RunReport': 'dicrivers.diagnostics',
+           'stage': 'dicrivers.diagnostics',
+           'IncrementalRiverInput': 'dicrivers.incremental',
+           'GridTopology': 'dicrivers.topology',
+           'read_river_table': 'dicrivers.rivers',
+           'river_columns': 'dicrivers.rivers'}
+
+_submodules = ['cache', 'cli', 'diagnostics', 'dicrivers', 'geo_utils',
+               'incremental', 'kernels', 'parallel', 'plumes', 'remapper',
+               'rivers', 'service', 'tiles', 'topology']
+
+__all__ = sorted(_public)
+
+
+def __getattr__(name):
+    if name in _public:
+        value = getattr(importlib.import_module(_public[name]), name)
+    elif name in _submodules:
+        value = importlib.import_module('dicrivers.' + name)
+    else:
+        raise AttributeError("module 'dicrivers' has no attribute %r" % name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_public) | set(_submodules))
+
+
+if sys.version_info < (3, 7):
+    for _name in __all__:
+        __getattr__(_name)
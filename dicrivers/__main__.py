@@ -0,0 +1,4 @@
+import sys
+from dicrivers.cli import main
+
+sys.exit(main())
@@ -0,0 +1,217 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def grid_hash(lon_grid, lat_grid, mask_grid, block_size=2 ** 22):
+    """ content hash of the grid arrays, read in blocks of rows so that
+    memory-mapped or lazy arrays are never loaded at once
+
+    Parameters
+    ----------
+    lon_grid : numpy.ndarray or xarray.DataArray
+        longitudes of the output grid
+    lat_grid : numpy.ndarray or xarray.DataArray
+        latitudes of the output grid
+    mask_grid : numpy.ndarray or xarray.DataArray
+        land/sea mask of the output grid
+    block_size : integer
+        number of values read at once
+    Returns
+    -------
+    key : string
+        hexadecimal digest
+    """
+    sha = hashlib.sha1()
+    for array in [lon_grid, lat_grid, mask_grid]:
+        shape = tuple(np.shape(array))
+        sha.update(str((shape, np.dtype(array.dtype).str)).encode())
+        # the blocks are contiguous, same digest as the whole array
+        nrow = max(1, block_size // max(1, int(np.prod(shape[1:]))))
+        for start in range(0, shape[0], nrow):
+            sha.update(np.ascontiguousarray(array[start:start + nrow]).data)
+    return sha.hexdigest()
+
+
+def river_keys(lon_rivers, lat_rivers, rspreads, prox, nitermax,
+               spreading='grid', decay='uniform', periodic=False,
+               tripolar=False, coastal=False):
+    """ key of each river, from everything its geometry depends on
+
+    Parameters
+    ----------
+    lon_rivers : np.array
+        longitudes of the river mouths
+    lat_rivers : np.array
+        latitudes of the river mouths
+    rspreads : np.array
+        number of gridpoints for spreading the plume of each river
+    prox : float
+        acceptable maximum distance (in km) between gridcell and true
+        river location
+    nitermax : integer
+        maximum number of iterations for spreading algo
+    spreading : string
+        spreading of the plumes, 'grid' or 'km'
+    decay : string
+        weights of the plumes for spreading in km
+    periodic : bool
+        plumes spread across the zonal seam
+    tripolar : bool
+        plumes spread across the north fold
+    coastal : bool
+        mouths are snapped to the coastal ocean cells (with a topology)
+    Returns
+    -------
+    keys : list of string
+        hexadecimal digest for each river
+    """
+    nriver = len(lon_rivers)
+    params = np.column_stack([np.asarray(lon_rivers, dtype=np.float64),
+                              np.asarray(lat_rivers, dtype=np.float64),
+                              np.asarray(rspreads, dtype=np.float64),
+                              np.full(nriver, prox, dtype=np.float64),
+                              np.full(nriver, nitermax, dtype=np.float64)])
+    # keys of plumes spread over gridpoints are unchanged by the other modes
+    suffix = b''
+    if spreading != 'grid':
+        suffix += ('%s-%s' % (spreading, decay)).encode()
+    if periodic:
+        suffix += b'-periodic'
+    if tripolar:
+        suffix += b'-tripolar'
+    if coastal:
+        suffix += b'-coastal'
+    return [hashlib.sha1(row.tobytes() + suffix).hexdigest()
+            for row in params]
+
+
+class GeometryCache(object):
+    """ persistent cache of snapped river mouths and plume footprints.
+    There is one npz file per grid, holding the mouth and footprint of
+    every river computed on that grid, and the weights of the plumes that
+    are not boolean. When the total size of the cache
+    exceeds max_size, the least recently used grids are evicted.
+
+    Parameters
+    ----------
+    path : string
+        directory of the cache, created if needed
+    max_size : integer
+        maximum size of the cache in bytes (None for unbounded)
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, grid_key):
+        return os.path.join(self.path, grid_key + '.npz')
+
+    def _read(self, grid_key):
+        ''' all entries stored for this grid '''
+        filename = self._file(grid_key)
+        if not os.path.exists(filename):
+            return {}
+        with np.load(filename) as data:
+            keys = data['keys']
+            mouths = data['mouths']
+            indptr = data['indptr']
+            cells = data['cells']
+            weights = data['weights'] if 'weights' in data else None
+        # mark as recently used
+        os.utime(filename)
+        entries = {}
+        for k, key in enumerate(keys):
+            plume = slice(indptr[k], indptr[k + 1])
+            entries[str(key)] = (mouths[k], cells[plume])
+            if weights is not None:
+                entries[str(key)] += (weights[plume],)
+        return entries
+
+    def load(self, grid_key, keys):
+        """ look up rivers in the cache
+
+        Parameters
+        ----------
+        grid_key : string
+            hash of the grid, from grid_hash
+        keys : list of string
+            keys of the rivers, from river_keys
+        Returns
+        -------
+        found : dict
+            (mouth, footprint) for each key present in the cache, followed
+            by the weights of the footprint if the grid has weighted plumes
+        """
+        entries = self._read(grid_key)
+        return {key: entries[key] for key in keys if key in entries}
+
+    def store(self, grid_key, entries):
+        """ add rivers to the cache
+
+        Parameters
+        ----------
+        grid_key : string
+            hash of the grid, from grid_hash
+        entries : dict
+            (mouth, footprint) or (mouth, footprint, weights) for each
+            river key
+        """
+        merged = self._read(grid_key)
+        merged.update(entries)
+        keys = sorted(merged)
+        lengths = [len(merged[key][1]) for key in keys]
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        cells = np.zeros(indptr[-1], dtype=np.int64)
+        for k, key in enumerate(keys):
+            cells[indptr[k]:indptr[k + 1]] = merged[key][1]
+        mouths = np.array([merged[key][0] for key in keys], dtype=np.int64)
+        arrays = dict(keys=np.array(keys, dtype='U40'), mouths=mouths,
+                      indptr=indptr, cells=cells)
+        if any(len(merged[key]) > 2 for key in keys):
+            # boolean plumes get unit weights
+            weights = np.ones(indptr[-1], dtype=np.float64)
+            for k, key in enumerate(keys):
+                if len(merged[key]) > 2:
+                    weights[indptr[k]:indptr[k + 1]] = merged[key][2]
+            arrays['weights'] = weights
+
+        # write to a temporary file first so readers never see partial files
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmpfile, self._file(grid_key))
+        self.evict(keep=grid_key)
+
+    def size(self):
+        """ total size of the cache in bytes """
+        return sum(os.path.getsize(os.path.join(self.path, f))
+                   for f in os.listdir(self.path) if f.endswith('.npz'))
+
+    def evict(self, keep=None):
+        """ remove least recently used grids until the cache fits in
+        max_size. The grid keep is never removed.
+        """
+        if self.max_size is None:
+            return
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                 if f.endswith('.npz')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for filename in files:
+            if total <= self.max_size:
+                break
+            if keep is not None and filename == self._file(keep):
+                continue
+            total -= os.path.getsize(filename)
+            os.remove(filename)
+
+    def clear(self):
+        """ remove all entries """
+        for f in os.listdir(self.path):
+            if f.endswith('.npz'):
+                os.remove(os.path.join(self.path, f))
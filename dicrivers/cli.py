@@ -0,0 +1,439 @@
+''' dicrivers command: run a batch of make_bgc_river_input jobs described
+in a JSON config file, in one process.
+
+Example of config file (paths are relative to the config file)::
+
+    {
+      "grids": {
+        "om4": {"file": "ocean_static.nc", "lon": "geolon",
+                "lat": "geolat", "mask": "wet", "area": "areacello",
+                "periodic": true, "tripolar": true,
+                "topology": "om4_topology.npz"},
+        "llc90": {"file": "llc90_grid.nc", "lon": "XC", "lat": "YC",
+                  "mask": "maskC", "face": "tile"}
+      },
+      "rivers": {
+        "glorich": {"file": "rivers.parquet"}
+      },
+      "jobs": [
+        {"grid": "om4", "rivers": "glorich", "variables": ["din", "don"],
+         "output": "om4_nitrogen.nc", "options": {"prox": 100.}},
+        {"grid": "om4", "rivers": "glorich", "variables": ["dic", "alk"],
+         "output": "om4_carbon.nc"},
+        {"grid": "llc90", "rivers": "glorich", "variables": ["din"],
+         "output": "llc90_din.zarr", "options": {"method": "discharge",
+                                                 "compressed": true}}
+      ],
+      "n_workers": 4,
+      "summary": "summary.json"
+    }
+
+Grids and river tables are read once. Snapped mouths and plumes are
+computed once per grid, river table and geometry options, so that jobs
+differing only by their variables or merging method share them. A single
+pool of workers serves all jobs. Each output is written when its job
+completes and the summary (timings, river counters and status of each
+job) is written to a JSON file. A grid with a topology file snaps the
+mouths to its coastal ocean cells and grows the plumes along its graph
+(see dicrivers.topology.GridTopology); the file is built from the grid
+on first use and loaded by the next runs.
+
+With --serve SOCKET, the command keeps running as a service: the jobs of
+the config are run to warm it up, then jobs are received on the Unix
+socket and run with the grids, tables, topologies and plumes kept in
+memory (see dicrivers.service). "request_timeout" in the config sets the
+seconds a client has to send its request (10 by default).
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+from dicrivers.dicrivers import make_bgc_river_input
+from dicrivers.diagnostics import RunReport
+from dicrivers.geo_utils import build_ocean_index
+from dicrivers.plumes import make_river_plumes
+from dicrivers.rivers import read_river_table, river_columns
+from dicrivers.topology import GridTopology
+
+
+logger = logging.getLogger('dicrivers')
+
+# job options that change the plumes, the others only change the merge
+geometry_options = ['lon_mouth_name', 'lat_mouth_name', 'nitermax', 'prox',
+                    'engine', 'spreading', 'decay', 'backend']
+merge_options = ['method', 'discharge_name', 'output_dtype', 'compressed']
+
+
+def main(argv=None):
+    """ entry point of the dicrivers command """
+    parser = argparse.ArgumentParser(
+        prog='dicrivers',
+        description='create bgc river inputs for ocean models from a '
+                    'JSON config file listing grids, river tables and jobs')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('--summary', default=None,
+                        help='JSON summary file (overrides the config)')
+    parser.add_argument('--n-workers', type=int, default=None,
+                        help='number of worker processes (overrides the '
+                             'config)')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='stop at the first failed job')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log progress of each job')
+    parser.add_argument('--serve', default=None, metavar='SOCKET',
+                        help='after the jobs of the config, serve jobs '
+                             'sent to this Unix socket until shut down')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING,
+                        format='%(asctime)s %(name)s %(message)s')
+    config = read_config(args.config, require_jobs=args.serve is None)
+    if args.summary is not None:
+        config['summary'] = args.summary
+    if args.n_workers is not None:
+        config['n_workers'] = args.n_workers
+    if args.serve is not None:
+        from dicrivers.service import serve
+        serve(config, args.serve)
+        return 0
+    summary = run_batch(config, fail_fast=args.fail_fast)
+    failed = [job for job in summary['jobs'] if job['status'] != 'ok']
+    return 1 if failed else 0
+
+
+def read_config(filename, require_jobs=True):
+    """ read a JSON config file, making its paths absolute
+
+    Parameters
+    ----------
+    filename : string
+        path of the config file
+    require_jobs : bool
+        raise an IOError if the config has no jobs (without, the jobs
+        default to an empty list)
+    Returns
+    -------
+    config : dict
+        grids, rivers, jobs and run options
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    for key in ['grids', 'rivers', 'jobs']:
+        if key not in config and (key != 'jobs' or require_jobs):
+            raise IOError('config must include %s' % key)
+    config.setdefault('jobs', [])
+    root = os.path.dirname(os.path.abspath(filename))
+
+    def absolute(path):
+        return os.path.join(root, os.path.expanduser(path))
+
+    for table in [config['grids'], config['rivers']]:
+        for spec in table.values():
+            spec['file'] = absolute(spec['file'])
+            if spec.get('topology') is not None:
+                spec['topology'] = absolute(spec['topology'])
+    for job in config['jobs']:
+        job['output'] = absolute(job['output'])
+    for key in ['summary', 'cache']:
+        if config.get(key) is not None:
+            config[key] = absolute(config[key])
+    return config
+
+
+def run_batch(config, fail_fast=False):
+    """ run all the jobs of a config in this process
+
+    Parameters
+    ----------
+    config : dict
+        grids, rivers, jobs and run options, see read_config
+    fail_fast : bool
+        raise the error of the first failed job instead of going on
+    Returns
+    -------
+    summary : dict
+        status, timings and river counters of each job, also written to
+        config['summary'] if given
+    """
+    n_workers = config.get('n_workers', 1)
+    batch = _Batch(config)
+    summary = {'config': config, 'jobs': []}
+    start = time.perf_counter()
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        for kjob, job in enumerate(config['jobs']):
+            name = job.get('name', 'job%d' % kjob)
+            logger.info('starting %s', name)
+            record = batch.run(name, job, executor, n_workers)
+            summary['jobs'].append(record)
+            logger.info('%s: %s in %.3fs', name, record['status'],
+                        record['time_s'])
+            if config.get('summary') is not None:
+                # summary is rewritten as jobs complete
+                summary['time_s'] = time.perf_counter() - start
+                _write_summary(summary, config['summary'])
+            if fail_fast and record['status'] != 'ok':
+                raise RuntimeError('%s failed:\n%s' % (name,
+                                                       record['error']))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    summary['time_s'] = time.perf_counter() - start
+    if config.get('summary') is not None:
+        _write_summary(summary, config['summary'])
+    return summary
+
+
+class _Batch(object):
+    ''' grids, river tables, topologies, ocean indices and plumes shared
+    by jobs '''
+
+    def __init__(self, config):
+        self.config = config
+        self.grids = {}
+        self.rivers = {}
+        self.columns = {}
+        self.topologies = {}
+        self.indices = {}
+        self.plumes = {}
+        self.counters = {}
+
+    def grid(self, name):
+        if name not in self.grids:
+            self.grids[name] = read_grid(self.config['grids'][name])
+        return self.grids[name]
+
+    def topology(self, name):
+        ''' topology of a grid, None if the grid has no topology file '''
+        if name not in self.topologies:
+            spec = self.config['grids'][name]
+            self.topologies[name] = None
+            if spec.get('topology') is not None:
+                grid = self.grid(name)
+                self.topologies[name] = load_topology(
+                    spec['topology'], grid)
+        return self.topologies[name]
+
+    def river_table(self, name, job=None):
+        ''' columns of the river table used by any of the jobs of the
+        config and by job, read again if job needs more columns '''
+        jobs = [other for other in self.config['jobs']
+                if other.get('rivers') == name]
+        if job is not None:
+            jobs.append(job)
+        columns = []
+        for other in jobs:
+            options = other.get('options', {})
+            used = river_columns(
+                other.get('variables', []),
+                **{key: options[key] for key in
+                   ['lon_mouth_name', 'lat_mouth_name', 'spreading',
+                    'method', 'discharge_name'] if key in options})
+            columns += [col for col in used if col not in columns]
+        read = self.columns.get(name, ())
+        if name not in self.rivers or \
+                (read is not None and not set(columns) <= set(read)):
+            if name in self.rivers:
+                # the rows are unchanged, plumes of the table stay valid
+                columns += [col for col in read if col not in columns]
+            spec = self.config['rivers'][name]
+            self.rivers[name] = read_river_table(
+                spec['file'], columns=columns or None,
+                **spec.get('options', {}))
+            self.columns[name] = columns or None
+        return self.rivers[name]
+
+    def river_plumes(self, job, executor, n_workers, report):
+        ''' plumes of the job and the counters of its rivers, computed
+        once per grid, rivers and geometry options '''
+        options = job.get('options', {})
+        geometry = {key: options[key] for key in geometry_options
+                    if key in options}
+        key = (job['grid'], job['rivers'],
+               json.dumps(geometry, sort_keys=True))
+        if key in self.plumes:
+            return self.plumes[key], self.counters[key], True
+        grid = self.grid(job['grid'])
+        topology = self.topology(job['grid'])
+        # with a topology, the ocean index is only used by km plumes
+        if job['grid'] not in self.indices and \
+                (topology is None or geometry.get('spreading') == 'km'):
+            self.indices[job['grid']] = build_ocean_index(grid['lon'],
+                                                          grid['lat'],
+                                                          grid['mask'])
+        plumes = make_river_plumes(self.river_table(job['rivers'], job),
+                                   grid['lon'], grid['lat'], grid['mask'],
+                                   n_workers=n_workers, executor=executor,
+                                   cache=self.config.get('cache'),
+                                   report=report,
+                                   periodic=grid['periodic'],
+                                   tripolar=grid['tripolar'],
+                                   ocean_index=self.indices.get(job['grid']),
+                                   topology=topology,
+                                   **geometry)
+        self.plumes[key] = plumes
+        self.counters[key] = report.rivers
+        return plumes, report.rivers, False
+
+    def run(self, name, job, executor, n_workers):
+        ''' run one job, never raising '''
+        record = {'name': name}
+        report = RunReport(trace_memory=False)
+        start = time.perf_counter()
+        try:
+            if not isinstance(job, dict):
+                raise ValueError('job must be a dict')
+            for key in ['grid', 'rivers', 'output', 'variables']:
+                record[key] = job.get(key)
+            options = dict(job.get('options', {}))
+            unknown = set(options) - set(geometry_options + merge_options)
+            if unknown:
+                raise ValueError('unknown options %s' % sorted(unknown))
+            if 'output_dtype' in options:
+                options['output_dtype'] = np.dtype(options['output_dtype'])
+            with report.stage('read'):
+                grid = self.grid(job['grid'])
+                river_df = self.river_table(job['rivers'], job)
+            plumes, rivers, reused = self.river_plumes(job, executor,
+                                                       n_workers, report)
+            river_conc = make_bgc_river_input(
+                river_df, job['variables'], grid['lon'], grid['lat'],
+                grid['mask'], area_grid=grid['area'], plumes=plumes,
+                report=report, **options)
+            with report.stage('write'):
+                write_output(river_conc, job['output'], face=grid['face'])
+            record['status'] = 'ok'
+            record['plumes_reused'] = reused
+            if rivers is not None:
+                record['nriver'] = int(len(rivers))
+                record['dropped'] = int(rivers['dropped'].sum())
+                record['not_converged'] = int((~rivers['converged']).sum())
+        except Exception:
+            record['status'] = 'failed'
+            record['error'] = traceback.format_exc()
+            logger.error('%s failed:\n%s', name, record['error'])
+        record['time_s'] = time.perf_counter() - start
+        record['stages'] = {stage: dict(values) for stage, values
+                            in report.stages.items()}
+        return record
+
+
+def read_grid(spec):
+    """ read the arrays of a grid from a netCDF (or zarr) file
+
+    Parameters
+    ----------
+    spec : dict
+        file, names of the lon, lat and mask variables, and optionally
+        area variable name, face dimension name and periodic/tripolar
+        flags
+    Returns
+    -------
+    grid : dict
+        lon, lat, mask and area arrays ((face, y, x) if the grid has a
+        face dimension) and the grid flags
+    """
+    for key in ['file', 'lon', 'lat', 'mask']:
+        if key not in spec:
+            raise IOError('grid must include %s' % key)
+    if spec['file'].endswith('.zarr'):
+        ds = xr.open_zarr(spec['file'])
+    else:
+        ds = xr.open_dataset(spec['file'])
+    face = spec.get('face')
+    grid = {'face': face, 'periodic': spec.get('periodic', False),
+            'tripolar': spec.get('tripolar', False), 'area': None}
+    with ds:
+        for key in ['lon', 'lat', 'mask', 'area']:
+            if spec.get(key) is None:
+                continue
+            array = ds[spec[key]]
+            if face is not None:
+                array = array.transpose(face, *[dim for dim in array.dims
+                                                if dim != face])
+            grid[key] = np.asarray(array.values)
+    if grid['mask'].dtype.kind == 'f':
+        # masks read from netCDF may have missing values over land
+        grid['mask'] = np.where(np.isnan(grid['mask']), 0, grid['mask'])
+    return grid
+
+
+def load_topology(filename, grid):
+    """ topology of a grid from its file, built from the grid and written
+    to the file if it does not exist yet
+
+    Parameters
+    ----------
+    filename : string
+        npz file of the topology
+    grid : dict
+        grid as returned by read_grid
+    Returns
+    -------
+    topology : dicrivers.topology.GridTopology
+    """
+    if os.path.exists(filename):
+        topology = GridTopology.load(filename)
+    else:
+        topology = GridTopology(grid['mask'], grid['lon'], grid['lat'],
+                                periodic=grid['periodic'],
+                                tripolar=grid['tripolar'])
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        topology.save(filename)
+    topology.check_grid(grid['mask'], periodic=grid['periodic'],
+                        tripolar=grid['tripolar'])
+    return topology
+
+
+def write_output(river_conc, filename, face=None):
+    """ write the river concentrations of a job to netCDF or zarr (for
+    names ending with .zarr)
+
+    Parameters
+    ----------
+    river_conc : xarray.Dataset
+        river concentrations on the grid (or in the compressed layout)
+    filename : string
+        output file
+    face : string
+        name of the face dimension in the grid file
+    """
+    if face is not None:
+        river_conc = river_conc.rename({'face': face})
+        if 'cell' in river_conc.coords:
+            # the compressed cells refer to the renamed dimension
+            compress = river_conc['cell'].attrs['compress'].split()
+            river_conc['cell'].attrs['compress'] = ' '.join(
+                [face if dim == 'face' else dim for dim in compress])
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if filename.endswith('.zarr'):
+        river_conc.to_zarr(filename, mode='w')
+    else:
+        river_conc.to_netcdf(filename)
+
+
+def _write_summary(summary, filename):
+    ''' write the summary without the config, atomically '''
+    content = {key: value for key, value in summary.items()
+               if key != 'config'}
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmpfile, filename)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import contextlib
+import logging
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger('dicrivers')
+
+river_columns = ['snap_distance_km', 'dropped', 'plume_cells', 'iterations',
+                 'converged', 'cached']
+
+
+class RunReport(object):
+    """ timings, memory and per river counters of a run, filled by the
+    functions accepting a report argument.
+
+    Stages (snapping, plume_growth, merge, assembly) record their wall time
+    and peak traced memory, a stage entered several times accumulates its
+    time. Per river counters are: distance (km) between the river mouth and
+    its ocean cell, dropped (further than prox), number of cells in the
+    plume, number of spreading iterations (-1 if not tracked), converged
+    and cached (read from the geometry cache, other counters are then
+    unknown).
+
+    Every stage and the river counters are also logged at debug level on
+    the 'dicrivers' logger and passed to callback(event, data) if given.
+
+    Parameters
+    ----------
+    callback : callable
+        called with (event, data), event is 'stage' or 'rivers'
+    trace_memory : bool
+        record peak memory of each stage with tracemalloc (slower)
+    """
+
+    def __init__(self, callback=None, trace_memory=True):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.rivers = None
+
+    def __repr__(self):
+        lines = ['RunReport(']
+        for name, stage in self.stages.items():
+            lines.append('  %s: %.3fs, peak %.1f MB' %
+                         (name, stage['time_s'], stage['peak_mb']))
+        if self.rivers is not None:
+            lines.append('  rivers: %d, dropped %d, not converged %d' %
+                         (len(self.rivers), self.rivers['dropped'].sum(),
+                          (~self.rivers['converged']).sum()))
+        lines.append(')')
+        return '\n'.join(lines)
+
+    def _emit(self, event, data):
+        logger.debug('%s %r', event, data)
+        if self.callback is not None:
+            self.callback(event, data)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ context manager timing the enclosed code as stage name """
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start_mem = 0
+        if self.trace_memory:
+            # python < 3.9 reports the peak since tracing started
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = 0.
+            if self.trace_memory:
+                peak = (tracemalloc.get_traced_memory()[1] - start_mem) / 1e6
+            if tracing:
+                tracemalloc.stop()
+            record = self.stages.setdefault(name, {'time_s': 0.,
+                                                   'peak_mb': 0.,
+                                                   'calls': 0})
+            record['time_s'] += elapsed
+            record['peak_mb'] = max(record['peak_mb'], peak)
+            record['calls'] += 1
+            self._emit('stage', dict(record, name=name))
+
+    def set_rivers(self, **counters):
+        """ record per river counters (arrays of length nriver) """
+        nriver = len(next(iter(counters.values())))
+        if self.rivers is None:
+            self.rivers = pd.DataFrame({
+                'snap_distance_km': np.full(nriver, np.nan),
+                'dropped': np.zeros(nriver, dtype=bool),
+                'plume_cells': np.zeros(nriver, dtype=np.int64),
+                'iterations': np.full(nriver, -1, dtype=np.int64),
+                'converged': np.ones(nriver, dtype=bool),
+                'cached': np.zeros(nriver, dtype=bool)},
+                columns=river_columns)
+        for name, values in counters.items():
+            self.rivers[name] = values
+        self._emit('rivers', self.rivers)
+
+    def stages_dataframe(self):
+        """ wall time (s), peak memory (MB) and number of calls of each
+        stage, in order of execution """
+        return pd.DataFrame.from_dict(self.stages, orient='index',
+                                      columns=['time_s', 'peak_mb', 'calls'])
+
+    def rivers_dataframe(self, index=None):
+        """ per river counters, optionally indexed like the river table """
+        if self.rivers is None:
+            return pd.DataFrame(columns=river_columns)
+        rivers = self.rivers.copy()
+        if index is not None:
+            rivers.index = index
+        return rivers
+
+
+def stage(report, name):
+    """ report.stage(name), or a no-op context if report is None """
+    if report is None:
+        return _null_stage()
+    return report.stage(name)
+
+
+@contextlib.contextmanager
+def _null_stage():
+    yield
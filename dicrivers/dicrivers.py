@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
 import xarray as xr
-from dicrivers.geo_utils import find_closest_ocean_cell_to_river_mouth
-from dicrivers.geo_utils import create_plume
+from dicrivers.plumes import make_river_plumes
+from dicrivers.remapper import RiverRemapper, long_to_river_dataset
+from dicrivers.diagnostics import stage
+from dicrivers.rivers import read_river_table, river_columns
 
 
 def make_bgc_river_input(river_df, variables,
@@ -11,21 +13,50 @@ def make_bgc_river_input(river_df, variables,
                          lat_mouth_name='mouth_lat',
                          nitermax=1000,
                          method='average',
-                         prox=200.):
+                         prox=200.,
+                         engine='multisource',
+                         n_workers=1,
+                         executor=None,
+                         cache=None,
+                         river_values=None,
+                         chunks=None,
+                         discharge_name='discharge',
+                         area_grid=None,
+                         output_dtype=np.float64,
+                         report=None,
+                         spreading='grid',
+                         decay='uniform',
+                         periodic=False,
+                         tripolar=False,
+                         plumes=None,
+                         compressed=False,
+                         backend='numpy',
+                         topology=None):
     """ create river bgc concentration file
     Parameters
     ----------
-    river_df : pandas.DataFrame
+    river_df : pandas.DataFrame or string
         dataframe of rivers including values for the bgc concentrations
-        we want to specify and the rspread (radius of spreading)
+        we want to specify and the radius of spreading, rspread (in
+        gridpoints) or rspread_km (in km) depending on spreading. Can be
+        a csv, parquet, Arrow or netCDF file (or a pyarrow Table or
+        xarray Dataset) of which only the needed columns are read, in
+        chunks (see dicrivers.rivers.read_river_table)
     variables : list of string
         bgc variables to work on
-    lon_grid : numpy.ndarray
-        longitudes of the output grid
-    lat_grid : numpy.ndarray
-        latitudes of the output grid
-    mask_grid : numpy.ndarray
-        land/sea mask of the output grid
+    lon_grid : numpy.ndarray or xarray.DataArray
+        longitudes of the output grid, (y, x) or (face, y, x). DataArrays
+        (lazily opened from file or dask-backed) and memory-mapped arrays
+        are only read near the river mouths and in the plume windows, and
+        lon and lat become the output coordinates without being copied
+    lat_grid : numpy.ndarray or xarray.DataArray
+        latitudes of the output grid, (y, x) or (face, y, x)
+    mask_grid : numpy.ndarray or xarray.DataArray
+        land/sea mask of the output grid, (y, x) or (face, y, x), boolean,
+        integer or float (nonzero is ocean). Faces are not connected to
+        each other: mouths are snapped against all faces, but plumes
+        (spread over gridpoints or in km) stay on the face of their
+        mouth and are cut at the face edges
     lon_mouth_name : string
         name of river mouth longitude in dataframe
     lat_mouth_name : string
@@ -33,75 +64,181 @@ def make_bgc_river_input(river_df, variables,
     nitermax : integer
         maximum iterations allowed for convergence
     method : string
-        merging method for plumes (available: 'average')
+        merging method for plumes (available: 'average', 'discharge',
+        'flux'). 'discharge' weights overlapping plumes by river discharge,
+        'flux' spreads the values (loads) over the plumes in proportion to
+        gridcell area, conserving totals.
     prox : float
         acceptable maximum distance (in km) between gridcell and true
         river location
+    engine : string
+        plume construction (available: 'multisource', 'perriver')
+    n_workers : integer
+        number of processes to spread the rivers across
+    executor : concurrent.futures.Executor
+        executor to use instead of a process pool of n_workers
+    cache : dicrivers.cache.GeometryCache or string
+        on-disk cache (or its directory) of mouths and plume footprints,
+        only rivers missing from the cache are computed
+    river_values : xarray.Dataset or pandas.DataFrame
+        time-varying concentrations, used instead of the river_df columns:
+        either a dataset of (time, river) variables (rivers in the order
+        of river_df, or reordered by their river coordinate if it has
+        one), or a long-format dataframe with 'time' and 'river' columns
+        (river matching the river_df index) and one column per variable
+    chunks : dict
+        chunk sizes of the output (e.g. {'y': 500, 'x': 500}) to return
+        lazy dask-backed variables instead of numpy arrays
+    discharge_name : string
+        name of river discharge in dataframe, for method='discharge'
+    area_grid : numpy.ndarray or xarray.DataArray
+        area of the gridcells, for method='flux'
+    output_dtype : numpy.dtype
+        floating point type of the concentrations (e.g. np.float32)
+    report : dicrivers.diagnostics.RunReport
+        if given, filled with the wall time and peak memory of each stage
+        and the counters of each river (see RunReport)
+    spreading : string
+        'grid' spreads the plumes over rspread gridpoints around the
+        mouth, 'km' over the ocean cells within rspread_km of the mouth
+        connected to it by water
+    decay : string
+        for spreading='km', weights of the plumes: 'uniform' or 'gaussian'
+    periodic : bool
+        the (y, x) grid is periodic in x (global grids), plumes spread
+        across the zonal seam
+    tripolar : bool
+        the last row of the (y, x) grid is folded onto itself (tripolar
+        north fold of global MOM6/NEMO grids), plumes spread across it
+    plumes : dicrivers.plumes.RiverPlumes
+        plumes of river_df on this grid from make_river_plumes, to skip
+        snapping and plume growth when they are already known
+    compressed : bool
+        return only the gridcells covered by a plume, along a cell
+        dimension with their flat index (CF compression by gathering),
+        grid indices j, i and lon, lat. dicrivers.expand_compressed
+        expands them back to the grid.
+    backend : string
+        plume growth for spreading='grid': 'numpy', 'numba' (compiled,
+        same plumes, numpy if numba is not installed) or 'auto'
+    topology : dicrivers.topology.GridTopology
+        connectivity of the ocean cells of this grid, built once per grid:
+        mouths are snapped to the closest coastal ocean cell (or ocean
+        cell, without coastal cell within prox) and plumes spread over
+        gridpoints grow along its graph
     Returns
     -------
     river_conc : xarray.Dataset
-        gridded concentrations of bgc variables
+        gridded concentrations of bgc variables, (time, y, x) if
+        river_values is given
     """
-    assert(isinstance(river_df, pd.DataFrame))
     assert(isinstance(variables, list))
-    assert(isinstance(lon_grid, np.ndarray))
-    assert(isinstance(lat_grid, np.ndarray))
-    assert(isinstance(mask_grid, np.ndarray))
+    if not isinstance(river_df, pd.DataFrame):
+        # read only the columns we use
+        columns = river_columns(variables if river_values is None else [],
+                                lon_mouth_name=lon_mouth_name,
+                                lat_mouth_name=lat_mouth_name,
+                                spreading=spreading, method=method,
+                                discharge_name=discharge_name)
+        river_df = read_river_table(river_df, columns=columns)
+    assert(isinstance(river_df, pd.DataFrame))
+    assert(isinstance(lon_grid, (np.ndarray, xr.DataArray)))
+    assert(isinstance(lat_grid, (np.ndarray, xr.DataArray)))
+    assert(isinstance(mask_grid, (np.ndarray, xr.DataArray)))
 
-    # test mak_grid is 2d
-    if len(mask_grid.shape) != 2:
-        raise IOError('mask must be 2d')
+    # test mak_grid is 2d or has a face dimension
+    if len(mask_grid.shape) not in [2, 3]:
+        raise IOError('mask must be 2d or 3d (face, y, x)')
+    if (periodic or tripolar) and len(mask_grid.shape) != 2:
+        raise IOError('periodic and tripolar grids must be 2d')
     # test presence of rspread
-    if 'rspread' not in river_df.keys():
+    if spreading not in ['grid', 'km']:
+        raise ValueError('available spreadings are grid and km')
+    if spreading == 'grid' and 'rspread' not in river_df.keys():
         raise IOError('river dataframe must include radius of spreading')
+    if spreading == 'km' and 'rspread_km' not in river_df.keys():
+        raise IOError('river dataframe must include radius of spreading '
+                      'in km (rspread_km)')
+    if decay not in ['uniform', 'gaussian']:
+        raise ValueError('available decays are uniform and gaussian')
+    if method not in ['average', 'discharge', 'flux']:
+        raise ValueError('available methods are average, discharge and flux')
+    if not np.issubdtype(output_dtype, np.floating):
+        raise ValueError('output_dtype must be a floating point type')
+    if method == 'discharge' and discharge_name not in river_df.keys():
+        raise IOError('river dataframe must include discharge')
 
-    # in order to do what we want, we need to move to xarray framework
-    ny, nx = mask_grid.shape
-    nriver = len(river_df)
-    river_plumes = xr.DataArray(np.zeros((nriver, ny, nx)),
-                                coords={'river': np.arange(nriver),
-                                        'lat': (['y', 'x'], lat_grid),
-                                        'lon': (['y', 'x'], lon_grid)},
-                                dims=['river', 'y', 'x'])
-
-    for index, river in river_df.iterrows():
-        # find the closest ocean point to river mouth
-        lon_river = river[lon_mouth_name]
-        lat_river = river[lat_mouth_name]
-        jmouth, imouth = find_closest_ocean_cell_to_river_mouth(lon_river,
-                                                                lat_river,
-                                                                lon_grid,
-                                                                lat_grid,
-                                                                mask_grid,
-                                                                prox=prox)
-        # create the plume (mask for this particular river)
-        if (jmouth is not None) and (imouth is not None):
-            plume = create_plume(imouth, jmouth, lon_grid, lat_grid, mask_grid,
-                                 rspread=river['rspread'], nitermax=nitermax)
+    if plumes is None:
+        plumes = make_river_plumes(river_df, lon_grid, lat_grid, mask_grid,
+                                   lon_mouth_name=lon_mouth_name,
+                                   lat_mouth_name=lat_mouth_name,
+                                   nitermax=nitermax, prox=prox,
+                                   engine=engine, n_workers=n_workers,
+                                   executor=executor, cache=cache,
+                                   report=report, spreading=spreading,
+                                   decay=decay, periodic=periodic,
+                                   tripolar=tripolar, backend=backend,
+                                   topology=topology)
+    elif plumes.nriver != len(river_df) or plumes.grid_shape != \
+            mask_grid.shape:
+        raise ValueError('plumes do not match the rivers and the grid')
 
-            river_plumes.loc[{'river': index}] = plume
-
-    # add dataarray to Dataset
-    ds_rivers = xr.Dataset({'river_plumes': river_plumes})
-    # populate dataset with concentration values for each variable
-    for var in variables:
-        ds_rivers.update({var: (['river'], river_df[var])})
-
-    # merge the plumes and concentrations
-    river_conc = xr.Dataset()
-    for var in variables:
-        if method == 'average':
-            merged_conc = merge_average(ds_rivers, var)
-        else:
-            raise ValueError('only method available yet is average')
-        river_conc.update({var: merged_conc})
+    # merge the plumes and concentrations of all variables at once
+    discharge = None
+    if method == 'discharge':
+        discharge = river_df[discharge_name].values
+    with stage(report, 'merge'):
+        remapper = RiverRemapper.from_plumes(plumes, lon_grid, lat_grid,
+                                             method=method,
+                                             discharge=discharge,
+                                             area_grid=area_grid)
+    if river_values is None:
+        # all variables are extracted at once as a (variable, river) array
+        values = np.ascontiguousarray(river_df[variables].values.T)
+        river_values = xr.DataArray(values, dims=['variable', 'river'],
+                                    coords={'variable': variables})
+        river_conc = remapper.apply(river_values, chunks=chunks,
+                                    output_dtype=output_dtype, report=report,
+                                    compressed=compressed)
+        with stage(report, 'assembly'):
+            river_conc = river_conc.to_dataset(dim='variable')
+            if compressed:
+                river_conc = river_conc.assign_coords(remapper.grid_coords())
+            return river_conc
+    elif isinstance(river_values, pd.DataFrame):
+        river_values = long_to_river_dataset(river_values, variables,
+                                             river_df.index)
+    elif 'river' in river_values.coords:
+        # rivers in the order of river_df, as for long-format dataframes
+        if not np.isin(river_df.index.values,
+                       river_values['river'].values).all():
+            raise ValueError('river_values must have all the rivers of '
+                             'river_df')
+        river_values = river_values.reindex(river=river_df.index.values)
+    river_conc = remapper.apply(river_values[variables], chunks=chunks,
+                                output_dtype=output_dtype, report=report,
+                                compressed=compressed)
 
     return river_conc
 
 
-def merge_average(ds, var):
-    merged = (ds[var] * ds['river_plumes']).sum(dim='river') / \
-              ds['river_plumes'].sum(dim='river')
-    # when the is no plumes, this returns a NaN, so we fix a poteriori
-    merged = merged.fillna(0)
-    return merged
+def merge_average(plumes, values):
+    """ average the values of overlapping plumes
+
+    Parameters
+    ----------
+    plumes : dicrivers.plumes.RiverPlumes
+        sparse plumes of the rivers
+    values : numpy.ndarray
+        value for each river
+    Returns
+    -------
+    merged : numpy.ndarray
+        merged values on the grid
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # missing values do not contribute but still count in the average
+    values = np.where(np.isnan(values), 0., values)
+    # when there is no plumes, the average is zero
+    merged = plumes.average_weights().dot(values)
+    return merged.reshape(plumes.grid_shape)
@@ -1,11 +1,25 @@
+import logging
 import numpy as np
 import scipy.ndimage as si
+import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
+import scipy.spatial as ss
 import warnings
+from dicrivers import kernels
+
+
+logger = logging.getLogger(__name__)
+
+
+rearth = 6400.
+
+# relative tolerance on distances for equidistant ocean cells
+tie_rtol = 1.e-9
 
 
 def find_closest_ocean_cell_to_river_mouth(lon_river, lat_river,
                                            lon_grid, lat_grid, mask_grid,
-                                           prox=200.):
+                                           prox=200., backend='numpy'):
     '''find grid's closest ocean grid point to true geographical location
     of river mouth by computing distance to the true location and finding
     minimum of array. Land points are set to very large value to exclude them.
@@ -27,15 +41,25 @@ def find_closest_ocean_cell_to_river_mouth(lon_river, lat_river,
     prox : float
         acceptable maximum distance (in km) between gridcell and true
         river location
+    backend : string
+        'numpy', or 'numba' for a compiled search skipping land without
+        temporary grid arrays (same result, numpy if numba is missing)
     Returns
     -------
     jmouth, imouth : integer
         coordinates of river mouth in grid
     '''
+    if kernels.resolve_backend(backend) == 'numba':
+        kmouth, arcmin = kernels.closest_ocean_cell(
+            float(lon_river), float(lat_river),
+            np.ravel(lon_grid), np.ravel(lat_grid), np.ravel(mask_grid))
+        # check that there is an ocean cell
+        assert(kmouth >= 0)
+        return _check_mouth(kmouth, arcmin, lon_river, lat_river,
+                            lon_grid.shape, mask_grid, prox)
     # Convert latitude and longitude to
     # spherical coordinates in radians.
     degrees_to_radians = np.pi/180.0
-    rearth = 6400
     # phi = 90 - latitude
     phi1 = (90.0 - lat_river)*degrees_to_radians
     phi2 = (90.0 - lat_grid)*degrees_to_radians
@@ -55,29 +79,644 @@ def find_closest_ocean_cell_to_river_mouth(lon_river, lat_river,
 
     # Remember to multiply arc by the radius of the earth
     # in your favorite set of units to get length.
-    arc[np.where(mask_grid == 0)] = 1.e36
+    arc[~ocean(mask_grid)] = 1.e36
 
-    jmouth, imouth = np.unravel_index(arc.argmin(), lon_grid.shape)
+    return _check_mouth(arc.argmin(), arc.min(), lon_river, lat_river,
+                        lon_grid.shape, mask_grid, prox)
+
+
+def _check_mouth(kmouth, arcmin, lon_river, lat_river, shape, mask_grid,
+                 prox):
+    ''' grid indices of the closest ocean cell, None if further than
+    prox '''
+    jmouth, imouth = np.unravel_index(kmouth, shape)
     jmouth = int(jmouth)
     imouth = int(imouth)
     # check that we don't fall on a land cell
-    assert(mask_grid[jmouth, imouth] == 1)
+    assert(ocean(mask_grid[jmouth, imouth]))
     # filter out points that do not belong to lat_grid,
     # i.e. are farther away than a few grid cells
     threshold = prox / rearth
-    if arc.min() > threshold:  # proximity threshold exceeded
-        print('river mouth at (lon,lat) = (%f,%f) ' % (lon_river, lat_river))
-        print('is too far from the ocean and cannot not used.')
-        print('It can be out of the domain (regional case) or flowing into')
-        print('an unresolved lake or sea. If you know that river should be')
-        print('there, you may need to increase the proximity range (prox)')
+    if arcmin > threshold:  # proximity threshold exceeded
+        _log_too_far(lon_river, lat_river)
         jmouth = None
         imouth = None
     return jmouth, imouth
 
 
+def _log_too_far(lon_river, lat_river):
+    ''' tell the user a river mouth was filtered out by prox '''
+    lon_river = float(np.squeeze(lon_river))
+    lat_river = float(np.squeeze(lat_river))
+    logger.warning('river mouth at (lon,lat) = (%f,%f) is too far from the '
+                   'ocean and cannot be used. It can be out of the domain '
+                   '(regional case) or flowing into an unresolved lake or '
+                   'sea. If you know that river should be there, you may '
+                   'need to increase the proximity range (prox)',
+                   lon_river, lat_river)
+
+
+def ocean(mask):
+    ''' ocean cells of land/sea mask values: nonzero values, missing values
+    (NaN) being land
+
+    Parameters
+    ----------
+    mask : np.array
+        values of the land/sea mask
+    Returns
+    -------
+    ocean : np.array of bool
+    '''
+    mask = np.asarray(mask)
+    if mask.dtype.kind in 'fc':
+        return (mask != 0) & ~np.isnan(mask)
+    return mask != 0
+
+
+def lonlat_to_xyz(lon, lat):
+    '''convert longitude/latitude (in degrees) to cartesian coordinates
+    on the unit sphere.
+
+    Parameters
+    ----------
+    lon : np.array
+        longitudes
+    lat : np.array
+        latitudes
+    Returns
+    -------
+    xyz : np.array
+        array of shape lon.shape + (3,)
+    '''
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    coslat = np.cos(lat)
+    return np.stack([coslat * np.cos(lon), coslat * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def build_ocean_index(lon_grid, lat_grid, mask_grid):
+    '''build a KD-tree over the ocean cells of the grid, in unit-sphere
+    cartesian coordinates. The index is built once and can answer
+    any number of river mouth queries.
+
+    Parameters
+    ----------
+    lon_grid : np.array
+        longitude of ocean grid
+    lat_grid : np.array
+        latitude of ocean grid
+    mask_grid : np.array
+        land/sea mask of ocean grid
+    Returns
+    -------
+    tree : scipy.spatial.cKDTree
+        KD-tree of ocean cells
+    ocean_cells : np.array
+        flat index (in lon_grid.shape) of each point in the tree
+    '''
+    ocean_cells = np.flatnonzero(ocean(mask_grid))
+    xyz = lonlat_to_xyz(np.ravel(lon_grid)[ocean_cells],
+                        np.ravel(lat_grid)[ocean_cells])
+    tree = ss.cKDTree(xyz)
+    return tree, ocean_cells
+
+
+def find_closest_ocean_cells_to_river_mouths(lon_rivers, lat_rivers,
+                                             lon_grid, lat_grid, mask_grid,
+                                             prox=200., index=None,
+                                             return_distance=False,
+                                             log_too_far=True):
+    '''batched version of find_closest_ocean_cell_to_river_mouth: snap all
+    river mouths in one query against a KD-tree of the ocean cells.
+    Rivers farther than prox from any ocean cell are filtered out.
+
+    Parameters
+    ----------
+    lon_rivers : np.array
+        longitudes of the river mouths in real life
+    lat_rivers : np.array
+        latitudes of the river mouths in real life
+    lon_grid : np.array
+        longitude of ocean grid
+    lat_grid : np.array
+        latitude of ocean grid
+    mask_grid : np.array
+        land/sea mask of ocean grid
+    prox : float
+        acceptable maximum distance (in km) between gridcell and true
+        river location
+    index : tuple
+        (tree, ocean_cells) as returned by build_ocean_index, built
+        if not provided
+    return_distance : bool
+        also return the distance (in km) to the closest ocean cell
+    log_too_far : bool
+        log a warning for each river filtered out
+    Returns
+    -------
+    jmouth, imouth : np.array of integers
+        coordinates of river mouths in grid, -1 for filtered out rivers.
+        For grids with a face dimension, (fmouth, jmouth, imouth).
+    distance : np.array
+        only if return_distance, distance (in km) between each river mouth
+        and the closest ocean cell (NaN if there is no ocean cell)
+    '''
+    lon_rivers = np.atleast_1d(np.asarray(lon_rivers, dtype=np.float64))
+    lat_rivers = np.atleast_1d(np.asarray(lat_rivers, dtype=np.float64))
+    if index is None:
+        index = build_ocean_index(lon_grid, lat_grid, mask_grid)
+    tree, ocean_cells = index
+
+    nriver = len(lon_rivers)
+    mouths = tuple(np.full(nriver, -1, dtype=np.intp)
+                   for dim in np.shape(lon_grid))
+    if nriver == 0 or len(ocean_cells) == 0:
+        if return_distance:
+            return mouths, np.full(nriver, np.nan)
+        return mouths
+
+    xyz = lonlat_to_xyz(lon_rivers, lat_rivers)
+    chord, nearest = tree.query(xyz, k=2)
+    found = ocean_cells[np.minimum(nearest[:, 0], len(ocean_cells) - 1)]
+    # equidistant cells go to the lowest flat index, as the argmin of
+    # find_closest_ocean_cell_to_river_mouth
+    reach = chord[:, 0] * (1 + tie_rtol)
+    tied = np.flatnonzero(chord[:, 1] <= reach)
+    if len(tied) > 0:
+        for k, candidates in zip(tied, tree.query_ball_point(
+                xyz[tied], r=reach[tied])):
+            found[k] = ocean_cells[candidates].min()
+    chord = chord[:, 0]
+    # convert chord length to arc length on the unit sphere
+    arc = 2 * np.arcsin(np.minimum(chord / 2, 1.))
+    # filter out points that do not belong to lat_grid,
+    # i.e. are farther away than a few grid cells
+    threshold = prox / rearth
+    valid = arc <= threshold
+    found = np.unravel_index(found[valid], np.shape(lon_grid))
+    for mouth, index in zip(mouths, found):
+        mouth[valid] = index
+    if log_too_far:
+        for lon_river, lat_river in zip(lon_rivers[~valid],
+                                        lat_rivers[~valid]):
+            _log_too_far(lon_river, lat_river)
+    if return_distance:
+        return mouths, arc * rearth
+    return mouths
+
+
+def _window_bounds(jmouths, imouths, rspreads, ny, nx, face_ny=None,
+                   periodic=False, tripolar=False):
+    ''' windows of +/- rspread gridpoints around the mouths, in window
+    coordinates that continue across the zonal seam (periodic) and above
+    the north fold (tripolar), see _window_to_grid. Returns jmin, imin,
+    height and width of the windows. '''
+    face_ny = ny if face_ny is None else face_ny
+    jstart = (jmouths // face_ny) * face_ny
+    jend = 2 * ny if tripolar else jstart + face_ny
+    jmin = np.maximum(jstart, jmouths - rspreads)
+    jmax = np.minimum(jmouths + rspreads + 1, jend)
+    if periodic:
+        # windows wider than the grid go once around it
+        width = np.minimum(2 * rspreads + 1, nx)
+        imin = imouths - np.minimum(rspreads, nx // 2)
+    else:
+        imin = np.maximum(0, imouths - rspreads)
+        width = np.minimum(imouths + rspreads + 1, nx) - imin
+    return jmin, imin, jmax - jmin, width
+
+
+def _window_to_grid(jj, ii, ny, nx, periodic=False, tripolar=False):
+    ''' grid indices of window coordinates. Columns are taken modulo nx on
+    periodic grids and, on tripolar grids, row ny + k is row ny - 1 - k
+    folded onto the other half of the grid (column nx - 1 - i). '''
+    if tripolar:
+        north = jj >= ny
+        jj = np.where(north, 2 * ny - 1 - jj, jj)
+        ii = np.where(north, nx - 1 - ii, ii)
+    if periodic:
+        ii = ii % nx
+    return jj, ii
+
+
+def _merge_seam(labels):
+    ''' merge the labels of components touching across the zonal seam of
+    a window going once around a periodic grid '''
+    left, right = labels[:, 0], labels[:, -1]
+    linked = (left > 0) & (right > 0)
+    nlabel = labels.max() + 1
+    graph = sp.coo_matrix((np.ones(linked.sum(), dtype=bool),
+                           (left[linked], right[linked])),
+                          shape=(nlabel, nlabel))
+    _, merged = csgraph.connected_components(graph, directed=False)
+    return np.where(labels > 0, merged[labels] + 1, 0)
+
+
+def plume_footprint(imouth, jmouth, mask_grid, rspread=10, nitermax=1000,
+                    face_ny=None, periodic=False, tripolar=False,
+                    backend='numpy'):
+    """ compute the footprint of the plume for the river at imouth, jmouth
+    in a single pass. The converged plume of the iterative spreading is the
+    4-connected component of ocean cells containing the mouth, inside the
+    window of +/- rspread gridpoints around the mouth, so we label the
+    connected components of the window once instead of dilating.
+
+    Parameters
+    ----------
+    imouth : integer
+        index of river mouth in x
+    jmouth : integer
+        index of river mouth in y
+    mask_grid : np.array
+        land/sea mask of ocean grid
+    rspread : integer
+        number of gridpoints for spreading the plume
+    nitermax : integer
+        maximum number of iterations for spreading algo
+    face_ny : integer
+        for multi-face grids stacked along y, number of rows of each face.
+        The plume does not spread out of the face of the mouth.
+    periodic : bool
+        the grid is periodic in x, plumes spread across the zonal seam
+    tripolar : bool
+        the last row of the grid is folded onto itself (tripolar north
+        fold), plumes spread across the fold
+    backend : string
+        'numpy', or 'numba' for a compiled flood fill bounded by nitermax
+        (same result, numpy if numba is missing)
+    Returns
+    -------
+    jmin, imin : integer
+        offset of the window in the grid (0 for periodic or tripolar grids)
+    jplume, iplume : np.array
+        window-local indices of the gridcells in the plume (grid indices
+        for periodic or tripolar grids)
+    """
+    return _plume_footprint(imouth, jmouth, mask_grid, rspread=rspread,
+                            nitermax=nitermax, face_ny=face_ny,
+                            periodic=periodic, tripolar=tripolar,
+                            backend=backend)[:4]
+
+
+def _plume_footprint(imouth, jmouth, mask_grid, rspread=10, nitermax=1000,
+                     face_ny=None, periodic=False, tripolar=False,
+                     backend='numpy'):
+    ''' plume_footprint, also returning whether spreading converged '''
+    ny, nx = mask_grid.shape
+    rspread = int(rspread)
+    # window within the face of the mouth (whole grid for single face grids)
+    jmin, imin, height, width = (int(bound) for bound in _window_bounds(
+        jmouth, imouth, rspread, ny, nx, face_ny=face_ny,
+        periodic=periodic, tripolar=tripolar))
+    wrapped = periodic or tripolar
+
+    if kernels.resolve_backend(backend) == 'numba':
+        stats = {}
+        _, cells = plume_footprints_multisource(
+            [jmouth], [imouth], mask_grid, rspread, nitermax=nitermax,
+            face_ny=face_ny, stats=stats, periodic=periodic,
+            tripolar=tripolar, backend='numba')
+        jplume, iplume = np.divmod(np.sort(cells), nx)
+        if wrapped:
+            return 0, 0, jplume, iplume, stats['converged'][0]
+        return jmin, imin, jplume - jmin, iplume - imin, \
+            stats['converged'][0]
+
+    if wrapped:
+        # index-mapped view of the window, across the seam and the fold
+        jj, ii = _window_to_grid(np.arange(jmin, jmin + height)[:, None],
+                                 np.arange(imin, imin + width)[None, :],
+                                 ny, nx, periodic=periodic, tripolar=tripolar)
+        ocean_zoom = ocean(mask_grid[jj, ii])
+    else:
+        ocean_zoom = ocean(mask_grid[jmin:jmin + height,
+                                     imin:imin + width])
+    # same connectivity as the default binary dilation (no diagonals)
+    structure = si.generate_binary_structure(2, 1)
+    labels, _ = si.label(ocean_zoom, structure=structure)
+    around = periodic and width == nx
+    if around:
+        labels = _merge_seam(labels)
+    plume_zoom = labels == labels[jmouth - jmin, imouth - imin]
+    converged = True
+    if plume_zoom.sum() > nitermax + 1:
+        # plume may be further than nitermax cells from the mouth,
+        # spreading has to be limited to nitermax iterations
+        if around:
+            # dilation does not cross the seam of the window
+            stats = {}
+            _, cells = plume_footprints_multisource(
+                [jmouth], [imouth], mask_grid, rspread, nitermax=nitermax,
+                face_ny=face_ny, periodic=periodic, tripolar=tripolar,
+                stats=stats)
+            jplume, iplume = np.divmod(cells, nx)
+            return 0, 0, jplume, iplume, stats['converged'][0]
+        seed = np.zeros(ocean_zoom.shape, dtype=bool)
+        seed[jmouth - jmin, imouth - imin] = True
+        limited = si.binary_dilation(seed, structure=structure,
+                                     iterations=int(nitermax),
+                                     mask=plume_zoom)
+        converged = limited.sum() == plume_zoom.sum()
+        if not converged:
+            warnings.warn('plume spreading did not converge')
+        plume_zoom = limited
+    jplume, iplume = np.nonzero(plume_zoom)
+    if wrapped:
+        # cells above the fold may be in the window twice
+        cells = np.unique((jj * nx + ii)[jplume, iplume])
+        jplume, iplume = np.divmod(cells, nx)
+        return 0, 0, jplume, iplume, converged
+    return jmin, imin, jplume, iplume, converged
+
+
+def plume_footprints_multisource(jmouths, imouths, mask_grid, rspreads,
+                                 nitermax=1000, face_ny=None, stats=None,
+                                 periodic=False, tripolar=False,
+                                 backend='numpy'):
+    """ compute the plumes of all rivers in one multi-source traversal of
+    the land/sea mask. All river mouths are seeded at once and the fronts
+    of all rivers are advanced together, one gridcell per iteration, each
+    river being confined to its own window of +/- rspread gridpoints. The
+    result is identical to calling plume_footprint for each river.
+
+    Parameters
+    ----------
+    jmouths : np.array of integers
+        indices of river mouths in y, negative for rivers without mouth
+    imouths : np.array of integers
+        indices of river mouths in x, negative for rivers without mouth
+    mask_grid : np.array
+        land/sea mask of ocean grid
+    rspreads : np.array of integers
+        number of gridpoints for spreading the plume of each river
+    nitermax : integer
+        maximum number of iterations for spreading algo
+    face_ny : integer
+        for multi-face grids stacked along y, number of rows of each face
+    stats : dict
+        if given, filled with per river 'iterations' (number of spreading
+        iterations that grew the plume, -1 if not tracked) and 'converged'
+    periodic : bool
+        the grid is periodic in x, plumes spread across the zonal seam
+    tripolar : bool
+        the last row of the grid is folded onto itself (tripolar north
+        fold), plumes spread across the fold
+    backend : string
+        'numpy', or 'numba' to flood fill the windows one river at a time
+        with a compiled bounded queue (same result, numpy if numba is
+        missing)
+    Returns
+    -------
+    rivers, cells : np.array
+        coordinates of the plumes: river number and flat index in the grid
+        of each gridcell reached by the river
+    """
+    ny, nx = mask_grid.shape
+    jmouths = np.asarray(jmouths, dtype=np.intp)
+    imouths = np.asarray(imouths, dtype=np.intp)
+    rspreads = np.broadcast_to(np.asarray(rspreads), jmouths.shape)
+    rspreads = rspreads.astype(np.intp)
+    rivers = np.flatnonzero((jmouths >= 0) & (imouths >= 0))
+    iterations = np.zeros(len(rivers), dtype=np.intp)
+    converged = np.ones(len(rivers), dtype=bool)
+    if stats is not None:
+        stats['iterations'] = np.full(len(jmouths), -1, dtype=np.intp)
+        stats['converged'] = np.ones(len(jmouths), dtype=bool)
+    if len(rivers) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    # windows of each river, stacked in one visited buffer. The fronts
+    # are in window coordinates, mapped to the grid to read the mask.
+    jmin, imin, height, width = _window_bounds(
+        jmouths[rivers], imouths[rivers], rspreads[rivers], ny, nx,
+        face_ny=face_ny, periodic=periodic, tripolar=tripolar)
+    around = periodic & (width == nx)
+    offset = np.zeros(len(rivers) + 1, dtype=np.intp)
+    np.cumsum(height * width, out=offset[1:])
+    visited = np.zeros(offset[-1], dtype=bool)
+
+    def expand(kr, jj, ii):
+        ''' new gridcells reached from the fronts (kr, jj, ii) '''
+        new_kr, new_jj, new_ii = [], [], []
+        for dj, di in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            nj = jj + dj
+            ni = ii + di
+            if periodic:
+                # windows going around the grid have no zonal edge
+                ni = np.where(around[kr], ni % width[kr], ni)
+            inside = (nj >= 0) & (nj < height[kr]) & \
+                     (ni >= 0) & (ni < width[kr])
+            nkr, nj, ni = kr[inside], nj[inside], ni[inside]
+            gj, gi = _window_to_grid(jmin[nkr] + nj, imin[nkr] + ni,
+                                     ny, nx, periodic=periodic,
+                                     tripolar=tripolar)
+            wet = ocean(mask_grid[gj, gi])
+            new_kr.append(nkr[wet])
+            new_jj.append(nj[wet])
+            new_ii.append(ni[wet])
+        kr = np.concatenate(new_kr)
+        jj = np.concatenate(new_jj)
+        ii = np.concatenate(new_ii)
+        key = offset[kr] + jj * width[kr] + ii
+        key, first = np.unique(key, return_index=True)
+        new = ~visited[key]
+        return key[new], kr[first[new]], jj[first[new]], ii[first[new]]
+
+    # seed all the river mouths at once
+    kr = np.arange(len(rivers))
+    jj = jmouths[rivers] - jmin
+    ii = imouths[rivers] - imin
+
+    if kernels.resolve_backend(backend) == 'numba':
+        visited, iterations, converged = kernels.flood_fill_windows(
+            mask_grid, jj, ii, jmin, imin, height, width, around, offset,
+            int(nitermax), bool(periodic), bool(tripolar))
+        if not converged.all():
+            warnings.warn('plume spreading did not converge')
+    else:
+        visited[offset[kr] + jj * width + ii] = True
+        for kk in np.arange(nitermax):
+            key, kr, jj, ii = expand(kr, jj, ii)
+            if len(key) == 0:
+                break
+            visited[key] = True
+            iterations[kr] = kk + 1
+        else:
+            # WARNING: did not converge
+            unfinished = expand(kr, jj, ii)[1]
+            if len(unfinished) > 0:
+                converged[unfinished] = False
+                warnings.warn('plume spreading did not converge')
+    if stats is not None:
+        stats['iterations'][rivers] = iterations
+        stats['converged'][rivers] = converged
+
+    # go back from the stacked windows to the grid
+    key = np.flatnonzero(visited)
+    kr = np.searchsorted(offset, key, side='right') - 1
+    local = key - offset[kr]
+    jj, ii = _window_to_grid(jmin[kr] + local // width[kr],
+                             imin[kr] + local % width[kr],
+                             ny, nx, periodic=periodic, tripolar=tripolar)
+    cells = jj * nx + ii
+    if tripolar:
+        # cells above the fold may be in the window twice
+        ncell = ny * nx
+        pairs = np.unique(rivers[kr].astype(np.int64) * ncell + cells)
+        return (pairs // ncell).astype(np.intp), (pairs % ncell)
+    return rivers[kr], cells
+
+
+def plume_footprints_perriver(jmouths, imouths, mask_grid, rspreads,
+                              nitermax=1000, face_ny=None, stats=None,
+                              periodic=False, tripolar=False,
+                              backend='numpy'):
+    """ compute the plumes of all rivers, one river at a time with
+    plume_footprint. Same inputs and outputs as
+    plume_footprints_multisource, iterations are not tracked.
+    """
+    ny, nx = mask_grid.shape
+    if stats is not None:
+        stats['iterations'] = np.full(len(jmouths), -1, dtype=np.intp)
+        stats['converged'] = np.ones(len(jmouths), dtype=bool)
+    rspreads = np.broadcast_to(np.asarray(rspreads), np.shape(jmouths))
+    rivers, cells = [], []
+    for kriver in range(len(jmouths)):
+        jmouth, imouth = jmouths[kriver], imouths[kriver]
+        if (jmouth < 0) or (imouth < 0):
+            continue
+        jmin, imin, jplume, iplume, converged = _plume_footprint(
+            imouth, jmouth, mask_grid, rspread=rspreads[kriver],
+            nitermax=nitermax, face_ny=face_ny, periodic=periodic,
+            tripolar=tripolar, backend=backend)
+        if stats is not None:
+            stats['converged'][kriver] = converged
+        rivers.append(np.full(len(jplume), kriver, dtype=np.intp))
+        cells.append((jmin + jplume) * nx + imin + iplume)
+    if len(rivers) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    return np.concatenate(rivers), np.concatenate(cells)
+
+
+def plume_footprints_radius(mouths, radii, mask_grid, index,
+                            decay='uniform', n_workers=1, periodic=False,
+                            tripolar=False):
+    """ compute the plumes of all rivers as the ocean cells closer than a
+    radius (in km) to the river mouth and connected to it by water
+    (4-connectivity). Candidate cells come from a ball query on the KD-tree
+    of ocean cells, so that the cost scales with the size of the plumes and
+    not with a number of spreading iterations, and the plume of a river
+    covers the same area on any grid.
+
+    Parameters
+    ----------
+    mouths : np.array
+        flat index of the mouth of each river, -1 for rivers without mouth
+    radii : np.array
+        radius of the plume of each river (in km)
+    mask_grid : np.array
+        land/sea mask of ocean grid, (y, x) or (face, y, x)
+    index : tuple
+        (tree, ocean_cells) from build_ocean_index on the same grid
+    decay : string
+        weights of the plume: 'uniform' or 'gaussian', exp(-d**2 / 2s**2)
+        where d is the distance to the mouth and s half the radius
+    n_workers : integer
+        number of threads for the ball query
+    periodic : bool
+        the grid is periodic in x, cells are connected across the seam
+    tripolar : bool
+        the last row of the grid is folded onto itself, cells are
+        connected across the north fold
+    Returns
+    -------
+    rivers, cells : np.array
+        coordinates of the plumes: river number and flat index in the grid
+        of each gridcell reached by the river
+    weights : np.array
+        weight of each gridcell of the plumes, None for uniform decay
+    """
+    if decay not in ['uniform', 'gaussian']:
+        raise ValueError('available decays are uniform and gaussian')
+    tree, ocean_cells = index
+    mouths = np.asarray(mouths, dtype=np.intp)
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float64),
+                            mouths.shape)
+    ny, nx = mask_grid.shape[-2:]
+    ncell = int(np.prod(mask_grid.shape))
+    valid = np.flatnonzero(mouths >= 0)
+    if len(valid) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        weights = None if decay == 'uniform' else np.zeros(0)
+        return empty, empty, weights
+
+    # candidates: all ocean cells in the ball around the mouth,
+    # the radius converted to a chord length on the unit sphere
+    centers = tree.data[np.searchsorted(ocean_cells, mouths[valid])]
+    chords = 2 * np.sin(np.minimum(radii[valid] / rearth, np.pi) / 2)
+    kwargs = {'workers': n_workers} if n_workers > 1 else {}
+    balls = tree.query_ball_point(centers, chords, **kwargs)
+    lengths = np.array([len(ball) for ball in balls], dtype=np.intp)
+    points = np.concatenate([np.asarray(ball, dtype=np.intp)
+                             for ball in balls])
+    rivers = np.repeat(valid, lengths)
+    keys = rivers.astype(np.int64) * ncell + ocean_cells[points]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    points = points[order]
+    rivers = rivers[order]
+    cells = ocean_cells[points]
+
+    # keep the candidates connected to the mouth: connected components
+    # of the graph linking 4-neighbours in the ball of the same river
+    jj = (cells // nx) % ny
+    ii = cells % nx
+    # eastern neighbours are the next candidate when present
+    east = np.flatnonzero((np.diff(keys) == 1) & (ii[:-1] + 1 < nx))
+    sources, targets = [east], [east + 1]
+    north = np.flatnonzero(jj + 1 < ny)
+    links = [(north, keys[north] + nx)]
+    if periodic:
+        seam = np.flatnonzero(ii == nx - 1)
+        links.append((seam, keys[seam] - (nx - 1)))
+    if tripolar:
+        fold = np.flatnonzero(jj == ny - 1)
+        links.append((fold, keys[fold] + nx - 1 - 2 * ii[fold]))
+    for cands, neighbors in links:
+        found = np.minimum(np.searchsorted(keys, neighbors), len(keys) - 1)
+        linked = keys[found] == neighbors
+        sources.append(cands[linked])
+        targets.append(found[linked])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    graph = sp.coo_matrix((np.ones(len(sources), dtype=bool),
+                           (sources, targets)), shape=(len(keys), len(keys)))
+    _, labels = csgraph.connected_components(graph, directed=False)
+    mouth_keys = valid.astype(np.int64) * ncell + mouths[valid]
+    connected = np.zeros(labels.max() + 1, dtype=bool)
+    connected[labels[np.searchsorted(keys, mouth_keys)]] = True
+    keep = connected[labels]
+    rivers = rivers[keep]
+    cells = cells[keep]
+    if decay == 'uniform':
+        return rivers, cells, None
+
+    # distance to the mouth on the sphere
+    centers = np.repeat(centers, lengths, axis=0)[order][keep]
+    chord = np.sqrt(((tree.data[points[keep]] - centers) ** 2).sum(axis=1))
+    distance = 2 * np.arcsin(np.minimum(chord / 2, 1.)) * rearth
+    sigma = radii[rivers] / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(sigma > 0,
+                           np.exp(-0.5 * (distance / sigma) ** 2), 1.)
+    return rivers, cells, weights
+
+
 def create_plume(imouth, jmouth, lon_grid, lat_grid, mask_grid,
-                 rspread=10, nitermax=1000):
+                 rspread=10, nitermax=1000, periodic=False, tripolar=False,
+                 backend='numpy'):
     """ create the plume for the river at imouth, jmouth with selected
     spreading.
     Parameters
@@ -96,47 +735,26 @@ def create_plume(imouth, jmouth, lon_grid, lat_grid, mask_grid,
         number of gridpoints for spreading the plume
     nitermax : integer
         maximum number of iterations for spreading algo
+    periodic : bool
+        the grid is periodic in x, the plume spreads across the seam
+    tripolar : bool
+        the plume spreads across the north fold of a tripolar grid
+    backend : string
+        'numpy' or 'numba' (see plume_footprint)
     Returns
     -------
     plume : np.array
-        binary mask of same dimensions of mask_grid that is equal to one
-        where the plume is, zero elsewhere.
+        boolean mask of same dimensions of mask_grid that is True
+        where the plume is, False elsewhere.
     """
 
-    #  initialize plume
     ny, nx = mask_grid.shape
-    plume = np.zeros((ny, nx))
-    plume[jmouth, imouth] = 1
-
-    #  for computational efficiency, we used subsets
-    # to +/- rspread in both directions
-    imin = max(0, imouth - rspread)
-    jmin = max(0, jmouth - rspread)
-    imax = min(imouth+rspread+1, nx)
-    jmax = min(jmouth+rspread+1, ny)
-
-    mask_zoom = mask_grid[jmin:jmax, imin:imax]
-    plume_zoom = plume[jmin:jmax, imin:imax]
-
-    #  run an iterative loop to spread the plume
-    #  init array
-    plume_zoom_old = plume_zoom.copy()
-
-    for kk in np.arange(nitermax):
-        #  use binary dilatation to spread plume
-        plume_zoom_new = si.binary_dilation(plume_zoom_old)
-        #  correct spreading with land/sea mask
-        plume_zoom_new = plume_zoom_new * mask_zoom
-        #  stop if we converged
-        if (plume_zoom_new == plume_zoom_old).all():
-            break
-        # update array
-        plume_zoom_old = plume_zoom_new.copy()
-        # WARNING: did not converge
-        if kk == nitermax-1:
-            warnings.warn('plume spreading did not converge')
-
-        # go back to full size array
-        plume[jmin:jmax, imin:imax] = plume_zoom_new
-
+    plume = np.zeros((ny, nx), dtype=bool)
+    jmin, imin, jplume, iplume = plume_footprint(imouth, jmouth, mask_grid,
+                                                 rspread=rspread,
+                                                 nitermax=nitermax,
+                                                 periodic=periodic,
+                                                 tripolar=tripolar,
+                                                 backend=backend)
+    plume[jmin + jplume, imin + iplume] = True
     return plume
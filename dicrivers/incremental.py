@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import xarray as xr
+from dicrivers.plumes import RiverPlumes, make_river_plumes, spread_names
+from dicrivers.remapper import RiverRemapper
+
+
+class IncrementalRiverInput(object):
+    """ river concentrations on the grid, as make_bgc_river_input, that
+    can be updated when the river table changes. The sparse plumes of all
+    rivers are kept so that an update only grows the plumes of new rivers
+    and rivers whose mouth or radius of spreading changed, and only
+    recomputes the gridcells covered by the plumes of changed rivers. The
+    updated result is bit-identical to a full rebuild.
+
+    Parameters
+    ----------
+    river_df : pandas.DataFrame
+        dataframe of rivers including values for the bgc concentrations
+        and the radius of spreading, rivers are identified by the index
+    variables : list of string
+        bgc variables to work on
+    lon_grid : numpy.ndarray
+        longitudes of the output grid, (y, x) or (face, y, x)
+    lat_grid : numpy.ndarray
+        latitudes of the output grid, (y, x) or (face, y, x)
+    mask_grid : numpy.ndarray
+        land/sea mask of the output grid, (y, x) or (face, y, x)
+    method : string
+        merging method for plumes (available: 'average', 'discharge',
+        'flux')
+    discharge_name : string
+        name of river discharge in dataframe, for method='discharge'
+    area_grid : numpy.ndarray
+        area of the gridcells, for method='flux'
+    output_dtype : numpy.dtype
+        floating point type of the concentrations (e.g. np.float32)
+    **kwargs :
+        passed to dicrivers.make_river_plumes (lon_mouth_name, prox,
+        spreading,...)
+
+    Attributes
+    ----------
+    river_conc : xarray.Dataset
+        river concentrations on the grid
+    plumes : dicrivers.plumes.RiverPlumes
+        plumes of the rivers, in the order of river_df
+    changes : dict
+        index of the rivers added, removed, moved (new mouth or radius of
+        spreading) and with new values by the last update
+    """
+
+    def __init__(self, river_df, variables, lon_grid, lat_grid, mask_grid,
+                 method='average', discharge_name='discharge',
+                 area_grid=None, output_dtype=np.float64, **kwargs):
+        assert(isinstance(river_df, pd.DataFrame))
+        assert(isinstance(variables, list))
+        if not river_df.index.is_unique:
+            raise ValueError('rivers must have a unique index')
+        self.variables = variables
+        self.lon_grid = lon_grid
+        self.lat_grid = lat_grid
+        self.mask_grid = mask_grid
+        self.method = method
+        self.discharge_name = discharge_name
+        self.area_grid = area_grid
+        self.output_dtype = output_dtype
+        self.plume_kwargs = kwargs
+        self.geometry_names = [kwargs.get('lon_mouth_name', 'mouth_lon'),
+                               kwargs.get('lat_mouth_name', 'mouth_lat'),
+                               spread_names[kwargs.get('spreading', 'grid')]]
+        self.value_names = list(variables)
+        if method == 'discharge':
+            self.value_names.append(discharge_name)
+
+        self.river_df = river_df.copy()
+        self.plumes = make_river_plumes(river_df, lon_grid, lat_grid,
+                                        mask_grid, **kwargs)
+        remapper = self._remapper(self.river_df, self.plumes)
+        values = xr.Dataset({var: (['river'], river_df[var].values)
+                             for var in variables})
+        self.river_conc = remapper.apply(values, output_dtype=output_dtype)
+        self.changes = {}
+
+    def _remapper(self, river_df, plumes):
+        discharge = None
+        if self.method == 'discharge':
+            discharge = river_df[self.discharge_name].values
+        return RiverRemapper.from_plumes(plumes, self.lon_grid,
+                                         self.lat_grid, method=self.method,
+                                         discharge=discharge,
+                                         area_grid=self.area_grid)
+
+    def update(self, river_df):
+        """ update the river concentrations for a new river table
+
+        Parameters
+        ----------
+        river_df : pandas.DataFrame
+            new dataframe of rivers, with the same columns
+        Returns
+        -------
+        river_conc : xarray.Dataset
+            river concentrations on the grid for the new table
+        """
+        assert(isinstance(river_df, pd.DataFrame))
+        if not river_df.index.is_unique:
+            raise ValueError('rivers must have a unique index')
+        old_df = self.river_df
+        old_position = pd.Series(np.arange(len(old_df)), index=old_df.index)
+        position = old_position.reindex(river_df.index).values
+        kept = ~np.isnan(position)
+        position = np.where(kept, position, -1).astype(np.intp)
+        removed = np.setdiff1d(np.arange(len(old_df)), position[kept])
+
+        # compare the kept rivers, NaN being equal to NaN
+        moved = np.zeros(len(river_df), dtype=bool)
+        revalued = np.zeros(len(river_df), dtype=bool)
+        moved[kept] = _rows_differ(old_df[self.geometry_names].values[
+            position[kept]], river_df[self.geometry_names].values[kept])
+        revalued[kept] = _rows_differ(old_df[self.value_names].values[
+            position[kept]], river_df[self.value_names].values[kept])
+        if (np.diff(position[kept]) < 0).any():
+            # overlapping plumes are summed in river order,
+            # reordered rivers are recomputed
+            revalued[kept] = True
+
+        # grow the plumes of new and moved rivers only
+        grow = np.flatnonzero(~kept | moved)
+        rows = position.copy()
+        matrices = [self.plumes.matrix]
+        if len(grow) > 0:
+            grown = make_river_plumes(river_df.iloc[grow], self.lon_grid,
+                                      self.lat_grid, self.mask_grid,
+                                      **self.plume_kwargs)
+            matrices.append(grown.matrix)
+            rows[grow] = len(old_df) + np.arange(len(grow))
+        matrix = sp.vstack(matrices, format='csr')[rows]
+        plumes = RiverPlumes(matrix, self.plumes.grid_shape)
+
+        # gridcells covered by a changed river, before or after the update
+        changed = ~kept | moved | revalued
+        old_changed = np.union1d(removed, position[kept & (moved | revalued)])
+        cells = np.union1d(self.plumes.matrix[old_changed].indices,
+                           matrix[np.flatnonzero(changed)].indices)
+
+        remapper = self._remapper(river_df, plumes)
+        values = river_df[self.variables].values.T.astype(self.output_dtype)
+        # same product as RiverRemapper.apply, for the changed cells only
+        values = np.where(np.isnan(values), 0, values)
+        weights = remapper._weights_as(self.output_dtype)[cells]
+        patched = weights.dot(values.T).T
+        river_conc = self.river_conc.copy(deep=True)
+        for kvar, var in enumerate(self.variables):
+            river_conc[var].values.reshape(-1)[cells] = patched[kvar]
+
+        self.changes = {'added': river_df.index[~kept],
+                        'removed': old_df.index[removed],
+                        'moved': river_df.index[moved],
+                        'revalued': river_df.index[revalued & ~moved]}
+        self.river_df = river_df.copy()
+        self.plumes = plumes
+        self.river_conc = river_conc
+        return river_conc
+
+
+def _rows_differ(old, new):
+    ''' rows of two object arrays that differ, NaN being equal to NaN '''
+    same = (old == new) | (pd.isnull(old) & pd.isnull(new))
+    return ~same.all(axis=1)
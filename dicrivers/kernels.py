@@ -0,0 +1,150 @@
+''' compiled kernels of the numba backend. numba is optional, the
+functions of geo_utils fall back to their numpy implementation when it is
+not installed. The kernels are compiled on first use. '''
+import warnings
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+backends = ['numpy', 'numba']
+
+
+def resolve_backend(backend):
+    """ backend actually used for a requested backend
+
+    Parameters
+    ----------
+    backend : string
+        'numpy', 'numba' (numpy with a warning if numba is not installed)
+        or 'auto' (numba if installed)
+    Returns
+    -------
+    backend : string
+        'numpy' or 'numba'
+    """
+    if backend == 'auto':
+        return 'numpy' if numba is None else 'numba'
+    if backend not in backends:
+        raise ValueError('available backends are numpy, numba and auto')
+    if backend == 'numba' and numba is None:
+        warnings.warn('numba is not installed, using the numpy backend')
+        return 'numpy'
+    return backend
+
+
+def _jit(func):
+    ''' compile func with numba, if installed '''
+    if numba is None:
+        return func
+    return numba.njit(nogil=True, cache=False)(func)
+
+
+@_jit
+def closest_ocean_cell(lon_river, lat_river, lon_grid, lat_grid, mask_grid):
+    ''' flat index of the closest ocean cell to a river mouth and its arc
+    distance on the unit sphere (-1 if there is no ocean cell), same
+    formula and tie-breaking as find_closest_ocean_cell_to_river_mouth.
+    Land and cells further in latitude alone than the running minimum are
+    skipped, the search stops at the first exact match. Grid arrays are
+    flat. '''
+    degrees_to_radians = np.pi / 180.0
+    phi1 = (90.0 - lat_river) * degrees_to_radians
+    theta1 = lon_river * degrees_to_radians
+    sin_phi1 = np.sin(phi1)
+    cos_phi1 = np.cos(phi1)
+    kmin = -1
+    arcmin = np.inf
+    for k in range(lon_grid.size):
+        # land, or missing value (NaN) over land
+        if not mask_grid[k] != 0 or mask_grid[k] != mask_grid[k]:
+            continue
+        phi2 = (90.0 - lat_grid[k]) * degrees_to_radians
+        # the arc is at least the difference in latitude, with a margin
+        # for the rounding of arccos
+        if abs(phi2 - phi1) > arcmin + 1.e-6:
+            continue
+        theta2 = lon_grid[k] * degrees_to_radians
+        cos = (sin_phi1 * np.sin(phi2) * np.cos(theta1 - theta2) +
+               cos_phi1 * np.cos(phi2))
+        arc = np.arccos(cos)
+        if np.isnan(arc):
+            # rounding above one, argmin would stop here too
+            return k, arc
+        if arc < arcmin:
+            kmin = k
+            arcmin = arc
+            if arc == 0:
+                break
+    return kmin, arcmin
+
+
+@_jit
+def flood_fill_windows(mask_grid, jseeds, iseeds, jmin, imin, height, width,
+                       around, offset, nitermax, periodic, tripolar):
+    ''' bounded breadth-first flood fill of the ocean from each seed,
+    inside its window (see geo_utils._window_bounds), with the same
+    connectivity and stacked visited buffer as
+    plume_footprints_multisource. Returns the visited buffer, the number
+    of iterations that grew each plume and whether it converged within
+    nitermax iterations. '''
+    ny, nx = mask_grid.shape
+    nriver = len(jseeds)
+    visited = np.zeros(offset[-1], dtype=np.bool_)
+    iterations = np.zeros(nriver, dtype=np.intp)
+    converged = np.ones(nriver, dtype=np.bool_)
+    size = 1
+    for kr in range(nriver):
+        size = max(size, height[kr] * width[kr])
+    queue = np.empty(size, dtype=np.intp)
+    depth = np.empty(size, dtype=np.intp)
+    jsteps = np.array([-1, 1, 0, 0])
+    isteps = np.array([0, 0, -1, 1])
+    for kr in range(nriver):
+        base = offset[kr]
+        start = jseeds[kr] * width[kr] + iseeds[kr]
+        visited[base + start] = True
+        queue[0] = start
+        depth[0] = 0
+        head = 0
+        tail = 1
+        while head < tail:
+            key = queue[head]
+            level = depth[head]
+            head += 1
+            jj = key // width[kr]
+            ii = key % width[kr]
+            for step in range(4):
+                nj = jj + jsteps[step]
+                ni = ii + isteps[step]
+                if around[kr]:
+                    # windows going around the grid have no zonal edge
+                    ni = ni % width[kr]
+                if nj < 0 or nj >= height[kr] or ni < 0 or ni >= width[kr]:
+                    continue
+                nkey = nj * width[kr] + ni
+                if visited[base + nkey]:
+                    continue
+                # window to grid coordinates, see geo_utils._window_to_grid
+                gj = jmin[kr] + nj
+                gi = imin[kr] + ni
+                if tripolar and gj >= ny:
+                    gj = 2 * ny - 1 - gj
+                    gi = nx - 1 - gi
+                if periodic:
+                    gi = gi % nx
+                wet = mask_grid[gj, gi]
+                if not wet != 0 or wet != wet:
+                    continue
+                if level == nitermax:
+                    converged[kr] = False
+                    continue
+                visited[base + nkey] = True
+                queue[tail] = nkey
+                depth[tail] = level + 1
+                tail += 1
+                iterations[kr] = level + 1
+    return visited, iterations, converged
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dicrivers.geo_utils import plume_footprints_multisource
+from dicrivers.geo_utils import plume_footprints_perriver
+
+
+_engines = {'multisource': plume_footprints_multisource,
+            'perriver': plume_footprints_perriver}
+
+
+def plume_footprints_parallel(jmouths, imouths, mask_grid, rspreads,
+                              nitermax=1000, engine='multisource',
+                              n_workers=1, executor=None, face_ny=None,
+                              stats=None, periodic=False, tripolar=False,
+                              backend='numpy'):
+    """ compute the plumes of all rivers, spreading the rivers across
+    processes. The land/sea mask is written once to a memory-mapped file
+    that all workers map read-only, so the grid is never pickled. Rivers
+    are split in contiguous chunks and results are gathered in chunk
+    order, so the output is identical to the serial one.
+
+    Parameters
+    ----------
+    jmouths : np.array of integers
+        indices of river mouths in y, negative for rivers without mouth
+    imouths : np.array of integers
+        indices of river mouths in x, negative for rivers without mouth
+    mask_grid : np.array
+        land/sea mask of ocean grid
+    rspreads : np.array of integers
+        number of gridpoints for spreading the plume of each river
+    nitermax : integer
+        maximum number of iterations for spreading algo
+    engine : string
+        plume construction (available: 'multisource', 'perriver')
+    n_workers : integer
+        number of processes
+    executor : concurrent.futures.Executor
+        executor to use instead of a process pool of n_workers
+    face_ny : integer
+        for multi-face grids stacked along y, number of rows of each face
+    stats : dict
+        if given, filled with per river 'iterations' and 'converged'
+    periodic : bool
+        the grid is periodic in x, plumes spread across the zonal seam
+    tripolar : bool
+        plumes spread across the north fold of a tripolar grid
+    backend : string
+        'numpy' or 'numba' (see plume_footprints_multisource)
+    Returns
+    -------
+    rivers, cells : np.array
+        coordinates of the plumes: river number and flat index in the grid
+        of each gridcell reached by the river
+    """
+    if engine not in _engines:
+        raise ValueError('available engines are multisource and perriver')
+    jmouths = np.asarray(jmouths, dtype=np.intp)
+    imouths = np.asarray(imouths, dtype=np.intp)
+    rspreads = np.broadcast_to(np.asarray(rspreads), jmouths.shape)
+    windows = dict(face_ny=face_ny, periodic=periodic, tripolar=tripolar,
+                   backend=backend)
+
+    if executor is None and n_workers <= 1:
+        return _engines[engine](jmouths, imouths, mask_grid, rspreads,
+                                nitermax=nitermax, stats=stats, **windows)
+
+    nchunks = max(1, min(len(jmouths), 4 * max(1, n_workers)))
+    bounds = np.linspace(0, len(jmouths), nchunks + 1).astype(np.intp)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mask_file = os.path.join(tmpdir, 'mask_grid.npy')
+        np.save(mask_file, np.asarray(mask_grid))
+        if executor is None:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                results = _map_chunks(pool, mask_file, bounds, jmouths,
+                                      imouths, rspreads, nitermax, engine,
+                                      windows)
+        else:
+            results = _map_chunks(executor, mask_file, bounds, jmouths,
+                                  imouths, rspreads, nitermax, engine,
+                                  windows)
+
+    rivers = [chunk_rivers + start
+              for (chunk_rivers, _, _), start in zip(results, bounds[:-1])]
+    cells = [chunk_cells for _, chunk_cells, _ in results]
+    if stats is not None:
+        for name in ['iterations', 'converged']:
+            stats[name] = np.concatenate([chunk_stats[name]
+                                          for _, _, chunk_stats in results])
+    return np.concatenate(rivers), np.concatenate(cells)
+
+
+def _map_chunks(executor, mask_file, bounds, jmouths, imouths, rspreads,
+                nitermax, engine, windows):
+    ''' submit one task per chunk of rivers and wait for all results '''
+    futures = [executor.submit(_plume_chunk, mask_file,
+                               jmouths[start:end], imouths[start:end],
+                               np.array(rspreads[start:end]),
+                               nitermax, engine, windows)
+               for start, end in zip(bounds[:-1], bounds[1:])]
+    return [future.result() for future in futures]
+
+
+def _plume_chunk(mask_file, jmouths, imouths, rspreads, nitermax, engine,
+                 windows):
+    ''' worker: plumes of a chunk of rivers on the memory-mapped mask '''
+    mask_grid = np.load(mask_file, mmap_mode='r')
+    stats = {}
+    rivers, cells = _engines[engine](jmouths, imouths, mask_grid, rspreads,
+                                     nitermax=nitermax, stats=stats,
+                                     **windows)
+    return rivers, cells, stats
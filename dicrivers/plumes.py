@@ -0,0 +1,506 @@
+import numpy as np
+import scipy.sparse as sp
+import warnings
+import xarray as xr
+from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+from dicrivers.geo_utils import build_ocean_index, plume_footprints_radius
+from dicrivers.parallel import plume_footprints_parallel
+from dicrivers.cache import GeometryCache, grid_hash, river_keys
+from dicrivers.diagnostics import stage
+from dicrivers.kernels import resolve_backend
+from dicrivers.tiles import TiledGrid, is_lazy, take_cells
+
+
+class RiverPlumes(object):
+    """ sparse storage of river plumes: a (river, cell) matrix where cell
+    is the flat index of a gridcell in the output grid. Memory scales with
+    the total area of the plumes instead of nriver * ny * nx. Plumes built
+    from footprints are boolean, unless they are given weights.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        river to cell weights, of shape (nriver, ncell)
+    grid_shape : tuple
+        shape of the output grid, with prod(grid_shape) == ncell
+    """
+
+    def __init__(self, matrix, grid_shape):
+        self.matrix = sp.csr_matrix(matrix)
+        self.grid_shape = tuple(grid_shape)
+        if self.matrix.shape[1] != int(np.prod(self.grid_shape)):
+            raise ValueError('matrix and grid_shape do not match')
+
+    @classmethod
+    def from_footprints(cls, footprints, grid_shape, weights=None):
+        """ build plumes from a list of footprints
+
+        Parameters
+        ----------
+        footprints : list of np.array
+            flat indices of gridcells covered by each river plume
+            (empty array for rivers without plume)
+        grid_shape : tuple
+            shape of the output grid
+        weights : list of np.array
+            weight of each gridcell of the footprints (None for boolean
+            plumes)
+        Returns
+        -------
+        plumes : RiverPlumes
+        """
+        nriver = len(footprints)
+        ncell = int(np.prod(grid_shape))
+        lengths = np.array([len(fp) for fp in footprints], dtype=np.intp)
+        indptr = np.zeros(nriver + 1, dtype=np.intp)
+        np.cumsum(lengths, out=indptr[1:])
+        if nriver > 0 and indptr[-1] > 0:
+            indices = np.concatenate(footprints).astype(np.intp)
+        else:
+            indices = np.zeros(0, dtype=np.intp)
+        if weights is None:
+            data = np.ones(len(indices), dtype=bool)
+        elif len(indices) > 0:
+            data = np.concatenate(weights).astype(np.float64)
+        else:
+            data = np.zeros(0)
+        matrix = sp.csr_matrix((data, indices, indptr), shape=(nriver, ncell))
+        matrix.sum_duplicates()
+        matrix.sort_indices()
+        return cls(matrix, grid_shape)
+
+    @classmethod
+    def from_coo(cls, rivers, cells, nriver, grid_shape, weights=None):
+        """ build plumes from (river, cell) coordinates
+
+        Parameters
+        ----------
+        rivers : np.array
+            river number of each plume gridcell
+        cells : np.array
+            flat index in the grid of each plume gridcell
+        nriver : integer
+            number of rivers
+        grid_shape : tuple
+            shape of the output grid
+        weights : np.array
+            weight of each plume gridcell (None for boolean plumes)
+        Returns
+        -------
+        plumes : RiverPlumes
+        """
+        ncell = int(np.prod(grid_shape))
+        if weights is None:
+            data = np.ones(len(cells), dtype=bool)
+        else:
+            data = np.asarray(weights, dtype=np.float64)
+        matrix = sp.coo_matrix((data, (rivers, cells)),
+                               shape=(nriver, ncell)).tocsr()
+        matrix.sum_duplicates()
+        matrix.sort_indices()
+        return cls(matrix, grid_shape)
+
+    @property
+    def nriver(self):
+        return self.matrix.shape[0]
+
+    @property
+    def ncell(self):
+        return self.matrix.shape[1]
+
+    def footprint(self, kriver):
+        """ flat indices of gridcells covered by plume of river kriver """
+        start, end = self.matrix.indptr[kriver:kriver + 2]
+        return self.matrix.indices[start:end]
+
+    def average_weights(self):
+        """ normalized (cell, river) weights that average the values of
+        overlapping plumes. Cells without plume have no weights.
+
+        Returns
+        -------
+        weights : scipy.sparse.csr_matrix
+            matrix of shape (ncell, nriver)
+        """
+        weights = self.matrix.T.tocsr().astype(np.float64)
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        weights.data /= np.repeat(total, np.diff(weights.indptr))
+        return weights
+
+    def discharge_weights(self, discharge):
+        """ normalized (cell, river) weights that average the values of
+        overlapping plumes weighted by the discharge of each river.
+        Cells without plume (or only rivers of zero discharge) have no
+        weights.
+
+        Parameters
+        ----------
+        discharge : np.array
+            discharge of each river
+        Returns
+        -------
+        weights : scipy.sparse.csr_matrix
+            matrix of shape (ncell, nriver)
+        """
+        discharge = np.asarray(discharge, dtype=np.float64)
+        if discharge.shape != (self.nriver,):
+            raise ValueError('discharge must have one value per river')
+        if (discharge < 0).any() or np.isnan(discharge).any():
+            raise ValueError('discharge must be positive')
+        weights = self.matrix.T.tocsr().astype(np.float64)
+        weights.data *= discharge[weights.indices]
+        weights.eliminate_zeros()
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        weights.data /= np.repeat(total, np.diff(weights.indptr))
+        return weights
+
+    def flux_weights(self, area_grid):
+        """ (cell, river) weights that spread the load of each river over
+        its plume in proportion to the area of the gridcells. Each river
+        column sums to one, so that the total load is conserved, and
+        overlapping plumes add up.
+
+        Parameters
+        ----------
+        area_grid : np.array or xarray.DataArray
+            area of the gridcells, of shape grid_shape, only read in the
+            plumes
+        Returns
+        -------
+        weights : scipy.sparse.csr_matrix
+            matrix of shape (ncell, nriver)
+        """
+        if int(np.prod(np.shape(area_grid))) != self.ncell:
+            raise ValueError('area_grid must have the shape of the grid')
+        weights = self.matrix.astype(np.float64).tocsr()
+        # area is only read in the plumes
+        cells, inverse = np.unique(weights.indices, return_inverse=True)
+        area = take_cells(area_grid, cells).astype(np.float64)
+        weights.data *= area[inverse]
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        weights.data /= np.repeat(total, np.diff(weights.indptr))
+        return weights.T.tocsr()
+
+    def to_dataarray(self, lon_grid=None, lat_grid=None):
+        """ dense (river, y, x) view of the plumes, for debugging.
+        Beware that this allocates nriver * ny * nx values.
+
+        Parameters
+        ----------
+        lon_grid : numpy.ndarray
+            longitudes of the output grid, added as coordinate
+        lat_grid : numpy.ndarray
+            latitudes of the output grid, added as coordinate
+        Returns
+        -------
+        river_plumes : xarray.DataArray
+        """
+        dense = self.matrix.toarray().reshape((self.nriver,) +
+                                              self.grid_shape)
+        dims = grid_dims(self.grid_shape)
+        coords = {'river': np.arange(self.nriver)}
+        if lat_grid is not None:
+            coords['lat'] = (dims, lat_grid)
+        if lon_grid is not None:
+            coords['lon'] = (dims, lon_grid)
+        return xr.DataArray(dense, coords=coords, dims=['river'] + dims)
+
+
+def make_river_plumes(river_df, lon_grid, lat_grid, mask_grid,
+                      lon_mouth_name='mouth_lon',
+                      lat_mouth_name='mouth_lat',
+                      nitermax=1000,
+                      prox=200.,
+                      engine='multisource',
+                      n_workers=1,
+                      executor=None,
+                      cache=None,
+                      report=None,
+                      spreading='grid',
+                      decay='uniform',
+                      periodic=False,
+                      tripolar=False,
+                      ocean_index=None,
+                      backend='numpy',
+                      topology=None):
+    """ create the sparse plumes of all rivers
+    Parameters
+    ----------
+    river_df : pandas.DataFrame
+        dataframe of rivers including the radius of spreading, rspread
+        (in gridpoints) or rspread_km (in km) depending on spreading
+    lon_grid : numpy.ndarray or xarray.DataArray
+        longitudes of the output grid, (y, x) or (face, y, x). Grids given
+        as DataArrays (lazily loaded or dask-backed) or memory-mapped
+        arrays are read tile by tile, only near the river mouths and in
+        the plume windows (see dicrivers.tiles.TiledGrid)
+    lat_grid : numpy.ndarray or xarray.DataArray
+        latitudes of the output grid, (y, x) or (face, y, x)
+    mask_grid : numpy.ndarray or xarray.DataArray
+        land/sea mask of the output grid, (y, x) or (face, y, x). Plumes
+        stay on the face of their mouth, they do not cross face edges
+    lon_mouth_name : string
+        name of river mouth longitude in dataframe
+    lat_mouth_name : string
+        name of river mouth latitude in dataframe
+    nitermax : integer
+        maximum iterations allowed for convergence
+    prox : float
+        acceptable maximum distance (in km) between gridcell and true
+        river location
+    engine : string
+        'multisource' grows the plumes of all rivers in one traversal,
+        'perriver' grows the plume of each river separately
+    n_workers : integer
+        number of processes to spread the rivers across
+    executor : concurrent.futures.Executor
+        executor to use instead of a process pool of n_workers
+    cache : dicrivers.cache.GeometryCache or string
+        on-disk cache (or its directory) of mouths and plume footprints,
+        only rivers missing from the cache are computed
+    report : dicrivers.diagnostics.RunReport
+        if given, filled with the timings and per river counters
+    spreading : string
+        'grid' spreads the plumes over rspread gridpoints around the
+        mouth, 'km' over the ocean cells within rspread_km of the mouth
+        connected to it by water (engine, nitermax and executor are unused)
+    decay : string
+        for spreading='km', weights of the plumes: 'uniform' or 'gaussian'
+    periodic : bool
+        the (y, x) grid is periodic in x, plumes spread across the seam
+    tripolar : bool
+        the last row of the (y, x) grid is folded onto itself (tripolar
+        north fold), plumes spread across the fold
+    ocean_index : tuple
+        KD-tree of the ocean cells from geo_utils.build_ocean_index,
+        to share it between calls on the same grid
+    backend : string
+        plume growth for spreading='grid': 'numpy', 'numba' (compiled
+        flood fill, same plumes, numpy if numba is not installed) or
+        'auto' (numba if installed)
+    topology : dicrivers.topology.GridTopology
+        connectivity of the ocean cells of this grid, built once and
+        shared between calls. River mouths are then snapped to the closest
+        coastal ocean cell (to the closest ocean cell if there is no
+        coastal cell within prox), and plumes spread over gridpoints grow
+        along its graph (same plumes, engine, n_workers and backend are
+        unused) without reading the mask.
+    Returns
+    -------
+    plumes : dicrivers.plumes.RiverPlumes
+        sparse (river, cell) plumes, use plumes.to_dataarray() for a
+        dense view
+    """
+    if spreading not in ['grid', 'km']:
+        raise ValueError('available spreadings are grid and km')
+    if spreading == 'grid' and decay != 'uniform':
+        raise ValueError('decay requires spreading in km')
+    if (periodic or tripolar) and mask_grid.ndim != 2:
+        raise ValueError('periodic and tripolar grids must be 2d')
+    lon_rivers = river_df[lon_mouth_name].values
+    lat_rivers = river_df[lat_mouth_name].values
+    rspreads = river_df[spread_names[spreading]].values
+    if topology is not None:
+        topology.check_grid(mask_grid, periodic=periodic, tripolar=tripolar)
+    tiled = None
+    if any(is_lazy(array) for array in [lon_grid, lat_grid, mask_grid]):
+        tiled = TiledGrid(lon_grid, lat_grid, mask_grid)
+    geometry_kwargs = dict(nitermax=nitermax, prox=prox, engine=engine,
+                           n_workers=n_workers, executor=executor,
+                           report=report, spreading=spreading, decay=decay,
+                           periodic=periodic, tripolar=tripolar,
+                           index=ocean_index,
+                           backend=resolve_backend(backend), tiled=tiled,
+                           topology=topology)
+
+    if cache is None:
+        counters = {}
+        _, rivers, cells, weights = _river_geometry(lon_rivers, lat_rivers,
+                                                    rspreads, lon_grid,
+                                                    lat_grid, mask_grid,
+                                                    counters=counters,
+                                                    **geometry_kwargs)
+        if report is not None:
+            report.set_rivers(**counters)
+        return RiverPlumes.from_coo(rivers, cells, len(river_df),
+                                    mask_grid.shape, weights=weights)
+
+    if not isinstance(cache, GeometryCache):
+        cache = GeometryCache(cache)
+    grid_key = grid_hash(lon_grid, lat_grid, mask_grid)
+    keys = river_keys(lon_rivers, lat_rivers, rspreads, prox, nitermax,
+                      spreading=spreading, decay=decay, periodic=periodic,
+                      tripolar=tripolar, coastal=topology is not None)
+    cached = cache.load(grid_key, keys)
+    # only rivers not in the cache go through snapping and plume growth
+    todo = np.array([k for k, key in enumerate(keys) if key not in cached],
+                    dtype=np.intp)
+    todo_counters = {}
+    if len(todo) > 0:
+        mouths, rivers, cells, weights = _river_geometry(
+            lon_rivers[todo], lat_rivers[todo], rspreads[todo],
+            lon_grid, lat_grid, mask_grid, counters=todo_counters,
+            **geometry_kwargs)
+        order = np.argsort(rivers, kind='stable')
+        bounds = np.searchsorted(rivers[order], np.arange(len(todo) + 1))
+        computed = {}
+        for k in range(len(todo)):
+            plume = order[bounds[k]:bounds[k + 1]]
+            computed[keys[todo[k]]] = (mouths[k], cells[plume])
+            if weights is not None:
+                computed[keys[todo[k]]] += (weights[plume],)
+        cache.store(grid_key, computed)
+        cached.update(computed)
+
+    footprints = [cached[key][1] for key in keys]
+    weights = None
+    if decay != 'uniform':
+        weights = [cached[key][2] for key in keys]
+    if report is not None:
+        # counters of cached rivers other than their plume are unknown
+        counters = dict(
+            snap_distance_km=np.full(len(keys), np.nan),
+            dropped=np.array([cached[key][0] < 0 for key in keys]),
+            plume_cells=np.array([len(f) for f in footprints]),
+            iterations=np.full(len(keys), -1, dtype=np.int64),
+            converged=np.ones(len(keys), dtype=bool),
+            cached=np.ones(len(keys), dtype=bool))
+        for name, values in todo_counters.items():
+            counters[name][todo] = values
+        report.set_rivers(**counters)
+    return RiverPlumes.from_footprints(footprints, mask_grid.shape,
+                                       weights=weights)
+
+
+# column of the river dataframe holding the radius of spreading
+spread_names = {'grid': 'rspread', 'km': 'rspread_km'}
+
+
+def _river_geometry(lon_rivers, lat_rivers, rspreads,
+                    lon_grid, lat_grid, mask_grid,
+                    nitermax=1000, prox=200., engine='multisource',
+                    n_workers=1, executor=None, report=None,
+                    counters=None, spreading='grid', decay='uniform',
+                    periodic=False, tripolar=False, index=None,
+                    backend='numpy', tiled=None, topology=None):
+    """ snap the river mouths and grow their plumes. The stages are timed
+    in report and the per river counters stored in counters if given.
+    With a TiledGrid, only the ocean cells within reach of the mouths and
+    the mask in the plume windows are read. With a GridTopology, mouths
+    are snapped to the coastal ocean cells, or to all the ocean cells when
+    no coastal cell is within prox, and plumes in gridpoints grow along
+    its graph.
+
+    Returns
+    -------
+    mouths : np.array
+        flat index of the mouth of each river, -1 for filtered out rivers
+    rivers, cells : np.array
+        coordinates of the plumes: river number and flat index in the grid
+        of each gridcell reached by the river
+    weights : np.array
+        weight of each plume gridcell, None for boolean plumes
+    """
+    # find the closest ocean point to all river mouths at once,
+    # on all faces for multi-face grids
+    with stage(report, 'snapping'):
+        if index is None and (topology is None or spreading == 'km'):
+            index = _ocean_index(lon_rivers, lat_rivers, rspreads, lon_grid,
+                                 lat_grid, mask_grid, prox, spreading, tiled)
+        if topology is None:
+            mouths, distance = find_closest_ocean_cells_to_river_mouths(
+                lon_rivers, lat_rivers, lon_grid, lat_grid, mask_grid,
+                prox=prox, index=index, return_distance=True)
+        else:
+            mouths, distance = find_closest_ocean_cells_to_river_mouths(
+                lon_rivers, lat_rivers, lon_grid, lat_grid, mask_grid,
+                prox=prox, index=topology.coastal_index(),
+                return_distance=True, log_too_far=False)
+            # rivers without coastal cell within prox (grids without land,
+            # mouths near the edge of the domain) snap to all the ocean
+            far = np.flatnonzero(mouths[0] < 0)
+            if len(far) > 0:
+                if len(topology.coastal) == 0:
+                    warnings.warn('topology has no coastal cells, mouths '
+                                  'are snapped to all the ocean cells')
+                if index is None:
+                    index = _ocean_index(lon_rivers[far], lat_rivers[far],
+                                         rspreads[far], lon_grid, lat_grid,
+                                         mask_grid, prox, spreading, tiled)
+                far_mouths, distance[far] = \
+                    find_closest_ocean_cells_to_river_mouths(
+                        lon_rivers[far], lat_rivers[far], lon_grid,
+                        lat_grid, mask_grid, prox=prox, index=index,
+                        return_distance=True)
+                for mouth, far_mouth in zip(mouths, far_mouths):
+                    mouth[far] = far_mouth
+    dropped = mouths[0] < 0
+    if tiled is not None:
+        # the closest ocean cell of dropped rivers is not searched
+        distance = np.where(dropped, np.nan, distance)
+    flat_mouths = np.where(dropped, -1, np.ravel_multi_index(
+        tuple(np.maximum(mouth, 0) for mouth in mouths), mask_grid.shape))
+
+    stats = {}
+    if spreading == 'km':
+        with stage(report, 'plume_growth'):
+            rivers, cells, weights = plume_footprints_radius(
+                flat_mouths, rspreads, mask_grid, index, decay=decay,
+                n_workers=n_workers, periodic=periodic, tripolar=tripolar)
+        stats['iterations'] = np.full(len(flat_mouths), -1, dtype=np.intp)
+        stats['converged'] = np.ones(len(flat_mouths), dtype=bool)
+    else:
+        # faces are stacked along y and plumes stay on the face of
+        # their mouth, flat indices are unchanged by the stacking
+        nx = mask_grid.shape[-1]
+        face_ny = mask_grid.shape[1] if mask_grid.ndim == 3 else None
+        jmouths = np.where(dropped, -1, flat_mouths // nx)
+        imouths = np.where(dropped, -1, flat_mouths % nx)
+        with stage(report, 'plume_growth'):
+            if topology is not None:
+                rivers, cells = topology.plume_footprints(
+                    jmouths, imouths, rspreads, nitermax=nitermax,
+                    stats=stats)
+            else:
+                if tiled is not None:
+                    mask_stacked = tiled.window_mask(jmouths, imouths,
+                                                     rspreads,
+                                                     periodic=periodic,
+                                                     tripolar=tripolar)
+                else:
+                    mask_stacked = mask_grid.reshape((-1, nx))
+                rivers, cells = plume_footprints_parallel(
+                    jmouths, imouths, mask_stacked, rspreads,
+                    nitermax=nitermax, engine=engine, n_workers=n_workers,
+                    executor=executor, face_ny=face_ny, stats=stats,
+                    periodic=periodic, tripolar=tripolar, backend=backend)
+        weights = None
+    if counters is not None:
+        counters.update(snap_distance_km=distance,
+                        dropped=dropped,
+                        plume_cells=np.bincount(rivers,
+                                                minlength=len(flat_mouths)),
+                        iterations=stats['iterations'],
+                        converged=stats['converged'],
+                        cached=np.zeros(len(flat_mouths), dtype=bool))
+    return flat_mouths, rivers, cells, weights
+
+
+def _ocean_index(lon_rivers, lat_rivers, rspreads, lon_grid, lat_grid,
+                 mask_grid, prox, spreading, tiled):
+    ''' KD-tree of all the ocean cells, or of the ocean cells within reach
+    of the mouths for a TiledGrid '''
+    if tiled is None:
+        return build_ocean_index(lon_grid, lat_grid, mask_grid)
+    # km plumes reach rspread_km further than the mouth cell
+    reach = prox
+    if spreading == 'km' and len(rspreads) > 0:
+        reach += max(0., np.nanmax(rspreads))
+    return tiled.ocean_index(lon_rivers, lat_rivers, reach)
+
+
+def grid_dims(grid_shape):
+    """ dimension names of a (y, x) or (face, y, x) grid """
+    if len(grid_shape) == 3:
+        return ['face', 'y', 'x']
+    return ['y', 'x']
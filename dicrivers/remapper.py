@@ -0,0 +1,611 @@
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+from dicrivers.plumes import make_river_plumes, grid_dims
+from dicrivers.diagnostics import stage
+from dicrivers.tiles import grid_variable, take_cells
+
+
+class RiverRemapper(object):
+    """ remap river values to the ocean grid. The geometry (mouth snapping
+    and plume growth) is done once and stored as a normalized sparse
+    (cell, river) weight operator, which can then be applied to any number
+    of variables and timesteps.
+
+    Parameters
+    ----------
+    river_df : pandas.DataFrame
+        dataframe of rivers including the radius of spreading (rspread,
+        or rspread_km for spreading='km')
+    lon_grid : numpy.ndarray or xarray.DataArray
+        longitudes of the output grid, (y, x) or (face, y, x)
+    lat_grid : numpy.ndarray or xarray.DataArray
+        latitudes of the output grid, (y, x) or (face, y, x)
+    mask_grid : numpy.ndarray or xarray.DataArray
+        land/sea mask of the output grid, (y, x) or (face, y, x)
+    method : string
+        merging method for plumes (available: 'average', 'discharge',
+        'flux'), see plumes_to_weights
+    discharge_name : string
+        name of river discharge in dataframe, for method='discharge'
+    area_grid : numpy.ndarray
+        area of the gridcells, for method='flux'
+    **kwargs :
+        passed to dicrivers.make_river_plumes
+    """
+
+    def __init__(self, river_df, lon_grid, lat_grid, mask_grid,
+                 method='average', discharge_name='discharge',
+                 area_grid=None, **kwargs):
+        plumes = make_river_plumes(river_df, lon_grid, lat_grid, mask_grid,
+                                   **kwargs)
+        discharge = None
+        if method == 'discharge':
+            discharge = river_df[discharge_name].values
+        self._set_weights(plumes_to_weights(plumes, method=method,
+                                            discharge=discharge,
+                                            area_grid=area_grid),
+                          lon_grid, lat_grid, method)
+
+    @classmethod
+    def from_plumes(cls, plumes, lon_grid, lat_grid, method='average',
+                    discharge=None, area_grid=None):
+        """ build the remapper from already computed plumes
+
+        Parameters
+        ----------
+        plumes : dicrivers.plumes.RiverPlumes
+            sparse plumes of the rivers
+        lon_grid : numpy.ndarray or xarray.DataArray
+            longitudes of the output grid, passed on to the output
+            coordinates without being loaded
+        lat_grid : numpy.ndarray or xarray.DataArray
+            latitudes of the output grid
+        method : string
+            merging method for plumes (available: 'average', 'discharge',
+            'flux')
+        discharge : numpy.ndarray
+            discharge of each river, for method='discharge'
+        area_grid : numpy.ndarray
+            area of the gridcells, for method='flux'
+        Returns
+        -------
+        remapper : RiverRemapper
+        """
+        remapper = cls.__new__(cls)
+        remapper._set_weights(plumes_to_weights(plumes, method=method,
+                                                discharge=discharge,
+                                                area_grid=area_grid),
+                              lon_grid, lat_grid, method)
+        return remapper
+
+    def _set_weights(self, weights, lon_grid, lat_grid, method):
+        self.weights = sp.csr_matrix(weights)
+        self._typed_weights = {}
+        self._covered = None
+        self.lon_grid = lon_grid
+        self.lat_grid = lat_grid
+        self.method = method
+        self.grid_shape = tuple(np.shape(lon_grid))
+        self.dims = grid_dims(self.grid_shape)
+        if self.weights.shape[0] != int(np.prod(self.grid_shape)):
+            raise ValueError('weights and grid do not match')
+
+    @property
+    def nriver(self):
+        return self.weights.shape[1]
+
+    def _weights_as(self, dtype):
+        ''' weights cast once to the output dtype '''
+        dtype = np.dtype(dtype)
+        if dtype == self.weights.dtype:
+            return self.weights
+        if dtype not in self._typed_weights:
+            self._typed_weights[dtype] = self.weights.astype(dtype)
+        return self._typed_weights[dtype]
+
+    def _compressed_weights(self, dtype):
+        ''' rows of the weights for the covered cells, cast to dtype '''
+        key = (np.dtype(dtype), 'compressed')
+        if key not in self._typed_weights:
+            self._typed_weights[key] = \
+                self._weights_as(dtype)[self.covered_cells()]
+        return self._typed_weights[key]
+
+    def covered_cells(self):
+        """ flat indices of the gridcells covered by a plume, the cells of
+        the compressed layout (all other cells are always zero) """
+        if self._covered is None:
+            self._covered = np.flatnonzero(np.diff(self.weights.indptr))
+        return self._covered
+
+    def compressed_coords(self):
+        """ coordinates along the cell dimension of the compressed layout:
+        the list of flat indices of the covered cells in the grid (with the
+        CF compress attribute of compression by gathering), their grid
+        indices (j, i and face_index for face grids) and lon, lat
+
+        Returns
+        -------
+        coords : dict
+        """
+        cells = self.covered_cells()
+        coords = {'cell': ('cell', cells.astype(np.int64),
+                           {'compress': ' '.join(self.dims),
+                            'long_name': 'flat index of the gridcell'})}
+        names = {'face': 'face_index', 'y': 'j', 'x': 'i'}
+        indices = np.unravel_index(cells, self.grid_shape)
+        for dim, index in zip(self.dims, indices):
+            coords[names[dim]] = ('cell', index.astype(np.int64))
+        coords['lon'] = ('cell', take_cells(self.lon_grid, cells))
+        coords['lat'] = ('cell', take_cells(self.lat_grid, cells))
+        return coords
+
+    def grid_coords(self):
+        """ index coordinates of the grid dimensions, which define the
+        dimensions named by the compress attribute in files of the
+        compressed layout
+
+        Returns
+        -------
+        coords : dict
+        """
+        return {dim: (dim, np.arange(size))
+                for dim, size in zip(self.dims, self.grid_shape)}
+
+    def _lonlat_coords(self):
+        ''' lat and lon coordinates of the output, DataArrays of the grid
+        are passed on without being loaded or copied '''
+        return {'lat': grid_variable(self.lat_grid, self.dims),
+                'lon': grid_variable(self.lon_grid, self.dims)}
+
+    def __repr__(self):
+        return ('RiverRemapper(method=%r, nriver=%d, grid_shape=%r, nnz=%d)' %
+                (self.method, self.nriver, self.grid_shape, self.weights.nnz))
+
+    def __call__(self, values, chunks=None, output_dtype=np.float64,
+                 report=None, compressed=False):
+        return self.apply(values, chunks=chunks, output_dtype=output_dtype,
+                          report=report, compressed=compressed)
+
+    def apply(self, values, chunks=None, output_dtype=np.float64,
+              report=None, compressed=False):
+        """ remap river values to the grid in one sparse matrix product
+
+        Parameters
+        ----------
+        values : xarray.DataArray, xarray.Dataset or numpy.ndarray
+            values with a river dimension (last axis for numpy arrays),
+            other dimensions (time, variable,...) are kept. All variables
+            of a Dataset with a river dimension are remapped together.
+        chunks : dict
+            chunk sizes of the output, e.g. {'y': 500, 'x': 500, 'time': 12}.
+            If given, the output is a lazy dask array and each chunk only
+            involves the rivers whose plumes intersect it.
+        output_dtype : numpy.dtype
+            floating point type of the output (e.g. np.float32)
+        report : dicrivers.diagnostics.RunReport
+            if given, the matrix product is timed as the merge stage and
+            the construction of the output as the assembly stage
+        compressed : bool
+            return only the gridcells covered by a plume, along a cell
+            dimension (see compressed_coords), instead of the full grid.
+            Datasets in this layout follow the CF compression by gathering
+            and are expanded back to the grid with expand_compressed.
+        Returns
+        -------
+        remapped : same type as values
+            values on the grid, river dimension replaced by grid dimensions
+            (or by the cell dimension if compressed)
+        """
+        if compressed and chunks is not None:
+            raise ValueError('compressed output cannot be chunked')
+        if not np.issubdtype(output_dtype, np.floating):
+            raise ValueError('output_dtype must be a floating point type')
+        if isinstance(values, xr.Dataset):
+            names = [var for var in values.data_vars
+                     if 'river' in values[var].dims]
+            if len(names) == 0:
+                if compressed:
+                    coords = dict(self.compressed_coords(),
+                                  **self.grid_coords())
+                    return xr.Dataset(coords=coords)
+                return xr.Dataset(coords=self._lonlat_coords())
+            stacked = values[names].to_array(dim='variable')
+            remapped = self.apply(stacked, chunks=chunks,
+                                  output_dtype=output_dtype, report=report,
+                                  compressed=compressed)
+            with stage(report, 'assembly'):
+                remapped = remapped.to_dataset(dim='variable')
+                if compressed:
+                    remapped = remapped.assign_coords(self.grid_coords())
+                return remapped
+
+        if isinstance(values, xr.DataArray):
+            other_dims = [dim for dim in values.dims if dim != 'river']
+            values = values.transpose(*(other_dims + ['river']))
+            with stage(report, 'merge'):
+                if chunks is None:
+                    remapped = self._apply_numpy(values.values, output_dtype,
+                                                 compressed=compressed)
+                else:
+                    dims = other_dims + self.dims
+                    remapped = self._apply_dask(values.values,
+                                                [chunks.get(dim)
+                                                 for dim in dims],
+                                                output_dtype)
+            with stage(report, 'assembly'):
+                coords = {name: coord
+                          for name, coord in values.coords.items()
+                          if 'river' not in coord.dims}
+                if compressed:
+                    out = xr.DataArray(remapped, dims=other_dims + ['cell'],
+                                       coords=coords, name=values.name)
+                    return out.assign_coords(self.compressed_coords())
+                out = xr.DataArray(remapped, dims=other_dims + self.dims,
+                                   coords=coords, name=values.name)
+                return out.assign_coords(self._lonlat_coords())
+
+        with stage(report, 'merge'):
+            return self._apply_numpy(np.asarray(values), output_dtype,
+                                     compressed=compressed)
+
+    def iter_apply(self, values, time_chunk=1, time_dim='time',
+                   output_dtype=np.float64, compressed=False):
+        """ remap time-dependent values one time chunk at a time, so that
+        the gridded output never has to fit in memory at once
+
+        Parameters
+        ----------
+        values : xarray.DataArray or xarray.Dataset
+            values with (time, river) dimensions
+        time_chunk : integer
+            number of timesteps remapped together
+        time_dim : string
+            name of the time dimension
+        output_dtype : numpy.dtype
+            floating point type of the output (e.g. np.float32)
+        compressed : bool
+            yield only the gridcells covered by a plume (see apply)
+        Yields
+        ------
+        remapped : same type as values
+            values on the grid for a chunk of time
+        """
+        ntime = values.sizes[time_dim]
+        for start in range(0, ntime, time_chunk):
+            chunk = values.isel({time_dim: slice(start, start + time_chunk)})
+            yield self.apply(chunk, output_dtype=output_dtype,
+                             compressed=compressed)
+
+    def _apply_dask(self, values, chunks, dtype):
+        ''' lazily remap array of shape (..., river), chunks gives the
+        chunk size (None for no chunking) of each output dimension '''
+        import dask
+        import dask.array as dsa
+
+        if values.shape[-1] != self.nriver:
+            raise ValueError('last dimension must be the %d rivers' %
+                             self.nriver)
+        shape = values.shape[:-1] + self.grid_shape
+        bounds = []
+        for size, chunk in zip(shape, chunks):
+            chunk = size if chunk is None else max(1, int(chunk))
+            starts = list(range(0, size, chunk)) or [0]
+            bounds.append([(start, min(start + chunk, size))
+                           for start in starts])
+        nother = values.ndim - 1
+
+        @dask.delayed
+        def remap_block(values_block, weights_block, block_shape):
+            values_block = values_block.reshape((-1, weights_block.shape[1]))
+            values_block = np.where(np.isnan(values_block), 0, values_block)
+            return weights_block.dot(values_block.T).T.reshape(block_shape)
+
+        def build(level, index):
+            ''' nested list of blocks for dask.array.block '''
+            if level < len(shape):
+                return [build(level + 1, index + [bound])
+                        for bound in bounds[level]]
+            block_shape = tuple(stop - start for start, stop in index)
+            # gridcells of this block and rivers intersecting them
+            grid_ranges = [np.arange(start, stop)
+                           for start, stop in index[nother:]]
+            cells = np.ravel_multi_index(np.meshgrid(*grid_ranges,
+                                                     indexing='ij'),
+                                         self.grid_shape).ravel()
+            weights_block = self._weights_as(dtype)[cells]
+            rivers = np.unique(weights_block.indices)
+            if len(rivers) == 0:
+                return dsa.zeros(block_shape, chunks=block_shape,
+                                 dtype=dtype)
+            weights_block = weights_block[:, rivers]
+            other = tuple(slice(start, stop) for start, stop in index[:nother])
+            values_block = values[other][..., rivers].astype(dtype)
+            block = remap_block(values_block, weights_block, block_shape)
+            return dsa.from_delayed(block, block_shape, dtype=dtype)
+
+        return dsa.block(build(0, []))
+
+    def _apply_numpy(self, values, dtype=np.float64, compressed=False):
+        ''' remap array of shape (..., river), to (..., covered cell) if
+        compressed '''
+        if values.shape[-1] != self.nriver:
+            raise ValueError('last dimension must be the %d rivers' %
+                             self.nriver)
+        other_shape = values.shape[:-1]
+        values = values.reshape((int(np.prod(other_shape)), self.nriver))
+        values = values.astype(dtype)
+        # missing values do not contribute
+        values = np.where(np.isnan(values), 0, values)
+        if compressed:
+            weights = self._compressed_weights(dtype)
+            remapped = weights.dot(values.T).T
+            return remapped.reshape(other_shape + (weights.shape[0],))
+        remapped = self._weights_as(dtype).dot(values.T).T
+        return remapped.reshape(other_shape + self.grid_shape)
+
+    def check_conservation(self, values=None, rtol=1e-10):
+        """ check the weights, at a cost linear in the size of the plumes.
+        For 'average' and 'discharge', the weights of each covered cell
+        must sum to one. For 'flux', the weights of each river with a
+        plume must sum to one and, if values are given, the total of the
+        remapped values must equal the total load of these rivers.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            loads of shape (..., river), for method='flux'
+        rtol : float
+            relative tolerance
+        Returns
+        -------
+        conserved : bool
+        """
+        if self.method == 'flux':
+            total = np.asarray(self.weights.sum(axis=0)).ravel()
+            has_plume = np.diff(self.weights.tocsc().indptr) > 0
+            if not np.allclose(total[has_plume], 1., rtol=rtol, atol=0):
+                return False
+            if values is None:
+                return True
+            values = np.asarray(values, dtype=np.float64)
+            values = values.reshape((-1, self.nriver))
+            values = np.where(np.isnan(values), 0., values)
+            # only covered cells are remapped
+            covered = np.flatnonzero(np.diff(self.weights.indptr))
+            remapped = self.weights[covered].dot(values.T)
+            loads = values[:, has_plume].sum(axis=1)
+            return bool(np.allclose(remapped.sum(axis=0), loads, rtol=rtol,
+                                    atol=0))
+        total = np.asarray(self.weights.sum(axis=1)).ravel()
+        covered = np.diff(self.weights.indptr) > 0
+        return bool(np.allclose(total[covered], 1., rtol=rtol, atol=0))
+
+    def to_netcdf(self, filename):
+        """ save the weights to netcdf, in a (row, col, S) layout
+        similar to ESMF weight files
+
+        Parameters
+        ----------
+        filename : string
+            output file
+        """
+        coo = self.weights.tocoo()
+        ds = xr.Dataset({'row': (['n_s'], coo.row.astype(np.int64)),
+                         'col': (['n_s'], coo.col.astype(np.int64)),
+                         'S': (['n_s'], coo.data),
+                         'lon': (self.dims, np.asarray(self.lon_grid)),
+                         'lat': (self.dims, np.asarray(self.lat_grid))},
+                        attrs={'method': self.method,
+                               'nriver': self.nriver})
+        ds.to_netcdf(filename)
+
+    @classmethod
+    def from_netcdf(cls, filename):
+        """ load the weights saved with to_netcdf
+
+        Parameters
+        ----------
+        filename : string
+            input file
+        Returns
+        -------
+        remapper : RiverRemapper
+        """
+        with xr.open_dataset(filename) as ds:
+            ds = ds.load()
+        ncell = ds['lon'].size
+        weights = sp.csr_matrix((ds['S'].values,
+                                 (ds['row'].values, ds['col'].values)),
+                                shape=(ncell, int(ds.attrs['nriver'])))
+        remapper = cls.__new__(cls)
+        remapper._set_weights(weights, ds['lon'].values, ds['lat'].values,
+                              ds.attrs['method'])
+        return remapper
+
+
+def plumes_to_weights(plumes, method='average', discharge=None,
+                      area_grid=None):
+    """ build the (cell, river) weight operator for a merging method:
+    'average' averages the values of overlapping plumes, 'discharge'
+    weights the average by the discharge of each river and 'flux'
+    spreads the load of each river over its plume in proportion to the
+    area of the gridcells, conserving the total load.
+
+    Parameters
+    ----------
+    plumes : dicrivers.plumes.RiverPlumes
+        sparse plumes of the rivers
+    method : string
+        merging method for plumes (available: 'average', 'discharge',
+        'flux')
+    discharge : numpy.ndarray
+        discharge of each river, for method='discharge'
+    area_grid : numpy.ndarray
+        area of the gridcells, for method='flux'
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        matrix of shape (ncell, nriver)
+    """
+    if method == 'average':
+        return plumes.average_weights()
+    elif method == 'discharge':
+        if discharge is None:
+            raise ValueError('discharge method requires river discharge')
+        return plumes.discharge_weights(discharge)
+    elif method == 'flux':
+        if area_grid is None:
+            raise ValueError('flux method requires area of gridcells')
+        return plumes.flux_weights(area_grid)
+    raise ValueError('available methods are average, discharge and flux')
+
+
+def long_to_river_dataset(long_df, variables, river_index,
+                          time_name='time', river_name='river'):
+    """ convert a long-format dataframe of time-varying river values
+    (one row per river and time) to a (time, river) dataset
+
+    Parameters
+    ----------
+    long_df : pandas.DataFrame
+        dataframe with time, river and variable columns
+    variables : list of string
+        variables to convert
+    river_index : array-like
+        river identifiers, in the order of the river table used to build
+        the plumes. Rivers missing from long_df get NaN values.
+    time_name : string
+        name of time column in long_df
+    river_name : string
+        name of river identifier column in long_df
+    Returns
+    -------
+    river_values : xarray.Dataset
+        variables with (time, river) dimensions
+    """
+    river_values = xr.Dataset()
+    for var in variables:
+        table = long_df.pivot(index=time_name, columns=river_name,
+                              values=var)
+        table = table.reindex(columns=river_index)
+        river_values[var] = xr.DataArray(table.values,
+                                         dims=['time', 'river'],
+                                         coords={'time': table.index.values})
+    return river_values
+
+
+def remap_to_file(remapper, values, filename, time_chunk=1, time_dim='time',
+                  output_dtype=np.float64, compressed=False):
+    """ remap time-dependent values and write them to file time chunk by
+    time chunk. Files ending with .zarr are written with zarr, others
+    with netCDF (requires netCDF4 for appending along time).
+
+    Parameters
+    ----------
+    remapper : RiverRemapper
+        remapper built for the rivers of values
+    values : xarray.Dataset
+        variables with (time, river) dimensions
+    filename : string
+        output file
+    time_chunk : integer
+        number of timesteps remapped and written together
+    time_dim : string
+        name of the time dimension
+    output_dtype : numpy.dtype
+        floating point type of the output (e.g. np.float32)
+    compressed : bool
+        write only the gridcells covered by a plume, with CF compression
+        by gathering (see RiverRemapper.apply and expand_compressed)
+    """
+    if isinstance(values, xr.DataArray):
+        values = values.to_dataset(name=values.name or 'river_conc')
+    chunks = remapper.iter_apply(values, time_chunk=time_chunk,
+                                 time_dim=time_dim,
+                                 output_dtype=output_dtype,
+                                 compressed=compressed)
+    if filename.endswith('.zarr'):
+        for k, chunk in enumerate(chunks):
+            if k == 0:
+                chunk.to_zarr(filename, mode='w')
+            else:
+                chunk.to_zarr(filename, append_dim=time_dim)
+        return
+
+    import netCDF4
+    start = 0
+    for k, chunk in enumerate(chunks):
+        ntime = chunk.sizes[time_dim]
+        if k == 0:
+            chunk.to_netcdf(filename, unlimited_dims=[time_dim])
+            start = ntime
+            continue
+        with netCDF4.Dataset(filename, 'a') as nc:
+            times = nc.variables[time_dim]
+            if 'units' in times.ncattrs() and \
+                    np.issubdtype(chunk[time_dim].dtype, np.datetime64):
+                calendar = getattr(times, 'calendar', 'standard')
+                dates = chunk[time_dim].to_index().to_pydatetime()
+                times[start:start + ntime] = netCDF4.date2num(
+                    dates, times.units, calendar)
+            else:
+                times[start:start + ntime] = chunk[time_dim].values
+            for var in chunk.data_vars:
+                nc.variables[var][start:start + ntime] = chunk[var].values
+        start += ntime
+
+
+def expand_compressed(compressed, grid_shape=None, fill_value=0.):
+    """ expand values in the compressed layout (RiverRemapper.apply with
+    compressed=True, or read back from file) to the full grid
+
+    Parameters
+    ----------
+    compressed : xarray.Dataset or xarray.DataArray
+        values with a cell dimension, whose cell coordinate holds the flat
+        index of each gridcell and names the grid dimensions in its
+        compress attribute
+    grid_shape : tuple of integer
+        shape of the grid, read from the sizes of the grid dimensions of
+        a Dataset if not given (required for a DataArray)
+    fill_value : float
+        value of the gridcells outside the plumes
+    Returns
+    -------
+    expanded : same type as compressed
+        values on the grid, cell dimension replaced by grid dimensions
+    """
+    dims = compressed['cell'].attrs['compress'].split()
+    if isinstance(compressed, xr.Dataset):
+        if grid_shape is None:
+            grid_shape = tuple(compressed.sizes[dim] for dim in dims)
+        expanded = xr.Dataset(attrs=compressed.attrs)
+        for var in compressed.data_vars:
+            if 'cell' in compressed[var].dims:
+                expanded[var] = expand_compressed(compressed[var],
+                                                  grid_shape=grid_shape,
+                                                  fill_value=fill_value)
+            else:
+                expanded[var] = compressed[var]
+        return expanded
+
+    if grid_shape is None:
+        raise ValueError('grid_shape is required to expand a DataArray')
+    grid_shape = tuple(grid_shape)
+    if len(grid_shape) != len(dims):
+        raise ValueError('grid_shape does not match the compressed '
+                         'dimensions %s' % dims)
+    other_dims = [dim for dim in compressed.dims if dim != 'cell']
+    values = compressed.transpose(*(other_dims + ['cell'])).values
+    other_shape = values.shape[:-1]
+    dtype = np.result_type(values.dtype, fill_value)
+    dense = np.full(other_shape + (int(np.prod(grid_shape)),), fill_value,
+                    dtype=dtype)
+    dense[..., compressed['cell'].values] = values
+    coords = {name: coord for name, coord in compressed.coords.items()
+              if 'cell' not in coord.dims}
+    return xr.DataArray(dense.reshape(other_shape + grid_shape),
+                        dims=other_dims + dims, coords=coords,
+                        name=compressed.name, attrs=compressed.attrs)
@@ -0,0 +1,170 @@
+import pandas as pd
+import xarray as xr
+
+
+def river_columns(variables=(), lon_mouth_name='mouth_lon',
+                  lat_mouth_name='mouth_lat', spreading='grid',
+                  method='average', discharge_name='discharge'):
+    """ columns of the river table used by make_bgc_river_input
+
+    Parameters
+    ----------
+    variables : list of string
+        bgc variables
+    lon_mouth_name : string
+        name of river mouth longitude
+    lat_mouth_name : string
+        name of river mouth latitude
+    spreading : string
+        'grid' (rspread column) or 'km' (rspread_km column)
+    method : string
+        merging method, 'discharge' also needs the discharge
+    discharge_name : string
+        name of river discharge
+    Returns
+    -------
+    columns : list of string
+    """
+    columns = [lon_mouth_name, lat_mouth_name,
+               'rspread_km' if spreading == 'km' else 'rspread']
+    if method == 'discharge':
+        columns.append(discharge_name)
+    return columns + [var for var in variables if var not in columns]
+
+
+def iter_river_table(source, columns=None, chunk_size=100000,
+                     river_dim=None, **kwargs):
+    """ read a river table in chunks of rows, keeping only the requested
+    columns, so that large databases never have to be loaded as a whole
+    or as object arrays. Supported sources are csv, parquet, Arrow IPC
+    (feather), netCDF and zarr files (from their extension), and
+    DataFrames, pyarrow Tables and xarray Datasets in memory.
+
+    Parameters
+    ----------
+    source : string, pandas.DataFrame, pyarrow.Table or xarray.Dataset
+        river table
+    columns : list of string
+        columns to read (all columns if None), columns missing from the
+        table are skipped
+    chunk_size : integer
+        number of rivers per chunk
+    river_dim : string
+        for netCDF, zarr and xarray sources, river dimension (default:
+        the dimension of the first column)
+    **kwargs :
+        passed to pandas.read_csv for csv files
+    Yields
+    ------
+    chunk : pandas.DataFrame
+        rows of the table, indexed by their position in the table (or by
+        the river coordinate of xarray sources)
+    """
+    if isinstance(source, pd.DataFrame):
+        table = source
+        if columns is not None:
+            table = source[_present(columns, source.columns)]
+        for start in range(0, len(table), chunk_size):
+            yield table.iloc[start:start + chunk_size]
+        return
+    if isinstance(source, xr.Dataset):
+        for chunk in _iter_dataset(source, columns, chunk_size, river_dim):
+            yield chunk
+        return
+    if not isinstance(source, str):
+        # pyarrow.Table
+        if columns is not None:
+            source = source.select(_present(columns,
+                                            source.schema.names))
+        for chunk in _iter_batches(source.to_batches(chunk_size)):
+            yield chunk
+        return
+
+    name = source.lower()
+    if name.endswith('.parquet') or name.endswith('.pq'):
+        import pyarrow.parquet as pq
+        table = pq.ParquetFile(source)
+        if columns is not None:
+            columns = _present(columns, table.schema_arrow.names)
+        batches = table.iter_batches(batch_size=chunk_size, columns=columns)
+        for chunk in _iter_batches(batches):
+            yield chunk
+    elif name.endswith('.arrow') or name.endswith('.feather') or \
+            name.endswith('.ipc'):
+        import pyarrow.feather as feather
+        table = feather.read_table(source, memory_map=True)
+        if columns is not None:
+            # memory mapped, only the selected columns are read
+            table = table.select(_present(columns, table.schema.names))
+        for chunk in _iter_batches(table.to_batches(chunk_size)):
+            yield chunk
+    elif name.endswith('.nc') or name.endswith('.nc4') or \
+            name.endswith('.zarr'):
+        if name.endswith('.zarr'):
+            ds = xr.open_zarr(source)
+        else:
+            ds = xr.open_dataset(source)
+        with ds:
+            for chunk in _iter_dataset(ds, columns, chunk_size, river_dim):
+                yield chunk
+    else:
+        usecols = None
+        if columns is not None:
+            usecols = columns.__contains__
+        reader = pd.read_csv(source, usecols=usecols, chunksize=chunk_size,
+                             **kwargs)
+        for chunk in reader:
+            yield chunk
+
+
+def read_river_table(source, columns=None, chunk_size=100000,
+                     river_dim=None, **kwargs):
+    """ read the requested columns of a river table, chunk by chunk (see
+    iter_river_table for the arguments and supported sources)
+
+    Returns
+    -------
+    river_df : pandas.DataFrame
+        the requested columns of all rivers
+    """
+    chunks = list(iter_river_table(source, columns=columns,
+                                   chunk_size=chunk_size,
+                                   river_dim=river_dim, **kwargs))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks)
+
+
+def _present(columns, names):
+    ''' columns found in names '''
+    return [col for col in columns if col in names]
+
+
+def _iter_batches(batches):
+    ''' DataFrames of record batches, indexed by their row in the table '''
+    start = 0
+    for batch in batches:
+        chunk = batch.to_pandas()
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+
+def _iter_dataset(ds, columns, chunk_size, river_dim):
+    ''' DataFrames of chunks of the river dimension of a Dataset '''
+    if columns is None:
+        columns = list(ds.data_vars)
+    else:
+        columns = _present(columns, ds.variables)
+    if river_dim is None:
+        river_dim = ds[columns[0]].dims[0]
+    nriver = ds.sizes[river_dim]
+    for start in range(0, nriver, chunk_size):
+        chunk = ds[columns].isel({river_dim: slice(start, start +
+                                                   chunk_size)})
+        if river_dim in ds.coords:
+            index = pd.Index(chunk[river_dim].values, name=river_dim)
+        else:
+            index = pd.RangeIndex(start, start + chunk.sizes[river_dim])
+        yield pd.DataFrame({name: chunk[name].values for name in columns},
+                           index=index, columns=columns)
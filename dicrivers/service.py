@@ -0,0 +1,282 @@
+''' service mode: a long-running dicrivers process that keeps the grids,
+river tables, topologies and plumes of a config in memory and runs the
+jobs sent to it over a Unix socket, so that short jobs do not pay for
+imports, reading the grid and growing the plumes each time.
+
+Start the service with the dicrivers command::
+
+    dicrivers --serve /tmp/dicrivers.sock config.json
+
+and send it jobs, with the same keys as the jobs of the config (grid and
+rivers are names from the config), from python::
+
+    from dicrivers.service import submit
+    record = submit('/tmp/dicrivers.sock', {'grid': 'om4',
+                                            'rivers': 'glorich',
+                                            'variables': ['din'],
+                                            'output': 'om4_din.nc'})
+
+or from the shell::
+
+    dicrivers-submit /tmp/dicrivers.sock job.json
+
+Each request is one JSON object on one line, {"command": ..., ...}, and
+gets one JSON line in reply. Commands are 'run' (with a 'job', replied
+with the job record of the dicrivers summary), 'ping', 'status' and
+'shutdown'. Requests are served one at a time, in order of arrival; jobs
+use the pool of n_workers of the config. A client has request_timeout
+seconds of the config (10 by default) to send its request, after which
+it gets a failed reply and the next request is served.
+
+The socket is only accessible to the user running the service, and the
+outputs of the jobs are written with the rights of that user.
+
+The client side only uses the standard library, and importing dicrivers
+does not import pandas, xarray or scipy.
+'''
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import traceback
+
+
+logger = logging.getLogger('dicrivers')
+
+
+def serve(config, socket_path):
+    """ run the jobs of a config, then serve jobs sent to a Unix socket
+    until a shutdown request
+
+    Parameters
+    ----------
+    config : dict
+        grids, rivers, jobs and run options, see dicrivers.cli.read_config,
+        and request_timeout, the seconds a client has to send its request
+    socket_path : string
+        path of the Unix socket, readable and writable by its owner only,
+        removed at shutdown
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from dicrivers.cli import _Batch
+
+    n_workers = config.get('n_workers', 1)
+    request_timeout = config.get('request_timeout', 10.)
+    batch = _Batch(config)
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+    server = _listen(socket_path)
+    try:
+        # warm up: grids, topologies and the plumes of the config jobs
+        for name in config['grids']:
+            batch.grid(name)
+            batch.topology(name)
+        for kjob, job in enumerate(config['jobs']):
+            name = job.get('name', 'job%d' % kjob)
+            record = batch.run(name, job, executor, n_workers)
+            logger.info('%s: %s in %.3fs', name, record['status'],
+                        record['time_s'])
+        logger.info('serving on %s', socket_path)
+        njob = 0
+        running = True
+        while running:
+            connection, _ = server.accept()
+            with connection:
+                # a silent client cannot hold the service
+                connection.settimeout(request_timeout)
+                try:
+                    message = _receive(connection)
+                    if not isinstance(message, dict):
+                        raise ValueError('request must be a JSON object')
+                    command = message.get('command')
+                    if command == 'run':
+                        job = message.get('job')
+                        if not isinstance(job, dict):
+                            raise ValueError('job must be a JSON object')
+                        name = job.get('name', 'request%d' % njob)
+                        njob += 1
+                        reply = batch.run(name, job, executor, n_workers)
+                        logger.info('%s: %s in %.3fs', name,
+                                    reply['status'], reply['time_s'])
+                    elif command == 'ping':
+                        reply = {'status': 'ok', 'pid': os.getpid()}
+                    elif command == 'status':
+                        reply = {'status': 'ok', 'pid': os.getpid(),
+                                 'jobs': njob, 'grids': sorted(batch.grids),
+                                 'rivers': sorted(batch.rivers),
+                                 'plumes': len(batch.plumes)}
+                    elif command == 'shutdown':
+                        reply = {'status': 'ok'}
+                        running = False
+                    else:
+                        raise ValueError('unknown command %s' % command)
+                except socket.timeout:
+                    reply = {'status': 'failed',
+                             'error': 'no request within %gs' %
+                                      request_timeout}
+                    logger.warning(reply['error'])
+                except Exception:
+                    # a bad request never stops the service
+                    reply = {'status': 'failed',
+                             'error': traceback.format_exc()}
+                    logger.error('request failed:\n%s', reply['error'])
+                try:
+                    _send(connection, reply)
+                except OSError:
+                    logger.warning('client left before the reply')
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        if executor is not None:
+            executor.shutdown()
+    return None
+
+
+def request(socket_path, message, timeout=None):
+    """ send a request to a service and wait for its reply
+
+    Parameters
+    ----------
+    socket_path : string
+        path of the Unix socket of the service
+    message : dict
+        request, with its command
+    timeout : float
+        seconds to wait for the reply (None waits forever)
+    Returns
+    -------
+    reply : dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        _send(connection, message)
+        return _receive(connection)
+
+
+def submit(socket_path, job, timeout=None):
+    """ run a job in a service
+
+    Parameters
+    ----------
+    socket_path : string
+        path of the Unix socket of the service
+    job : dict
+        grid and rivers (names from the config of the service),
+        variables, output and options, as the jobs of the config. A
+        relative output is relative to the current directory.
+    timeout : float
+        seconds to wait for the job (None waits forever)
+    Returns
+    -------
+    record : dict
+        status, timings and river counters of the job, as in the summary
+        of the dicrivers command
+    """
+    job = dict(job)
+    if 'output' in job:
+        job['output'] = os.path.abspath(os.path.expanduser(job['output']))
+    return request(socket_path, {'command': 'run', 'job': job},
+                   timeout=timeout)
+
+
+def wait_for(socket_path, timeout=60.):
+    """ wait until a service answers, for instance while it warms up
+
+    Parameters
+    ----------
+    socket_path : string
+        path of the Unix socket of the service
+    timeout : float
+        seconds to wait before raising a TimeoutError
+    Returns
+    -------
+    reply : dict
+        reply to the ping, with the pid of the service
+    """
+    start = time.perf_counter()
+    while True:
+        try:
+            return request(socket_path, {'command': 'ping'},
+                           timeout=timeout)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError('no service on %s' % socket_path)
+            time.sleep(0.05)
+
+
+def main(argv=None):
+    """ entry point of the dicrivers-submit command """
+    parser = argparse.ArgumentParser(
+        prog='dicrivers-submit',
+        description='send a job to a dicrivers service (dicrivers --serve)')
+    parser.add_argument('socket', help='Unix socket of the service')
+    parser.add_argument('job', nargs='?', default=None,
+                        help='JSON file of the job, paths relative to it')
+    parser.add_argument('--ping', action='store_true',
+                        help='wait for the service to answer')
+    parser.add_argument('--shutdown', action='store_true',
+                        help='stop the service')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to wait for the reply')
+    args = parser.parse_args(argv)
+
+    if args.ping:
+        reply = wait_for(args.socket, timeout=args.timeout or 60.)
+    elif args.shutdown:
+        reply = request(args.socket, {'command': 'shutdown'},
+                        timeout=args.timeout)
+    elif args.job is not None:
+        with open(args.job) as f:
+            job = json.load(f)
+        if 'output' in job:
+            root = os.path.dirname(os.path.abspath(args.job))
+            job['output'] = os.path.join(root,
+                                         os.path.expanduser(job['output']))
+        reply = submit(args.socket, job, timeout=args.timeout)
+    else:
+        parser.error('a job, --ping or --shutdown is required')
+    json.dump(reply, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0 if reply.get('status') == 'ok' else 1
+
+
+def _listen(socket_path):
+    ''' listening Unix socket, replacing the file of a dead service '''
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, {'command': 'ping'}, timeout=1.)
+        except (ConnectionRefusedError, socket.timeout):
+            os.remove(socket_path)
+        else:
+            raise IOError('a service is already listening on %s' %
+                          socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    # jobs write their outputs as the service user: owner only, set
+    # before clients can connect
+    os.chmod(socket_path, 0o600)
+    server.listen()
+    return server
+
+
+def _send(connection, message):
+    ''' write a message as one JSON line '''
+    connection.sendall((json.dumps(message) + '\n').encode())
+
+
+def _receive(connection):
+    ''' read a message written by _send '''
+    with connection.makefile('rb') as stream:
+        line = stream.readline()
+    if not line:
+        raise ValueError('connection closed without a message')
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as error:
+        raise ValueError('message is not JSON: %s' % error)
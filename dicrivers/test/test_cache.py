@@ -0,0 +1,60 @@
+import pandas as pd
+import os
+import numpy as np
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_geometry_cache(datafiles, tmpdir, monkeypatch):
+    'unit test'
+    import dicrivers.plumes as dr
+    from dicrivers.cache import GeometryCache
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+
+    cache = GeometryCache(str(tmpdir.join('cache')))
+    expected = dr.make_river_plumes(rivers, lon_grid, lat_grid, mask_grid)
+    first = dr.make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                 cache=cache)
+    assert((first.matrix != expected.matrix).nnz == 0)
+    assert(cache.size() > 0)
+
+    # count the rivers that go through the geometry stages
+    computed = []
+    river_geometry = dr._river_geometry
+
+    def counting_geometry(lon_rivers, *args, **kwargs):
+        computed.append(len(lon_rivers))
+        return river_geometry(lon_rivers, *args, **kwargs)
+
+    monkeypatch.setattr(dr, '_river_geometry', counting_geometry)
+
+    # second run is read from the cache entirely
+    second = dr.make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                  cache=str(tmpdir.join('cache')))
+    assert(computed == [])
+    assert((second.matrix != expected.matrix).nnz == 0)
+
+    # only the modified river is recomputed
+    rivers.loc[3, 'rspread'] = 2
+    third = dr.make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                 cache=cache)
+    assert(computed == [1])
+    monkeypatch.undo()
+    expected = dr.make_river_plumes(rivers, lon_grid, lat_grid, mask_grid)
+    assert((third.matrix != expected.matrix).nnz == 0)
+
+    # size-bounded eviction keeps the last grid only
+    small = GeometryCache(str(tmpdir.join('cache')), max_size=1)
+    dr.make_river_plumes(rivers, lon_grid, lat_grid, 1 - mask_grid,
+                         cache=small)
+    assert(len(os.listdir(str(tmpdir.join('cache')))) == 1)
@@ -0,0 +1,86 @@
+import pandas as pd
+import os
+import json
+import numpy as np
+import xarray as xr
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_batch_driver(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.cli import main
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['din'] = rivers['testvar'] * 2.
+    rivers.to_csv(str(tmpdir.join('rivers.csv')), index=False)
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-90, 90, 1.))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+    xr.Dataset({'geolon': (['yh', 'xh'], lon_grid),
+                'geolat': (['yh', 'xh'], lat_grid),
+                'wet': (['yh', 'xh'], mask_grid)}).to_netcdf(
+                    str(tmpdir.join('grid.nc')))
+    # the same grid cut in two faces, face dimension last in the file
+
+    def split(array):
+        return np.stack(np.split(array, 2, axis=0), axis=-1)
+
+    faces = xr.Dataset({'XC': (['j', 'i', 'tile'], split(lon_grid)),
+                        'YC': (['j', 'i', 'tile'], split(lat_grid)),
+                        'maskC': (['j', 'i', 'tile'], split(mask_grid))})
+    faces.to_netcdf(str(tmpdir.join('faces.nc')))
+
+    config = {
+        'grids': {'regular': {'file': 'grid.nc', 'lon': 'geolon',
+                              'lat': 'geolat', 'mask': 'wet'},
+                  'faces': {'file': 'faces.nc', 'lon': 'XC', 'lat': 'YC',
+                            'mask': 'maskC', 'face': 'tile'}},
+        'rivers': {'major': {'file': 'rivers.csv'}},
+        'jobs': [{'name': 'test', 'grid': 'regular', 'rivers': 'major',
+                  'variables': ['testvar'], 'output': 'out/testvar.nc'},
+                 {'name': 'din', 'grid': 'regular', 'rivers': 'major',
+                  'variables': ['din'], 'output': 'out/din.nc',
+                  'options': {'output_dtype': 'float32'}},
+                 {'name': 'faces', 'grid': 'faces', 'rivers': 'major',
+                  'variables': ['din'], 'output': 'out/faces.zarr'},
+                 {'name': 'broken', 'grid': 'regular', 'rivers': 'major',
+                  'variables': ['missing'], 'output': 'out/missing.nc'}],
+        'summary': 'summary.json'}
+    with open(str(tmpdir.join('config.json')), 'w') as f:
+        json.dump(config, f)
+
+    assert(main([str(tmpdir.join('config.json'))]) == 1)
+    with open(str(tmpdir.join('summary.json'))) as f:
+        summary = json.load(f)
+    status = {job['name']: job['status'] for job in summary['jobs']}
+    assert(status == {'test': 'ok', 'din': 'ok', 'faces': 'ok',
+                      'broken': 'failed'})
+    # plumes are computed once for the regular grid
+    jobs = summary['jobs']
+    assert(not jobs[0]['plumes_reused'] and jobs[1]['plumes_reused'])
+    assert('plume_growth' in jobs[0]['stages'])
+    assert('plume_growth' not in jobs[1]['stages'])
+    assert(jobs[0]['nriver'] == len(rivers))
+
+    expected = make_bgc_river_input(rivers, ['din'], lon_grid, lat_grid,
+                                    mask_grid, output_dtype=np.float32)
+    out = xr.open_dataset(str(tmpdir.join('out/din.nc')))
+    assert(out['din'].dtype == np.float32)
+    assert(np.array_equal(out['din'].values, expected['din'].values))
+    # plumes do not cross the edges of the faces
+    expected = make_bgc_river_input(
+        rivers, ['din'], np.stack(np.split(lon_grid, 2, axis=0)),
+        np.stack(np.split(lat_grid, 2, axis=0)),
+        np.stack(np.split(mask_grid, 2, axis=0)))
+    out = xr.open_zarr(str(tmpdir.join('out/faces.zarr')))
+    assert(out['din'].dims == ('tile', 'y', 'x'))
+    assert(np.array_equal(out['din'].values, expected['din'].values))
+    return None
@@ -0,0 +1,79 @@
+import pandas as pd
+import os
+import numpy as np
+import pytest
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_run_report(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input, RunReport
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['rspread'] = 5
+    rivers['din'] = 1.
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+
+    events = []
+    report = RunReport(callback=lambda event, data: events.append(event))
+    make_bgc_river_input(rivers, ['din'], lon_grid, lat_grid, mask_grid,
+                         lon_mouth_name='mouth_lon',
+                         lat_mouth_name='mouth_lat', prox=300.,
+                         report=report)
+    stages = report.stages_dataframe()
+    assert(list(stages.index) == ['snapping', 'plume_growth', 'merge',
+                                  'assembly'])
+    assert((stages['time_s'] >= 0).all())
+    assert('stage' in events and 'rivers' in events)
+
+    counters = report.rivers_dataframe(index=rivers.index)
+    assert(len(counters) == len(rivers))
+    dropped = counters['dropped'].values
+    assert((counters['snap_distance_km'][~dropped] <= 300.).all())
+    assert((counters['plume_cells'][dropped] == 0).all())
+    assert((counters['plume_cells'][~dropped] > 0).all())
+    assert((counters['iterations'][~dropped] > 0).all())
+    assert(counters['converged'].all())
+    assert(not counters['cached'].any())
+
+    # rivers read from the cache are flagged
+    report = RunReport(trace_memory=False)
+    for k in range(2):
+        make_bgc_river_input(rivers, ['din'], lon_grid, lat_grid, mask_grid,
+                             lon_mouth_name='mouth_lon',
+                             lat_mouth_name='mouth_lat', prox=300.,
+                             cache=str(tmpdir.join('cache')), report=report)
+    cached = report.rivers_dataframe()
+    assert(cached['cached'].all())
+    assert((cached['plume_cells'].values ==
+            counters['plume_cells'].values).all())
+    assert(report.stages['snapping']['calls'] == 1)
+
+
+def test_plume_stats():
+    'unit test'
+    from dicrivers.geo_utils import plume_footprints_multisource
+    from dicrivers.geo_utils import plume_footprints_perriver
+    mask_grid = np.ones((20, 20))
+    for engine in [plume_footprints_multisource, plume_footprints_perriver]:
+        stats = {}
+        engine([10, -1], [10, -1], mask_grid, 3, stats=stats)
+        assert(stats['converged'].all())
+        stats = {}
+        # not enough iterations to fill the window
+        with pytest.warns(UserWarning):
+            engine([10], [10], mask_grid, 3, nitermax=2, stats=stats)
+        assert(not stats['converged'][0])
+    stats = {}
+    plume_footprints_multisource([10], [10], mask_grid, 3, stats=stats)
+    # 4-connected spreading reaches the corners of the 7x7 window in 6 steps
+    assert(stats['iterations'][0] == 6)
@@ -2,6 +2,7 @@ import pandas as pd
 import os
 import numpy as np
 import xarray as xr
+import pytest
 # requires pytest-datafiles
 
 
@@ -53,3 +54,189 @@ def test_make_bgc_river_input(datafiles):
     assert(isinstance(out['testvar'], xr.DataArray))
     assert(out['testvar'].min().values == 0)
     assert(out['testvar'].max().values == 96)
+
+
+def test_merge_average(datafiles):
+    'unit test'
+    from dicrivers.dicrivers import make_river_plumes, merge_average
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    # make plumes overlap
+    rivers['rspread'] = 20
+
+    plumes = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid)
+    assert(plumes.nriver == len(rivers))
+    assert(plumes.matrix.nnz < plumes.nriver * plumes.ncell)
+
+    # dense view is consistent with sparse storage
+    river_plumes = plumes.to_dataarray(lon_grid=lon_grid, lat_grid=lat_grid)
+    assert(river_plumes.dims == ('river', 'y', 'x'))
+    assert(river_plumes.sum().values == plumes.matrix.nnz)
+
+    # sparse reduction gives the same answer as the dense average
+    testvar = xr.DataArray(rivers['testvar'].values, dims=['river'])
+    expected = (testvar * river_plumes).sum(dim='river') / \
+        river_plumes.sum(dim='river')
+    expected = expected.fillna(0)
+    merged = merge_average(plumes, rivers['testvar'].values)
+    assert(np.allclose(merged, expected.values))
+
+
+def test_make_river_plumes_engines(datafiles):
+    'unit test'
+    from dicrivers.dicrivers import make_river_plumes
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+
+    multi = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                              engine='multisource')
+    single = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                               engine='perriver')
+    assert((multi.matrix != single.matrix).nnz == 0)
+
+
+def test_make_bgc_river_input_parallel(datafiles):
+    'unit test'
+    from concurrent.futures import ThreadPoolExecutor
+    from dicrivers import make_bgc_river_input
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+
+    serial = make_bgc_river_input(rivers, ['testvar'],
+                                  lon_grid, lat_grid, mask_grid)
+    pool = make_bgc_river_input(rivers, ['testvar'],
+                                lon_grid, lat_grid, mask_grid,
+                                n_workers=2)
+    assert(serial.identical(pool))
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        threads = make_bgc_river_input(rivers, ['testvar'],
+                                       lon_grid, lat_grid, mask_grid,
+                                       engine='perriver', executor=executor)
+    assert(serial.identical(threads))
+
+
+def test_make_bgc_river_input_faces(datafiles):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    # global grid cut in 4 faces of 90 degrees
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+    lon_faces = np.stack(np.split(lon_grid, 4, axis=1))
+    lat_faces = np.stack(np.split(lat_grid, 4, axis=1))
+    mask_faces = np.stack(np.split(mask_grid, 4, axis=1))
+
+    out = make_bgc_river_input(rivers, ['testvar'],
+                               lon_faces, lat_faces, mask_faces)
+    assert(out['testvar'].dims == ('face', 'y', 'x'))
+    assert(out['testvar'].max().values == 99)
+
+    # each river is only on the face of its mouth
+    fmouths, jmouths, imouths = find_closest_ocean_cells_to_river_mouths(
+        rivers['mouth_lon'].values, rivers['mouth_lat'].values,
+        lon_faces, lat_faces, mask_faces)
+    for face in range(4):
+        on_face = rivers.loc[fmouths == face].reset_index(drop=True)
+        expected = make_bgc_river_input(on_face, ['testvar'],
+                                        lon_faces[face], lat_faces[face],
+                                        mask_faces[face])
+        assert(np.array_equal(out['testvar'].isel(face=face).values,
+                              expected['testvar'].values))
+
+    # plumes in km do not cross face edges either
+    edge = pd.DataFrame({'mouth_lon': [89.2], 'mouth_lat': [0.],
+                         'rspread_km': [500.], 'testvar': [1.]})
+    out = make_bgc_river_input(edge, ['testvar'], lon_faces, lat_faces,
+                               mask_faces, spreading='km')
+    covered = (out['testvar'] > 0).sum(dim=['y', 'x']).values
+    assert(covered[0] > 0 and covered[1:].sum() == 0)
+
+
+def test_compact_dtypes(datafiles):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.dicrivers import make_river_plumes
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+    expected = make_bgc_river_input(rivers, ['testvar'],
+                                    lon_grid, lat_grid, mask_grid)
+
+    # boolean and integer masks are used as they are
+    for mask in [mask_grid.astype(bool), mask_grid.astype(np.int8)]:
+        plumes = make_river_plumes(rivers, lon_grid, lat_grid, mask)
+        assert(plumes.matrix.dtype == bool)
+        out = make_bgc_river_input(rivers, ['testvar'],
+                                   lon_grid, lat_grid, mask)
+        assert(out.identical(expected))
+
+    out = make_bgc_river_input(rivers, ['testvar'],
+                               lon_grid, lat_grid, mask_grid,
+                               output_dtype=np.float32)
+    assert(out['testvar'].dtype == np.float32)
+    assert(np.allclose(out['testvar'], expected['testvar']))
+    # integer outputs would truncate the averages
+    with pytest.raises(ValueError):
+        make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                             mask_grid, output_dtype=np.int32)
+
+
+def test_make_bgc_river_input_km(datafiles, tmpdir):
+    '''unit test'''
+    from dicrivers import make_bgc_river_input
+    from dicrivers.plumes import make_river_plumes
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['rspread_km'] = 300.
+    rivers['din'] = np.arange(len(rivers)) + 1.
+
+    # same physical plumes on grids of different resolutions
+    ncells = []
+    for res in [1., 0.5]:
+        lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, res),
+                                         np.arange(-90, 90, res))
+        mask_grid = np.ones(lon_grid.shape)
+        mask_grid[lat_grid > 60] = 0
+        plumes = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                   spreading='km')
+        assert(plumes.matrix.dtype == bool)
+        ncells.append(plumes.matrix.nnz)
+    assert(3.5 < ncells[1] / ncells[0] < 4.5)
+
+    out = make_bgc_river_input(rivers, ['din'], lon_grid, lat_grid,
+                               mask_grid, spreading='km', decay='gaussian')
+    din = out['din'].values
+    assert(np.nanmin(din[din > 0]) >= 1.)
+    assert(din.max() <= len(rivers))
+
+    # weights go through the cache
+    cache = str(tmpdir.join('cache'))
+    for k in range(2):
+        cached = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                   spreading='km', decay='gaussian',
+                                   cache=cache)
+    expected = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                 spreading='km', decay='gaussian')
+    assert(abs(cached.matrix - expected.matrix).max() == 0)
+
+    with pytest.raises(IOError):
+        make_bgc_river_input(rivers.drop(columns='rspread_km'), ['din'],
+                             lon_grid, lat_grid, mask_grid, spreading='km')
+    return None
@@ -1,6 +1,7 @@
 import pandas as pd
 import os
 import numpy as np
+import warnings
 # requires pytest-datafiles
 
 
@@ -96,6 +97,54 @@ def test_find_closest_ocean_cell_to_river_mouth(datafiles):
     return None
 
 
+def test_find_closest_ocean_cells_to_river_mouths(datafiles):
+    'unit test'
+    from dicrivers.geo_utils import find_closest_ocean_cell_to_river_mouth
+    from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    # -------------------------------------------------------------------------
+    # regional grid with some land
+    lon_grid, lat_grid = np.meshgrid(np.arange(-120, 30, 0.25),
+                                     np.arange(10, 70, 0.25))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[:, :100] = 0
+
+    jmouths, imouths = find_closest_ocean_cells_to_river_mouths(
+        rivers['mouth_lon'].values, rivers['mouth_lat'].values,
+        lon_grid, lat_grid, mask_grid)
+
+    # batched query gives the same answer as the river by river search
+    for kriver, river in rivers.iterrows():
+        jmouth, imouth = find_closest_ocean_cell_to_river_mouth(
+            river['mouth_lon'], river['mouth_lat'],
+            lon_grid, lat_grid, mask_grid)
+        if jmouth is None:
+            assert(jmouths[kriver] == -1)
+            assert(imouths[kriver] == -1)
+        else:
+            assert(jmouths[kriver] == jmouth)
+            assert(imouths[kriver] == imouth)
+            assert(mask_grid[jmouth, imouth] == 1)
+    # Amazon is out of the domain
+    assert(jmouths[0] == -1)
+
+    # mouths halfway between cells go to the lowest flat index
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 20, 0.5),
+                                     np.arange(30, 40, 0.5))
+    mask_grid = np.ones(lon_grid.shape)
+    lon_rivers = np.array([10.25, 5.75, 3.25, 7.75, 12.25])
+    lat_rivers = np.array([35., 33.25, 31.75, 36.25, 34.])
+    jmouths, imouths = find_closest_ocean_cells_to_river_mouths(
+        lon_rivers, lat_rivers, lon_grid, lat_grid, mask_grid)
+    assert(list(imouths) == [20, 11, 6, 15, 24])
+    for kriver in range(len(lon_rivers)):
+        assert(find_closest_ocean_cell_to_river_mouth(
+            lon_rivers[kriver], lat_rivers[kriver], lon_grid, lat_grid,
+            mask_grid) == (jmouths[kriver], imouths[kriver]))
+    return None
+
+
 def test_create_plume(datafiles):
     '''unit test'''
     from dicrivers.geo_utils import find_closest_ocean_cell_to_river_mouth
@@ -125,7 +174,306 @@ def test_create_plume(datafiles):
                          rspread=rspread, nitermax=nitermax)
 
     assert(isinstance(plume, np.ndarray))
+    assert(plume.dtype == bool)
     #  test for min/max values in the no-mask case
     assert(plume.sum() > 1)
     assert(plume.sum() < (2*rspread+1)**2 + 1)
     return None
+
+
+def _iterative_plume(imouth, jmouth, mask_grid, rspread, nitermax):
+    ''' reference implementation: iterative binary dilation '''
+    import scipy.ndimage as si
+    ny, nx = mask_grid.shape
+    plume = np.zeros((ny, nx))
+    plume[jmouth, imouth] = 1
+    imin = max(0, imouth - rspread)
+    jmin = max(0, jmouth - rspread)
+    imax = min(imouth+rspread+1, nx)
+    jmax = min(jmouth+rspread+1, ny)
+    mask_zoom = mask_grid[jmin:jmax, imin:imax]
+    plume_zoom_old = plume[jmin:jmax, imin:imax].copy()
+    for kk in np.arange(nitermax):
+        plume_zoom_new = si.binary_dilation(plume_zoom_old) * mask_zoom
+        if (plume_zoom_new == plume_zoom_old).all():
+            break
+        plume_zoom_old = plume_zoom_new.copy()
+        plume[jmin:jmax, imin:imax] = plume_zoom_new
+    return plume
+
+
+def test_plume_footprint(datafiles):
+    '''unit test'''
+    from dicrivers.geo_utils import plume_footprint
+
+    # random land/sea mask with ragged coastlines
+    rng = np.random.RandomState(42)
+    mask_grid = (rng.rand(60, 80) > 0.35).astype(float)
+
+    for jmouth, imouth in [(30, 40), (2, 3), (58, 77), (10, 70)]:
+        mask_grid[jmouth, imouth] = 1
+        for rspread in [1, 5, 12]:
+            expected = _iterative_plume(imouth, jmouth, mask_grid,
+                                        rspread, 1000)
+            jmin, imin, jplume, iplume = plume_footprint(imouth, jmouth,
+                                                         mask_grid,
+                                                         rspread=rspread)
+            plume = np.zeros(mask_grid.shape)
+            plume[jmin + jplume, imin + iplume] = 1
+            assert(np.array_equal(plume, expected))
+            # indices are local to the window
+            assert(jplume.max() <= 2 * rspread)
+            assert(iplume.max() <= 2 * rspread)
+
+    # spreading limited by the number of iterations
+    mask_grid = np.ones((41, 41))
+    expected = _iterative_plume(20, 20, mask_grid, 20, 3)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        jmin, imin, jplume, iplume = plume_footprint(20, 20, mask_grid,
+                                                     rspread=20, nitermax=3)
+    assert(len(caught) == 1)
+    plume = np.zeros(mask_grid.shape)
+    plume[jmin + jplume, imin + iplume] = 1
+    assert(np.array_equal(plume, expected))
+    return None
+
+
+def test_plume_footprints_multisource(datafiles):
+    '''unit test'''
+    from dicrivers.geo_utils import plume_footprint
+    from dicrivers.geo_utils import plume_footprints_multisource
+
+    rng = np.random.RandomState(0)
+    mask_grid = (rng.rand(60, 80) > 0.35).astype(float)
+    # overlapping plumes, rivers on the edges and a filtered out river
+    jmouths = np.array([30, 31, 2, 58, -1, 10, 30])
+    imouths = np.array([40, 42, 3, 77, -1, 70, 40])
+    rspreads = np.array([5, 12, 3, 8, 5, 1, 0])
+    mask_grid[jmouths[jmouths >= 0], imouths[imouths >= 0]] = 1
+
+    rivers, cells = plume_footprints_multisource(jmouths, imouths,
+                                                 mask_grid, rspreads)
+    for kriver in range(len(jmouths)):
+        got = np.sort(cells[rivers == kriver])
+        if jmouths[kriver] < 0:
+            assert(len(got) == 0)
+            continue
+        jmin, imin, jplume, iplume = plume_footprint(imouths[kriver],
+                                                     jmouths[kriver],
+                                                     mask_grid,
+                                                     rspread=rspreads[kriver])
+        expected = np.sort(np.ravel_multi_index((jmin + jplume,
+                                                 imin + iplume),
+                                                mask_grid.shape))
+        assert(np.array_equal(got, expected))
+    return None
+
+
+def test_plume_footprints_radius(datafiles):
+    '''unit test'''
+    import scipy.ndimage as si
+    from dicrivers.geo_utils import build_ocean_index, lonlat_to_xyz, rearth
+    from dicrivers.geo_utils import plume_footprints_radius
+
+    rng = np.random.RandomState(0)
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 2.),
+                                     np.arange(-60, 60, 2.))
+    mask_grid = (rng.rand(*lon_grid.shape) > 0.35).astype(float)
+    mouths = np.array([30 * 180 + 40, 30 * 180 + 42, 2 * 180 + 3, -1,
+                       59 * 180 + 179])
+    radii = np.array([800., 1500., 400., 500., 0.])
+    mask_grid.flat[mouths[mouths >= 0]] = 1
+    index = build_ocean_index(lon_grid, lat_grid, mask_grid)
+
+    rivers, cells, weights = plume_footprints_radius(mouths, radii,
+                                                     mask_grid, index)
+    assert(weights is None)
+    xyz = lonlat_to_xyz(lon_grid.ravel(), lat_grid.ravel())
+    for kriver in range(len(mouths)):
+        got = cells[rivers == kriver]
+        if mouths[kriver] < 0:
+            assert(len(got) == 0)
+            continue
+        # brute force: water connected component of the disk
+        chord = np.sqrt(((xyz - xyz[mouths[kriver]]) ** 2).sum(axis=1))
+        distance = 2 * np.arcsin(np.minimum(chord / 2, 1.)) * rearth
+        disk = (distance.reshape(lon_grid.shape) <= radii[kriver]) & \
+            (mask_grid != 0)
+        labels, _ = si.label(disk)
+        expected = np.flatnonzero(labels.ravel() ==
+                                  labels.flat[mouths[kriver]])
+        assert(np.array_equal(np.sort(got), expected))
+
+    rivers, cells, weights = plume_footprints_radius(mouths, radii,
+                                                     mask_grid, index,
+                                                     decay='gaussian')
+    assert(weights[cells == mouths[rivers]].min() == 1.)
+    assert((weights > 0).all() and (weights <= 1).all())
+    return None
+
+
+def test_plume_footprints_wrapped(datafiles):
+    '''unit test'''
+    from dicrivers.geo_utils import plume_footprint
+    from dicrivers.geo_utils import plume_footprints_multisource
+    from dicrivers.geo_utils import plume_footprints_perriver
+
+    rng = np.random.RandomState(1)
+    ny, nx = 30, 40
+    mask_grid = (rng.rand(ny, nx) > 0.3).astype(float)
+    # mouths on the seam, next to the fold and in the interior
+    jmouths = np.array([10, 28, 29, 15, 0, 29])
+    imouths = np.array([0, 38, 5, 20, 39, 20])
+    rspreads = np.array([6, 4, 5, 3, 25, 2])
+    mask_grid[jmouths, imouths] = 1
+
+    # reference: plumes on the grid unrolled across the seam and the fold
+    unrolled = np.concatenate([mask_grid, mask_grid[::-1, ::-1]], axis=0)
+    unrolled = np.tile(unrolled, (1, 3))
+    for kriver in range(len(jmouths)):
+        if 2 * rspreads[kriver] + 1 >= nx:
+            continue
+        jmin, imin, jplume, iplume = plume_footprint(
+            imouths[kriver] + nx, jmouths[kriver], unrolled,
+            rspread=rspreads[kriver])
+        jj = jmin + jplume
+        ii = (imin + iplume) % nx
+        north = jj >= ny
+        jj[north] = 2 * ny - 1 - jj[north]
+        ii[north] = nx - 1 - ii[north]
+        expected = np.unique(jj * nx + ii)
+        jmin, imin, jplume, iplume = plume_footprint(
+            imouths[kriver], jmouths[kriver], mask_grid,
+            rspread=rspreads[kriver], periodic=True, tripolar=True)
+        assert(np.array_equal((jmin + jplume) * nx + imin + iplume,
+                              expected))
+
+    # both engines agree, including windows going around the grid and
+    # spreading limited by nitermax
+    for nitermax in [1000, 3]:
+        with np.errstate(all='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            multi = plume_footprints_multisource(
+                jmouths, imouths, mask_grid, rspreads, nitermax=nitermax,
+                periodic=True, tripolar=True)
+            single = plume_footprints_perriver(
+                jmouths, imouths, mask_grid, rspreads, nitermax=nitermax,
+                periodic=True, tripolar=True)
+        for kriver in range(len(jmouths)):
+            assert(np.array_equal(np.sort(multi[1][multi[0] == kriver]),
+                                  np.sort(single[1][single[0] == kriver])))
+
+    # a plume on the seam of an ocean-only grid covers both sides
+    ocean = np.ones((ny, nx))
+    rivers, cells = plume_footprints_multisource([10], [0], ocean, 2,
+                                                 periodic=True)
+    assert(len(cells) == 25)
+    rivers, cells = plume_footprints_multisource([10], [0], ocean, 2)
+    assert(len(cells) == 15)
+    return None
+
+
+def test_plume_footprints_radius_periodic(datafiles):
+    '''unit test'''
+    from dicrivers.geo_utils import build_ocean_index
+    from dicrivers.geo_utils import plume_footprints_radius
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 2.),
+                                     np.arange(-60, 60, 2.))
+    mask_grid = np.ones(lon_grid.shape)
+    index = build_ocean_index(lon_grid, lat_grid, mask_grid)
+    mouth = [30 * 180]
+    rivers, cells = plume_footprints_radius(mouth, 500., mask_grid,
+                                            index)[:2]
+    assert(((cells % 180) < 90).all())
+    rivers, cells = plume_footprints_radius(mouth, 500., mask_grid,
+                                            index, periodic=True)[:2]
+    assert(((cells % 180) == 179).any())
+    return None
+
+
+def test_backends(datafiles, monkeypatch):
+    '''unit test'''
+    import pytest
+    from dicrivers import kernels
+    from dicrivers.geo_utils import find_closest_ocean_cell_to_river_mouth
+    from dicrivers.geo_utils import plume_footprint, create_plume
+    from dicrivers.geo_utils import plume_footprints_multisource
+    from dicrivers.plumes import make_river_plumes
+    pytest.importorskip('numba')
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    # mouths snapped on a grid with land
+    lon_grid, lat_grid = np.meshgrid(np.arange(-180, 180, 1.5),
+                                     np.arange(-80, 90, 1.5))
+    rng = np.random.RandomState(3)
+    mask_grid = (rng.rand(*lon_grid.shape) > 0.5).astype(float)
+    for index, river in rivers.iterrows():
+        args = (river['mouth_lon'], river['mouth_lat'], lon_grid, lat_grid,
+                mask_grid)
+        assert(find_closest_ocean_cell_to_river_mouth(*args, prox=100.) ==
+               find_closest_ocean_cell_to_river_mouth(*args, prox=100.,
+                                                      backend='numba'))
+
+    # plumes, including plumes limited by nitermax
+    mask_grid = (rng.rand(60, 80) > 0.35).astype(float)
+    for jmouth, imouth in [(30, 40), (2, 3), (58, 77)]:
+        mask_grid[jmouth, imouth] = 1
+        for rspread, nitermax in [(1, 1000), (12, 1000), (12, 4)]:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                expected = plume_footprint(imouth, jmouth, mask_grid,
+                                           rspread=rspread,
+                                           nitermax=nitermax)
+                got = plume_footprint(imouth, jmouth, mask_grid,
+                                      rspread=rspread, nitermax=nitermax,
+                                      backend='numba')
+            assert(expected[:2] == got[:2])
+            assert(np.array_equal(expected[2], got[2]))
+            assert(np.array_equal(expected[3], got[3]))
+    assert(np.array_equal(create_plume(40, 30, None, None, mask_grid),
+                          create_plume(40, 30, None, None, mask_grid,
+                                       backend='numba')))
+
+    # all rivers at once, across the seam and the fold
+    jmouths = np.array([30, 59, 2, 58, -1, 10, 57])
+    imouths = np.array([40, 0, 79, 77, -1, 70, 5])
+    rspreads = np.array([5, 12, 3, 8, 5, 1, 40])
+    mask_grid[jmouths[jmouths >= 0], imouths[imouths >= 0]] = 1
+    for nitermax in [1000, 6]:
+        stats, numba_stats = {}, {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = plume_footprints_multisource(
+                jmouths, imouths, mask_grid, rspreads, nitermax=nitermax,
+                stats=stats, periodic=True, tripolar=True)
+            got = plume_footprints_multisource(
+                jmouths, imouths, mask_grid, rspreads, nitermax=nitermax,
+                stats=numba_stats, periodic=True, tripolar=True,
+                backend='numba')
+        assert(np.array_equal(expected[0], got[0]))
+        assert(np.array_equal(expected[1], got[1]))
+        for name in ['iterations', 'converged']:
+            assert(np.array_equal(stats[name], numba_stats[name]))
+
+    # plumes of the river table, for both engines
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    expected = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid)
+    for engine in ['multisource', 'perriver']:
+        got = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                engine=engine, backend='numba')
+        assert((got.matrix != expected.matrix).nnz == 0)
+
+    # without numba, the numpy backend is used
+    monkeypatch.setattr(kernels, 'numba', None)
+    assert(kernels.resolve_backend('auto') == 'numpy')
+    with pytest.warns(UserWarning):
+        got = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                backend='numba')
+    assert((got.matrix != expected.matrix).nnz == 0)
+    with pytest.raises(ValueError):
+        kernels.resolve_backend('cuda')
+    return None
@@ -0,0 +1,76 @@
+import pandas as pd
+import os
+import numpy as np
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_incremental_update(datafiles):
+    'unit test'
+    from dicrivers import make_bgc_river_input, IncrementalRiverInput
+    from dicrivers.plumes import make_river_plumes
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['rspread'] = 15
+    rivers['discharge'] = np.arange(1., len(rivers) + 1)
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+    area_grid = np.cos(np.deg2rad(lat_grid))
+
+    # a moved mouth, a new radius, a new value, a removed and a new river
+    edited = rivers.copy()
+    edited.loc[3, 'mouth_lon'] += 2.
+    edited.loc[5, 'rspread'] = 4
+    edited.loc[7, 'testvar'] = 1000.
+    edited.loc[9, 'discharge'] = 50.
+    edited = edited.drop(index=11)
+    added = rivers.loc[[2]].rename(index={2: 100})
+    added['mouth_lat'] -= 3.
+    edited = pd.concat([edited.iloc[:10], added, edited.iloc[10:]])
+
+    for method in ['average', 'discharge', 'flux']:
+        for dtype in [np.float64, np.float32]:
+            state = IncrementalRiverInput(rivers, ['testvar'], lon_grid,
+                                          lat_grid, mask_grid,
+                                          method=method,
+                                          area_grid=area_grid,
+                                          output_dtype=dtype)
+            out = state.update(edited)
+            expected = make_bgc_river_input(edited, ['testvar'], lon_grid,
+                                            lat_grid, mask_grid,
+                                            method=method,
+                                            area_grid=area_grid,
+                                            output_dtype=dtype)
+            assert(out['testvar'].dtype == expected['testvar'].dtype)
+            assert(np.array_equal(out['testvar'].values,
+                                  expected['testvar'].values))
+            plumes = make_river_plumes(edited, lon_grid, lat_grid, mask_grid)
+            assert((state.plumes.matrix != plumes.matrix).nnz == 0)
+
+    assert(list(state.changes['added']) == [100])
+    assert(list(state.changes['removed']) == [11])
+    assert(list(state.changes['moved']) == [3, 5])
+    # discharge is not used by the flux method
+    assert(list(state.changes['revalued']) == [7])
+
+    # reordered rivers and back to the original table
+    shuffled = edited.iloc[::-1]
+    assert(np.array_equal(state.update(shuffled)['testvar'].values,
+                          make_bgc_river_input(shuffled, ['testvar'],
+                                               lon_grid, lat_grid, mask_grid,
+                                               method='flux',
+                                               area_grid=area_grid,
+                                               output_dtype=np.float32)[
+                                                   'testvar'].values))
+    out = state.update(rivers)
+    assert(np.array_equal(out['testvar'].values, make_bgc_river_input(
+        rivers, ['testvar'], lon_grid, lat_grid, mask_grid, method='flux',
+        area_grid=area_grid, output_dtype=np.float32)['testvar'].values))
+    return None
@@ -0,0 +1,272 @@
+import pandas as pd
+import os
+import numpy as np
+import xarray as xr
+import pytest
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_river_remapper(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.remapper import RiverRemapper
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['rspread'] = 15
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid)
+    expected = make_bgc_river_input(rivers, ['testvar'],
+                                    lon_grid, lat_grid, mask_grid)
+
+    # dataframe column
+    testvar = xr.DataArray(rivers['testvar'].values, dims=['river'])
+    out = remapper(testvar)
+    assert(out.dims == ('y', 'x'))
+    assert(np.array_equal(out.values, expected['testvar'].values))
+
+    # monthly climatology of several tracers in one call
+    months = np.arange(1, 13)
+    clim = xr.Dataset({'dic': testvar * xr.DataArray(months, dims=['time']),
+                       'alk': 2 * testvar + 0 * xr.DataArray(months,
+                                                             dims=['time'])})
+    clim = clim.assign_coords(time=months)
+    out = remapper.apply(clim)
+    assert(out['dic'].dims == ('time', 'y', 'x'))
+    assert(np.allclose(out['dic'].sel(time=3), 3 * expected['testvar']))
+    assert(np.allclose(out['alk'].sel(time=5), 2 * expected['testvar']))
+    assert('lon' in out.coords)
+
+    # numpy arrays with river as last axis
+    out = remapper.apply(np.stack([rivers['testvar'].values] * 2))
+    assert(out.shape == (2,) + lon_grid.shape)
+    with pytest.raises(ValueError):
+        remapper.apply(testvar, output_dtype=np.int64)
+
+    # save and reload the weights
+    filename = str(tmpdir.join('weights.nc'))
+    remapper.to_netcdf(filename)
+    reloaded = RiverRemapper.from_netcdf(filename)
+    assert((reloaded.weights != remapper.weights).nnz == 0)
+    assert(np.array_equal(reloaded(testvar).values,
+                          expected['testvar'].values))
+
+
+def test_time_varying_values(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.remapper import RiverRemapper, remap_to_file
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    expected = make_bgc_river_input(rivers, ['testvar'],
+                                    lon_grid, lat_grid, mask_grid)
+
+    # long-format daily series, value doubling every day
+    dates = pd.date_range('2000-01-01', periods=5, freq='D')
+    long_df = pd.DataFrame({'time': np.repeat(dates, len(rivers)),
+                            'river': np.tile(rivers.index, len(dates))})
+    factor = np.repeat(2. ** np.arange(len(dates)), len(rivers))
+    long_df['testvar'] = np.tile(rivers['testvar'].values, len(dates)) * \
+        factor
+
+    out = make_bgc_river_input(rivers, ['testvar'],
+                               lon_grid, lat_grid, mask_grid,
+                               river_values=long_df)
+    assert(out['testvar'].dims == ('time', 'y', 'x'))
+    for k in range(len(dates)):
+        assert(np.allclose(out['testvar'].isel(time=k),
+                           2 ** k * expected['testvar']))
+
+    # streamed to file, two days at a time
+    river_values = xr.Dataset(
+        {'testvar': (['time', 'river'],
+                     long_df['testvar'].values.reshape((len(dates), -1)))},
+        coords={'time': dates})
+    # rivers of a dataset with a river coordinate follow river_df
+    shuffled = river_values.assign_coords(river=rivers.index.values)
+    shuffled = shuffled.isel(river=np.random.RandomState(0).permutation(
+        len(rivers)))
+    out_shuffled = make_bgc_river_input(rivers, ['testvar'],
+                                        lon_grid, lat_grid, mask_grid,
+                                        river_values=shuffled)
+    assert(np.array_equal(out_shuffled['testvar'].values,
+                          out['testvar'].values))
+    try:
+        make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                             mask_grid, river_values=shuffled.isel(
+                                 river=slice(1, None)))
+        raise AssertionError('missing rivers')
+    except ValueError:
+        pass
+
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid)
+    for filename in ['out.nc', 'out.zarr']:
+        filename = str(tmpdir.join(filename))
+        remap_to_file(remapper, river_values, filename, time_chunk=2)
+        engine = 'zarr' if filename.endswith('zarr') else None
+        with xr.open_dataset(filename, engine=engine) as ds:
+            assert(np.array_equal(ds['time'].values, dates.values))
+            assert(np.allclose(ds['testvar'], out['testvar']))
+
+
+def test_lazy_chunked_output(datafiles, tmpdir):
+    'unit test'
+    import dask.array as dsa
+    from dicrivers import make_bgc_river_input
+    from dicrivers.remapper import RiverRemapper
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1),
+                                     np.arange(-90, 90, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    expected = make_bgc_river_input(rivers, ['testvar'],
+                                    lon_grid, lat_grid, mask_grid)
+    lazy = make_bgc_river_input(rivers, ['testvar'],
+                                lon_grid, lat_grid, mask_grid,
+                                chunks={'y': 50, 'x': 100})
+    assert(isinstance(lazy['testvar'].data, dsa.Array))
+    assert(lazy['testvar'].data.chunks == ((50, 50, 50, 30),
+                                           (100, 100, 100, 60)))
+    assert(np.array_equal(lazy['testvar'].values, expected['testvar'].values))
+
+    # chunked along time too, written without computing in memory first
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid)
+    testvar = xr.DataArray(rivers['testvar'].values, dims=['river'])
+    series = testvar * xr.DataArray(np.arange(6.), dims=['time'])
+    out = remapper.apply(series.to_dataset(name='testvar'),
+                         chunks={'time': 2, 'y': 90, 'x': 180})
+    assert(out['testvar'].data.chunks[0] == (2, 2, 2))
+    filename = str(tmpdir.join('lazy.nc'))
+    out.to_netcdf(filename)
+    with xr.open_dataset(filename) as ds:
+        assert(np.allclose(ds['testvar'].isel(time=4),
+                           4 * expected['testvar']))
+
+
+def test_merge_methods(datafiles):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    from dicrivers.remapper import RiverRemapper
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    # make plumes overlap
+    rivers['rspread'] = 20
+    rivers['discharge'] = np.arange(1., len(rivers) + 1)
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    area_grid = np.cos(np.deg2rad(lat_grid))
+
+    # discharge weighting with equal discharges is the average
+    average = make_bgc_river_input(rivers, ['testvar'],
+                                   lon_grid, lat_grid, mask_grid)
+    equal = rivers.assign(discharge=1.)
+    out = make_bgc_river_input(equal, ['testvar'],
+                               lon_grid, lat_grid, mask_grid,
+                               method='discharge')
+    assert(np.allclose(out['testvar'], average['testvar']))
+
+    # discharge weighted values stay within the range of river values
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid,
+                             method='discharge')
+    assert(remapper.check_conservation())
+    out = remapper(xr.DataArray(rivers['testvar'].values, dims=['river']))
+    plumes = remapper.weights.T.tocsr()
+    for kriver in range(len(rivers)):
+        cells = plumes.indices[plumes.indptr[kriver]:plumes.indptr[kriver+1]]
+        if len(cells) == 0:
+            continue
+        # cells of this river only take the discharge weighted mean
+        cell = cells[0]
+        row = remapper.weights[cell]
+        q = rivers['discharge'].values[row.indices]
+        c = rivers['testvar'].values[row.indices]
+        assert(np.isclose(out.values.ravel()[cell], (q * c).sum() / q.sum()))
+
+    # flux conserving spreading of the loads
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid,
+                             method='flux', area_grid=area_grid)
+    loads = np.stack([rivers['testvar'].values, rivers['discharge'].values])
+    assert(remapper.check_conservation(loads))
+    out = remapper.apply(loads)
+    has_plume = np.diff(remapper.weights.tocsc().indptr) > 0
+    assert(np.allclose(out.sum(axis=(1, 2)), loads[:, has_plume].sum(axis=1)))
+    # a lone plume gets a uniform load per unit area
+    kriver = np.flatnonzero(has_plume)[0]
+    single = np.zeros(len(rivers))
+    single[kriver] = 1.
+    density = remapper.apply(single) / area_grid
+    assert(np.allclose(density[density > 0], density[density > 0].max()))
+
+    out = make_bgc_river_input(rivers, ['testvar'],
+                               lon_grid, lat_grid, mask_grid,
+                               method='flux', area_grid=area_grid)
+    assert(np.isclose(out['testvar'].sum(),
+                      rivers['testvar'].values[has_plume].sum()))
+
+
+def test_compressed_output(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input, expand_compressed
+    from dicrivers.remapper import RiverRemapper, remap_to_file
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(-100, 30, 1),
+                                     np.arange(20, 70, 1))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[:, :10] = 0
+    expected = make_bgc_river_input(rivers, ['testvar'],
+                                    lon_grid, lat_grid, mask_grid)
+    out = make_bgc_river_input(rivers, ['testvar'],
+                               lon_grid, lat_grid, mask_grid,
+                               compressed=True)
+    assert(out['testvar'].dims == ('cell',))
+    assert(out['cell'].attrs['compress'] == 'y x')
+    # only ocean cells covered by a plume, all nonzero cells included
+    cells = out['cell'].values
+    assert(len(cells) < lon_grid.size)
+    assert((mask_grid.ravel()[cells] == 1).all())
+    assert((expected['testvar'].values.ravel() != 0).sum() <= len(cells))
+    assert(np.array_equal(out['j'].values * lon_grid.shape[1] +
+                          out['i'].values, cells))
+    assert(np.array_equal(out['lon'].values, lon_grid.ravel()[cells]))
+    dense = expand_compressed(out)
+    assert(dense['testvar'].dims == ('y', 'x'))
+    assert(np.array_equal(dense['testvar'].values,
+                          expected['testvar'].values))
+
+    # time-dependent values written time chunk by time chunk
+    remapper = RiverRemapper(rivers, lon_grid, lat_grid, mask_grid)
+    dates = pd.date_range('2000-01-01', periods=3, freq='D')
+    testvar = xr.DataArray(rivers['testvar'].values, dims=['river'])
+    values = (testvar * xr.DataArray(np.arange(1., 4.), dims=['time']))
+    values = values.assign_coords(time=dates).to_dataset(name='testvar')
+    dense = remapper.apply(values, output_dtype=np.float32)
+    for filename in ['compressed.nc', 'compressed.zarr']:
+        filename = str(tmpdir.join(filename))
+        remap_to_file(remapper, values, filename, time_chunk=2,
+                      output_dtype=np.float32, compressed=True)
+        engine = 'zarr' if filename.endswith('zarr') else None
+        with xr.open_dataset(filename, engine=engine) as ds:
+            assert(ds['testvar'].dims == ('time', 'cell'))
+            assert(ds['cell'].attrs['compress'] == 'y x')
+            expanded = expand_compressed(ds)
+            assert(expanded['testvar'].dtype == np.float32)
+            assert(np.array_equal(expanded['testvar'].values,
+                                  dense['testvar'].values))
+    # a DataArray needs the grid shape
+    compressed = remapper.apply(testvar, compressed=True)
+    assert(np.array_equal(expand_compressed(compressed,
+                                            lon_grid.shape).values,
+                          expected['testvar'].values))
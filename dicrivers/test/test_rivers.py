@@ -0,0 +1,67 @@
+import pandas as pd
+import os
+import numpy as np
+import xarray as xr
+import pytest
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_read_river_table(datafiles, tmpdir):
+    'unit test'
+    from dicrivers.rivers import read_river_table, river_columns
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    columns = river_columns(['testvar'])
+    assert(columns == ['mouth_lon', 'mouth_lat', 'rspread', 'testvar'])
+    expected = rivers[columns]
+
+    # csv read in chunks, only the requested columns
+    table = read_river_table(FIXTURE_DIR + '20major_rivers.csv',
+                             columns=columns + ['not_there'], chunk_size=7)
+    assert('basinname' not in table)
+    pd.testing.assert_frame_equal(table[columns], expected)
+
+    # netCDF, river dimension with a coordinate
+    ds = xr.Dataset.from_dataframe(rivers.rename_axis('river'))
+    ds.to_netcdf(str(tmpdir.join('rivers.nc')))
+    table = read_river_table(str(tmpdir.join('rivers.nc')),
+                             columns=columns, chunk_size=7)
+    assert(np.array_equal(table.index, rivers.index))
+    pd.testing.assert_frame_equal(table, expected.rename_axis('river'))
+
+    pytest.importorskip('pyarrow')
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    arrow = pa.Table.from_pandas(rivers, preserve_index=False)
+    feather.write_feather(arrow, str(tmpdir.join('rivers.arrow')))
+    rivers.to_parquet(str(tmpdir.join('rivers.parquet')), index=False)
+    for source in [str(tmpdir.join('rivers.parquet')),
+                   str(tmpdir.join('rivers.arrow')), arrow]:
+        table = read_river_table(source, columns=columns, chunk_size=7)
+        pd.testing.assert_frame_equal(table, expected)
+    return None
+
+
+def test_make_bgc_river_input_from_file(datafiles, tmpdir):
+    'unit test'
+    from dicrivers import make_bgc_river_input
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-90, 90, 1.))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+
+    expected = make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                                    mask_grid)
+    ds = xr.Dataset.from_dataframe(rivers.rename_axis('river'))
+    ds.to_netcdf(str(tmpdir.join('rivers.nc')))
+    out = make_bgc_river_input(str(tmpdir.join('rivers.nc')), ['testvar'],
+                               lon_grid, lat_grid, mask_grid)
+    assert(np.array_equal(out['testvar'].values,
+                          expected['testvar'].values))
+    return None
@@ -0,0 +1,105 @@
+import pandas as pd
+import os
+import json
+import socket
+import subprocess
+import sys
+import threading
+import numpy as np
+import xarray as xr
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_service(datafiles, tmpdir):
+    '''unit test'''
+    from dicrivers import make_bgc_river_input
+    from dicrivers.service import serve, submit, request, wait_for
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['din'] = rivers['testvar'] * 2.
+    rivers.to_csv(str(tmpdir.join('rivers.csv')), index=False)
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-90, 90, 1.))
+    mask_grid = np.ones(lon_grid.shape)
+    mask_grid[lat_grid > 60] = 0
+    xr.Dataset({'geolon': (['yh', 'xh'], lon_grid),
+                'geolat': (['yh', 'xh'], lat_grid),
+                'wet': (['yh', 'xh'], mask_grid)}).to_netcdf(
+                    str(tmpdir.join('grid.nc')))
+    config = {'grids': {'regular': {'file': str(tmpdir.join('grid.nc')),
+                                    'lon': 'geolon', 'lat': 'geolat',
+                                    'mask': 'wet'}},
+              'rivers': {'major': {'file': str(tmpdir.join('rivers.csv'))}},
+              'jobs': [{'grid': 'regular', 'rivers': 'major',
+                        'variables': ['testvar'],
+                        'output': str(tmpdir.join('warmup.nc'))}],
+              'request_timeout': 0.5}
+
+    socket_path = str(tmpdir.join('dicrivers.sock'))
+    service = threading.Thread(target=serve, args=(config, socket_path))
+    service.start()
+    try:
+        assert(wait_for(socket_path)['pid'] == os.getpid())
+        assert(os.stat(socket_path).st_mode & 0o777 == 0o600)
+        # plumes of the warm up job are reused, the new column is read
+        record = submit(socket_path, {'grid': 'regular', 'rivers': 'major',
+                                      'variables': ['din'],
+                                      'output': str(tmpdir.join('din.nc'))})
+        assert(record['status'] == 'ok')
+        assert(record['plumes_reused'])
+        expected = make_bgc_river_input(rivers, ['din'], lon_grid, lat_grid,
+                                        mask_grid)
+        with xr.open_dataset(str(tmpdir.join('din.nc'))) as out:
+            assert(np.array_equal(out['din'].values, expected['din'].values))
+        record = submit(socket_path, {'grid': 'missing', 'rivers': 'major',
+                                      'variables': ['din'],
+                                      'output': str(tmpdir.join('no.nc'))})
+        assert(record['status'] == 'failed')
+        # malformed requests are answered and the service goes on
+        for message in [{'command': 'run', 'job': 'oops'}, [1, 2],
+                        {'command': 'run', 'job': {'options': 'oops'}},
+                        {'command': 'unknown'}]:
+            reply = request(socket_path, message)
+            assert(reply['status'] == 'failed')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(b'not json\n')
+            reply = json.loads(client.makefile('rb').readline())
+        assert(reply['status'] == 'failed')
+        # silent clients and partial lines time out
+        for data in [b'', b'{"command": "ping"']:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+                client.sendall(data)
+                reply = json.loads(client.makefile('rb').readline())
+            assert(reply['status'] == 'failed')
+        assert(wait_for(socket_path, timeout=5.)['status'] == 'ok')
+        status = request(socket_path, {'command': 'status'})
+        assert(status['jobs'] == 3 and status['plumes'] == 1)
+    finally:
+        request(socket_path, {'command': 'shutdown'})
+        service.join()
+    assert(not os.path.exists(socket_path))
+
+    # importing the package does not import the heavy dependencies
+    # (imported with the package before python 3.7)
+    if sys.version_info < (3, 7):
+        return None
+    modules = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, dicrivers.service; '
+         'print(" ".join(sorted(sys.modules)))']).decode().split()
+    for module in ['pandas', 'xarray', 'scipy']:
+        assert(module not in modules)
+    # nor does a module import the modules it does not use
+    modules = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, dicrivers.dicrivers; '
+         'print(" ".join(sorted(sys.modules)))']).decode().split()
+    for module in ['dicrivers.incremental', 'dicrivers.topology']:
+        assert(module not in modules)
+    return None
@@ -0,0 +1,139 @@
+import pandas as pd
+import os
+import numpy as np
+import xarray as xr
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_tiled_grid(datafiles):
+    '''unit test'''
+    from dicrivers.geo_utils import build_ocean_index
+    from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+    from dicrivers.tiles import TiledGrid
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-89.5, 90, 1.))
+    rng = np.random.RandomState(0)
+    mask_grid = (rng.rand(*lon_grid.shape) > 0.3).astype(float)
+    grid = xr.Dataset({'lon': (['yh', 'xh'], lon_grid),
+                       'lat': (['yh', 'xh'], lat_grid),
+                       'mask': (['yh', 'xh'], mask_grid)})
+    grid = grid.chunk({'yh': 30, 'xh': 30})
+    tiled = TiledGrid(grid['lon'], grid['lat'], grid['mask'])
+    assert((tiled.tile_ny, tiled.tile_nx) == (30, 30))
+
+    # the mouths snapped on the ocean cells near them are the same
+    lon_rivers = rivers['mouth_lon'].values
+    lat_rivers = rivers['mouth_lat'].values
+    index = tiled.ocean_index(lon_rivers, lat_rivers, 200.)
+    assert(len(tiled.tiles_read) < tiled.ntile)
+    expected = find_closest_ocean_cells_to_river_mouths(
+        lon_rivers, lat_rivers, lon_grid, lat_grid, mask_grid,
+        index=build_ocean_index(lon_grid, lat_grid, mask_grid))
+    got = find_closest_ocean_cells_to_river_mouths(
+        lon_rivers, lat_rivers, lon_grid, lat_grid, mask_grid, index=index)
+    for expected_index, got_index in zip(expected, got):
+        assert(np.array_equal(expected_index, got_index))
+
+    # mask read in the plume windows only, across the seam and the fold
+    jmouths = np.array([5, 100, 179, -1])
+    imouths = np.array([0, 200, 359, -1])
+    tiled = TiledGrid(grid['lon'], grid['lat'], grid['mask'])
+    mask = tiled.window_mask(jmouths, imouths, 10, periodic=True,
+                             tripolar=True)
+    assert(sorted(tiled.tiles_read) ==
+           [(0, 0, 0), (0, 0, 11), (0, 3, 6), (0, 3, 7), (0, 5, 0),
+            (0, 5, 11)])
+    for face, jtile, itile in tiled.tiles_read:
+        rows = slice(30 * jtile, 30 * jtile + 30)
+        cols = slice(30 * itile, 30 * itile + 30)
+        assert(np.array_equal(mask[rows, cols], mask_grid[rows, cols] != 0))
+    assert(mask.sum() < (mask_grid != 0).sum())
+    return None
+
+
+def test_lazy_grids(datafiles, tmpdir):
+    '''unit test'''
+    from dicrivers import make_bgc_river_input
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+    rivers['rspread_km'] = 300.
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-89.5, 90, 1.))
+    rng = np.random.RandomState(0)
+    mask_grid = (rng.rand(*lon_grid.shape) > 0.3).astype(float)
+    area_grid = np.cos(np.deg2rad(lat_grid))
+    filename = str(tmpdir.join('grid.nc'))
+    xr.Dataset({'geolon': (['yh', 'xh'], lon_grid, {'units': 'degrees'}),
+                'geolat': (['yh', 'xh'], lat_grid),
+                'wet': (['yh', 'xh'], mask_grid),
+                'area': (['yh', 'xh'], area_grid)}).to_netcdf(filename)
+    mask_file = str(tmpdir.join('mask.npy'))
+    np.save(mask_file, mask_grid)
+
+    # missing values over land are land in all containers
+    nan_mask = np.where(mask_grid == 0, np.nan, mask_grid)
+    nan_file = str(tmpdir.join('nan_mask.npy'))
+    np.save(nan_file, nan_mask)
+    expected = make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                                    mask_grid)
+    for mask in [nan_mask, xr.DataArray(nan_mask, dims=['yh', 'xh']),
+                 np.load(nan_file, mmap_mode='r')]:
+        out = make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                                   mask)
+        assert(np.array_equal(out['testvar'].values,
+                              expected['testvar'].values))
+    # nonzero wet values other than 1 (fractional hFacC, 2.0) are ocean
+    from dicrivers.geo_utils import find_closest_ocean_cell_to_river_mouth
+    for wet in [0.5, 2.]:
+        out = make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                                   mask_grid * wet)
+        assert(np.array_equal(out['testvar'].values,
+                              expected['testvar'].values))
+        for index, river in rivers.iterrows():
+            mouth = find_closest_ocean_cell_to_river_mouth(
+                river['mouth_lon'], river['mouth_lat'], lon_grid, lat_grid,
+                mask_grid * wet)
+            assert(mouth == find_closest_ocean_cell_to_river_mouth(
+                river['mouth_lon'], river['mouth_lat'], lon_grid, lat_grid,
+                mask_grid))
+
+    with xr.open_dataset(filename) as grid:
+        chunked = grid.chunk({'yh': 45, 'xh': 60})
+        for kwargs in [{}, {'spreading': 'km'}, {'method': 'flux'},
+                       {'periodic': True, 'tripolar': True}]:
+            expected = make_bgc_river_input(rivers, ['testvar'], lon_grid,
+                                            lat_grid, mask_grid,
+                                            area_grid=area_grid, **kwargs)
+            # lazily opened from file
+            out = make_bgc_river_input(rivers, ['testvar'], grid['geolon'],
+                                       grid['geolat'], grid['wet'],
+                                       area_grid=grid['area'], **kwargs)
+            assert(np.array_equal(out['testvar'].values,
+                                  expected['testvar'].values))
+            # coordinates are passed on without being loaded
+            assert(not out['lon'].variable._in_memory)
+            assert(out['lon'].dims == ('y', 'x'))
+            assert(out['lon'].attrs['units'] == 'degrees')
+            # dask-backed
+            out = make_bgc_river_input(rivers, ['testvar'],
+                                       chunked['geolon'], chunked['geolat'],
+                                       chunked['wet'], area_grid=area_grid,
+                                       **kwargs)
+            assert(np.array_equal(out['testvar'].values,
+                                  expected['testvar'].values))
+            # memory-mapped
+            out = make_bgc_river_input(rivers, ['testvar'], lon_grid,
+                                       lat_grid,
+                                       np.load(mask_file, mmap_mode='r'),
+                                       area_grid=area_grid, **kwargs)
+            assert(np.array_equal(out['testvar'].values,
+                                  expected['testvar'].values))
+    return None
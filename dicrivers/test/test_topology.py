@@ -0,0 +1,141 @@
+import pandas as pd
+import os
+import numpy as np
+import pytest
+# requires pytest-datafiles
+
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'data/',
+    )
+
+
+def test_grid_topology(datafiles, tmpdir):
+    '''unit test'''
+    from dicrivers.topology import GridTopology
+    from dicrivers.geo_utils import plume_footprints_multisource
+
+    mask_grid = np.array([[0, 1, 1, 0, 1],
+                          [1, 1, 0, 0, 1],
+                          [1, 1, 1, 1, 1]], dtype=float)
+    topology = GridTopology(mask_grid)
+    assert(topology.nocean == 11)
+    graph = topology.graph
+    assert((graph != graph.T).nnz == 0)
+    # (0, 1) is linked to (0, 2) and (1, 1)
+    node = topology.nodes([1])[0]
+    linked = topology.ocean_cells[graph[node].indices]
+    assert(sorted(linked) == [2, 6])
+    assert(topology.nodes([0])[0] == -1)
+    # (2, 0), (2, 1) and (2, 4) do not touch land
+    coastal = topology.ocean_cells[topology.coastal]
+    assert(sorted(coastal) == [1, 2, 4, 5, 6, 9, 12, 13])
+    # the seam links (2, 4) to (2, 0) and the fold reverses the last row
+    periodic = GridTopology(mask_grid, periodic=True, tripolar=True)
+    graph = periodic.graph
+    node = periodic.nodes([14])[0]
+    assert(sorted(periodic.ocean_cells[graph[node].indices]) ==
+           [9, 10, 13])
+    node = periodic.nodes([11])[0]
+    assert(sorted(periodic.ocean_cells[graph[node].indices]) ==
+           [6, 10, 12, 13])
+
+    # plumes are those of the multisource engine, across the seam and
+    # the fold
+    rng = np.random.RandomState(0)
+    mask_grid = (rng.rand(30, 41) > 0.35).astype(float)
+    wet = np.flatnonzero(mask_grid)
+    mouths = rng.choice(wet, 50)
+    rspreads = rng.randint(0, 20, 50)
+    for flags in [{}, {'periodic': True}, {'periodic': True,
+                                           'tripolar': True}]:
+        topology = GridTopology(mask_grid, **flags)
+        expected = plume_footprints_multisource(mouths // 41, mouths % 41,
+                                                mask_grid, rspreads,
+                                                nitermax=8, **flags)
+        stats = {}
+        got = topology.plume_footprints(mouths // 41, mouths % 41, rspreads,
+                                        nitermax=8, stats=stats)
+        assert(sorted(zip(*expected)) == sorted(zip(*got)))
+        assert(stats['iterations'].max() <= 8)
+
+    # written and read back
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 360. / 41),
+                                     np.linspace(-80, 80, 30))
+    topology = GridTopology(mask_grid, lon_grid, lat_grid, periodic=True,
+                            tripolar=True)
+    filename = str(tmpdir.join('topology.npz'))
+    topology.save(filename)
+    loaded = GridTopology.load(filename)
+    assert(loaded.shape == topology.shape)
+    assert(loaded.periodic and loaded.tripolar)
+    for name in ['ocean_cells', 'indptr', 'indices', 'directions',
+                 'coastal', 'coastal_xyz']:
+        assert(np.array_equal(getattr(loaded, name),
+                              getattr(topology, name)))
+    assert(np.array_equal(loaded.coastal_index()[1],
+                          topology.ocean_cells[topology.coastal]))
+    return None
+
+
+def test_topology_river_input(datafiles, tmpdir):
+    '''unit test'''
+    from dicrivers import make_bgc_river_input, GridTopology
+    from dicrivers.geo_utils import find_closest_ocean_cells_to_river_mouths
+    from dicrivers.plumes import make_river_plumes
+    rivers = pd.read_csv(FIXTURE_DIR + '20major_rivers.csv')
+
+    lon_grid, lat_grid = np.meshgrid(np.arange(0, 360, 1.),
+                                     np.arange(-89.5, 90, 1.))
+    rng = np.random.RandomState(0)
+    mask_grid = (rng.rand(*lon_grid.shape) > 0.3).astype(float)
+    topology = GridTopology(mask_grid, lon_grid, lat_grid, periodic=True,
+                            tripolar=True)
+
+    # mouths are snapped to the coastal ocean cells
+    plumes = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                               periodic=True, tripolar=True,
+                               topology=topology)
+    mouths = find_closest_ocean_cells_to_river_mouths(
+        rivers['mouth_lon'], rivers['mouth_lat'], lon_grid, lat_grid,
+        mask_grid, index=topology.coastal_index())
+    flat_mouths = np.ravel_multi_index(mouths, mask_grid.shape)
+    for kriver in range(len(rivers)):
+        assert(flat_mouths[kriver] in plumes.footprint(kriver))
+
+    # same plumes as the multisource engine from the same mouths
+    expected = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                                 periodic=True, tripolar=True,
+                                 ocean_index=topology.coastal_index())
+    assert((plumes.matrix != expected.matrix).nnz == 0)
+    out = make_bgc_river_input(rivers, ['testvar'], lon_grid, lat_grid,
+                               mask_grid, periodic=True, tripolar=True,
+                               topology=topology)
+    assert(np.nansum(out['testvar'].values) > 0)
+
+    # cached separately from the plumes snapped to all the ocean cells
+    cache = str(tmpdir.join('cache'))
+    make_river_plumes(rivers, lon_grid, lat_grid, mask_grid, cache=cache)
+    cached = make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                               cache=cache, periodic=True, tripolar=True,
+                               topology=topology)
+    assert((cached.matrix != plumes.matrix).nnz == 0)
+
+    # without coastal cells, mouths snap to all the ocean cells
+    ocean_grid = np.ones(lon_grid.shape)
+    expected = make_river_plumes(rivers, lon_grid, lat_grid, ocean_grid)
+    with pytest.warns(UserWarning):
+        plumes = make_river_plumes(
+            rivers, lon_grid, lat_grid, ocean_grid,
+            topology=GridTopology(ocean_grid, lon_grid, lat_grid))
+    assert((plumes.matrix != expected.matrix).nnz == 0)
+    assert(plumes.matrix.nnz > 0)
+
+    try:
+        make_river_plumes(rivers, lon_grid, lat_grid, mask_grid,
+                          topology=topology)
+        raise AssertionError('topology of another grid')
+    except ValueError:
+        pass
+    return None
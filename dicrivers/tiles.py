@@ -0,0 +1,255 @@
+import numpy as np
+import scipy.spatial as ss
+import xarray as xr
+from dicrivers.geo_utils import lonlat_to_xyz, rearth, _window_bounds
+
+
+# tile shape used when the arrays are not chunked
+default_tile_shape = (512, 512)
+
+
+def is_lazy(array):
+    """ whether a grid array is read on demand: xarray DataArray (lazily
+    loaded from file or dask-backed) or memory-mapped numpy array """
+    return isinstance(array, (xr.DataArray, np.memmap))
+
+
+def take_cells(array, cells):
+    """ values of a grid array at flat indices, reading only the part of
+    lazy arrays that holds these cells
+
+    Parameters
+    ----------
+    array : numpy.ndarray or xarray.DataArray
+        grid array, (y, x) or (face, y, x)
+    cells : np.array of integers
+        flat indices in the grid
+    Returns
+    -------
+    values : np.array
+    """
+    if isinstance(array, xr.DataArray):
+        indices = np.unravel_index(cells, array.shape)
+        indexers = {dim: xr.DataArray(index, dims=['cell'])
+                    for dim, index in zip(array.dims, indices)}
+        return array.isel(indexers).values
+    return np.ravel(array)[cells]
+
+
+def grid_variable(array, dims):
+    """ grid array as an xarray Variable with dimensions dims, keeping the
+    data of DataArrays (lazy or dask-backed) and their attributes without
+    loading or copying them """
+    if isinstance(array, xr.DataArray):
+        variable = array.variable.copy(deep=False)
+        variable.dims = dims
+        return variable
+    return xr.Variable(dims, array)
+
+
+class TiledGrid(object):
+    """ grid whose lon, lat and mask are read tile by tile, on demand.
+    lon and lat are streamed one tile at a time to find the ocean cells
+    within reach of the river mouths, and the mask is only read in the
+    tiles near the mouths and in the tiles touched by the plume windows.
+    Missing values of the mask are land.
+
+    Parameters
+    ----------
+    lon_grid : numpy.ndarray or xarray.DataArray
+        longitudes of the grid, (y, x) or (face, y, x), memory-mapped,
+        lazily loaded or dask-backed
+    lat_grid : numpy.ndarray or xarray.DataArray
+        latitudes of the grid
+    mask_grid : numpy.ndarray or xarray.DataArray
+        land/sea mask of the grid
+    tile_shape : tuple of integer
+        (ny, nx) of the tiles, default: the chunks of dask-backed masks,
+        else default_tile_shape
+
+    Attributes
+    ----------
+    tiles_read : set
+        (face, jtile, itile) of the tiles of the mask read so far
+    """
+
+    def __init__(self, lon_grid, lat_grid, mask_grid, tile_shape=None):
+        self.lon_grid = lon_grid
+        self.lat_grid = lat_grid
+        self.mask_grid = mask_grid
+        self.shape = tuple(np.shape(mask_grid))
+        if len(self.shape) not in [2, 3]:
+            raise IOError('mask must be 2d or 3d (face, y, x)')
+        if tuple(np.shape(lon_grid)) != self.shape or \
+                tuple(np.shape(lat_grid)) != self.shape:
+            raise ValueError('lon, lat and mask must have the same shape')
+        self.nface = self.shape[0] if len(self.shape) == 3 else 1
+        self.ny, self.nx = self.shape[-2:]
+        if tile_shape is None:
+            tile_shape = _chunk_shape(mask_grid) or default_tile_shape
+        self.tile_ny = max(1, min(int(tile_shape[0]), self.ny))
+        self.tile_nx = max(1, min(int(tile_shape[1]), self.nx))
+        self.tiles_read = set()
+        # faces stacked along y, land until read. Zeroed memory is only
+        # committed where tiles are written.
+        self._mask = np.zeros((self.nface * self.ny, self.nx), dtype=bool)
+
+    @property
+    def ntile(self):
+        return self.nface * (-(-self.ny // self.tile_ny)) * \
+            (-(-self.nx // self.tile_nx))
+
+    def tiles(self):
+        """ (face, jtile, itile) of all the tiles of the grid """
+        for face in range(self.nface):
+            for jtile in range(-(-self.ny // self.tile_ny)):
+                for itile in range(-(-self.nx // self.tile_nx)):
+                    yield face, jtile, itile
+
+    def _bounds(self, tile):
+        ''' first row and column and shape of a tile '''
+        face, jtile, itile = tile
+        j0 = jtile * self.tile_ny
+        i0 = itile * self.tile_nx
+        return (j0, i0, min(self.tile_ny, self.ny - j0),
+                min(self.tile_nx, self.nx - i0))
+
+    def read(self, array, tile):
+        """ values of a grid array on a tile """
+        face, _, _ = tile
+        j0, i0, height, width = self._bounds(tile)
+        key = (slice(j0, j0 + height), slice(i0, i0 + width))
+        if len(self.shape) == 3:
+            key = (face,) + key
+        return np.asarray(array[key])
+
+    def mask_tile(self, tile):
+        """ ocean cells of a tile, read once """
+        face, _, _ = tile
+        j0, i0, height, width = self._bounds(tile)
+        rows = slice(face * self.ny + j0, face * self.ny + j0 + height)
+        cols = slice(i0, i0 + width)
+        if tile not in self.tiles_read:
+            mask = self.read(self.mask_grid, tile)
+            if mask.dtype.kind == 'f':
+                mask = np.where(np.isnan(mask), 0, mask)
+            self._mask[rows, cols] = mask != 0
+            self.tiles_read.add(tile)
+        return self._mask[rows, cols]
+
+    def ocean_index(self, lon_points, lat_points, reach):
+        """ KD-tree of the ocean cells within reach of points, as
+        geo_utils.build_ocean_index. Snapping the points against it gives
+        the same mouths as against all the ocean cells, for a proximity
+        range up to reach.
+
+        Parameters
+        ----------
+        lon_points : np.array
+            longitudes of the points (river mouths)
+        lat_points : np.array
+            latitudes of the points
+        reach : float
+            distance (in km) from the points
+        Returns
+        -------
+        tree : scipy.spatial.cKDTree
+            KD-tree of the ocean cells within reach
+        ocean_cells : np.array
+            flat index in the grid of each point in the tree, sorted
+        """
+        points = lonlat_to_xyz(np.atleast_1d(lon_points),
+                               np.atleast_1d(lat_points)).reshape((-1, 3))
+        # with a margin, candidates are filtered by the callers
+        chord = 2 * np.sin(min(reach / rearth, np.pi) / 2) * (1 + 1e-6)
+        cells, xyz = [], []
+        if len(points) > 0:
+            near_tree = ss.cKDTree(points)
+            for tile in self.tiles():
+                tile_xyz = lonlat_to_xyz(self.read(self.lon_grid, tile),
+                                         self.read(self.lat_grid, tile))
+                tile_xyz = tile_xyz.reshape((-1, 3))
+                distance, _ = near_tree.query(tile_xyz,
+                                              distance_upper_bound=chord)
+                near = np.isfinite(distance)
+                if not near.any():
+                    continue
+                near &= self.mask_tile(tile).ravel()
+                face, _, _ = tile
+                j0, i0, height, width = self._bounds(tile)
+                jj, ii = np.divmod(np.flatnonzero(near), width)
+                cells.append((face * self.ny + j0 + jj) * self.nx + i0 + ii)
+                xyz.append(tile_xyz[near])
+        if len(cells) == 0:
+            return ss.cKDTree(np.zeros((0, 3))), np.zeros(0, dtype=np.intp)
+        cells = np.concatenate(cells)
+        xyz = np.concatenate(xyz)
+        order = np.argsort(cells)
+        return ss.cKDTree(xyz[order]), cells[order]
+
+    def window_mask(self, jmouths, imouths, rspreads, periodic=False,
+                    tripolar=False):
+        """ mask of the grid, faces stacked along y, with the tiles touched
+        by the plume windows read and land elsewhere. Plumes grown on it
+        are the plumes grown on the full mask.
+
+        Parameters
+        ----------
+        jmouths : np.array of integers
+            indices of river mouths in stacked y, negative for rivers
+            without mouth
+        imouths : np.array of integers
+            indices of river mouths in x
+        rspreads : np.array of integers
+            number of gridpoints for spreading the plume of each river
+        periodic : bool
+            the grid is periodic in x
+        tripolar : bool
+            the last row of the grid is folded onto itself
+        Returns
+        -------
+        mask : np.array
+            boolean mask of shape (nface * ny, nx)
+        """
+        jmouths = np.asarray(jmouths, dtype=np.intp)
+        imouths = np.asarray(imouths, dtype=np.intp)
+        rspreads = np.broadcast_to(np.asarray(rspreads), jmouths.shape)
+        rivers = np.flatnonzero((jmouths >= 0) & (imouths >= 0))
+        face_ny = self.ny if self.nface > 1 else None
+        jmin, imin, height, width = _window_bounds(
+            jmouths[rivers], imouths[rivers],
+            rspreads[rivers].astype(np.intp), self.nface * self.ny, self.nx,
+            face_ny=face_ny, periodic=periodic, tripolar=tripolar)
+        ny, nx = self.nface * self.ny, self.nx
+        njtile = -(-self.ny // self.tile_ny)
+        tiles = set()
+        for kr in range(len(rivers)):
+            rows = np.arange(jmin[kr], jmin[kr] + height[kr])
+            cols = np.arange(imin[kr], imin[kr] + width[kr])
+            # window coordinates to grid, see geo_utils._window_to_grid
+            parts = [(rows[rows < ny], cols)]
+            if tripolar:
+                parts.append((2 * ny - 1 - rows[rows >= ny], nx - 1 - cols))
+            for part_rows, part_cols in parts:
+                if len(part_rows) == 0:
+                    continue
+                if periodic:
+                    part_cols = part_cols % nx
+                faces, jrows = np.divmod(part_rows, self.ny)
+                jtiles = np.unique(faces * njtile + jrows // self.tile_ny)
+                itiles = np.unique(part_cols // self.tile_nx)
+                for key in jtiles:
+                    face, jtile = divmod(int(key), njtile)
+                    for itile in itiles:
+                        tiles.add((face, jtile, int(itile)))
+        for tile in sorted(tiles):
+            self.mask_tile(tile)
+        return self._mask
+
+
+def _chunk_shape(array):
+    ''' (ny, nx) of the first chunk of dask-backed arrays, None otherwise '''
+    chunks = getattr(array, 'chunks', None)
+    if not chunks or not isinstance(chunks[0], tuple):
+        return None
+    return chunks[-2][0], chunks[-1][0]
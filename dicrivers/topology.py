@@ -0,0 +1,344 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.spatial as ss
+import warnings
+from dicrivers.geo_utils import lonlat_to_xyz, _window_bounds
+from dicrivers.geo_utils import _window_to_grid, ocean
+from dicrivers.tiles import take_cells
+
+
+# steps in (y, x) of the links of the graph, by direction code. Links
+# across the north fold are northward.
+north, south, east, west = 0, 1, 2, 3
+_jsteps = np.array([1, -1, 0, 0], dtype=np.intp)
+_isteps = np.array([0, 0, 1, -1], dtype=np.intp)
+
+_version = 1
+
+
+class GridTopology(object):
+    """ connectivity of the ocean cells of a grid, built once per grid and
+    shared by all the river inputs made on it. It holds the adjacency of
+    the ocean cells as a compact CSR graph, with the links across the
+    zonal seam and the north fold for periodic and tripolar grids, and an
+    index of the coastal ocean cells (ocean cells next to land). Saved to
+    a npz file, it loads without reading the grid again.
+
+    With a topology, river mouths are snapped to the closest coastal
+    ocean cell (to the closest ocean cell when no coastal cell is within
+    the proximity range, e.g. on grids without land) and plumes spread
+    over gridpoints grow along the graph, without reading the mask.
+
+    Parameters
+    ----------
+    mask_grid : np.array
+        land/sea mask of the grid, (y, x) or (face, y, x). Missing values
+        are land.
+    lon_grid : np.array or xarray.DataArray
+        longitudes of the grid, needed to snap river mouths, only read at
+        the coastal ocean cells
+    lat_grid : np.array or xarray.DataArray
+        latitudes of the grid, needed to snap river mouths
+    periodic : bool
+        the (y, x) grid is periodic in x, link the cells across the seam
+    tripolar : bool
+        the last row of the (y, x) grid is folded onto itself, link the
+        cells across the fold
+
+    Attributes
+    ----------
+    ocean_cells : np.array
+        sorted flat indices in the grid of the ocean cells, the nodes of
+        the graph
+    indptr, indices : np.array
+        CSR adjacency of the nodes
+    directions : np.array
+        direction of each link (north, south, east or west)
+    coastal : np.array
+        nodes of the coastal ocean cells
+    coastal_xyz : np.array
+        unit-sphere cartesian coordinates of the coastal ocean cells, None
+        if the topology was built without lon/lat
+    """
+
+    def __init__(self, mask_grid, lon_grid=None, lat_grid=None,
+                 periodic=False, tripolar=False):
+        mask = np.asarray(mask_grid)
+        if mask.ndim not in [2, 3]:
+            raise IOError('mask must be 2d or 3d (face, y, x)')
+        if (periodic or tripolar) and mask.ndim != 2:
+            raise ValueError('periodic and tripolar grids must be 2d')
+        self.shape = mask.shape
+        self.periodic = bool(periodic)
+        self.tripolar = bool(tripolar)
+        # faces are stacked along y, without links between them
+        ny, nx = self.shape[-2:]
+        nface = self.shape[0] if mask.ndim == 3 else 1
+        wet = ocean(mask).reshape((nface * ny, nx))
+        self.ocean_cells = np.flatnonzero(wet)
+        if len(self.ocean_cells) >= np.iinfo(np.int32).max:
+            raise ValueError('too many ocean cells for a topology')
+
+        node = np.full(wet.size, -1, dtype=np.int32)
+        node[self.ocean_cells] = np.arange(len(self.ocean_cells),
+                                           dtype=np.int32)
+        jj, ii = np.divmod(self.ocean_cells, nx)
+        sources, targets, directions = [], [], []
+        land = np.zeros(len(self.ocean_cells), dtype=bool)
+        for direction in [north, south, east, west]:
+            nj = jj + _jsteps[direction]
+            ni = ii + _isteps[direction]
+            if self.periodic:
+                ni = ni % nx
+            if direction == north and self.tripolar:
+                # the last row is linked to itself, reversed
+                fold = nj == ny
+                nj = np.where(fold, ny - 1, nj)
+                ni = np.where(fold, nx - 1 - ii, ni)
+            # cells on the edges of a face have no neighbor there
+            inside = (nj // ny == jj // ny) & (nj >= 0) & \
+                (ni >= 0) & (ni < nx)
+            neighbor = np.full(len(jj), -1, dtype=np.int32)
+            neighbor[inside] = node[nj[inside] * nx + ni[inside]]
+            land |= inside & (neighbor < 0)
+            linked = np.flatnonzero(neighbor >= 0)
+            sources.append(linked.astype(np.int32))
+            targets.append(neighbor[linked])
+            directions.append(np.full(len(linked), direction, dtype=np.int8))
+        sources = np.concatenate(sources)
+        order = np.argsort(sources, kind='stable')
+        self.indptr = np.zeros(len(self.ocean_cells) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.ocean_cells)),
+                  out=self.indptr[1:])
+        self.indices = np.concatenate(targets)[order]
+        self.directions = np.concatenate(directions)[order]
+        self.coastal = np.flatnonzero(land).astype(np.int32)
+        self.coastal_xyz = None
+        if lon_grid is not None and lat_grid is not None:
+            cells = self.ocean_cells[self.coastal]
+            self.coastal_xyz = lonlat_to_xyz(take_cells(lon_grid, cells),
+                                             take_cells(lat_grid, cells))
+        self._index = None
+
+    @property
+    def nocean(self):
+        return len(self.ocean_cells)
+
+    @property
+    def graph(self):
+        """ adjacency of the ocean cells as a scipy.sparse.csr_matrix of
+        shape (nocean, nocean), for scipy.sparse.csgraph. Cells linked
+        twice (across the seam and the fold) are linked once. """
+        data = np.ones(len(self.indices), dtype=bool)
+        graph = sp.csr_matrix((data, self.indices, self.indptr),
+                              shape=(self.nocean, self.nocean))
+        graph.sum_duplicates()
+        return graph
+
+    def nodes(self, cells):
+        """ nodes of ocean cells given by their flat index in the grid,
+        -1 for cells that are not ocean """
+        cells = np.asarray(cells, dtype=np.intp)
+        if self.nocean == 0:
+            return np.full(cells.shape, -1, dtype=np.intp)
+        nodes = np.searchsorted(self.ocean_cells, cells)
+        nodes = np.minimum(nodes, self.nocean - 1)
+        return np.where(self.ocean_cells[nodes] == cells, nodes, -1)
+
+    def coastal_index(self):
+        """ KD-tree of the coastal ocean cells, as
+        geo_utils.build_ocean_index, to snap the river mouths with
+        geo_utils.find_closest_ocean_cells_to_river_mouths. The tree is
+        built on first use.
+
+        Returns
+        -------
+        tree : scipy.spatial.cKDTree
+            KD-tree of the coastal ocean cells
+        coastal_cells : np.array
+            flat index in the grid of each point in the tree
+        """
+        if self.coastal_xyz is None:
+            raise ValueError('topology was built without lon/lat')
+        if self._index is None:
+            self._index = (ss.cKDTree(self.coastal_xyz.reshape((-1, 3))),
+                           self.ocean_cells[self.coastal])
+        return self._index
+
+    def check_grid(self, mask_grid, periodic=False, tripolar=False):
+        """ raise a ValueError if the topology was built for another grid
+        shape or other seam and fold flags """
+        if tuple(np.shape(mask_grid)) != self.shape:
+            raise ValueError('topology and grid shapes differ')
+        if bool(periodic) != self.periodic or \
+                bool(tripolar) != self.tripolar:
+            raise ValueError('topology and grid periodic/tripolar differ')
+
+    def plume_footprints(self, jmouths, imouths, rspreads, nitermax=1000,
+                         stats=None):
+        """ compute the plumes of all rivers along the graph. Plumes are
+        grown from all the mouths at once, each river being confined to
+        its own window of +/- rspread gridpoints, and are identical to the
+        plumes of geo_utils.plume_footprints_multisource on the mask of
+        the grid.
+
+        Parameters
+        ----------
+        jmouths : np.array of integers
+            indices of river mouths in y (faces stacked along y), negative
+            for rivers without mouth
+        imouths : np.array of integers
+            indices of river mouths in x, negative for rivers without mouth
+        rspreads : np.array of integers
+            number of gridpoints for spreading the plume of each river
+        nitermax : integer
+            maximum number of iterations for spreading algo
+        stats : dict
+            if given, filled with per river 'iterations' and 'converged'
+        Returns
+        -------
+        rivers, cells : np.array
+            coordinates of the plumes: river number and flat index in the
+            grid of each gridcell reached by the river
+        """
+        ny, nx = self.shape[-2:]
+        face_ny = ny if len(self.shape) == 3 else None
+        nrow = int(np.prod(self.shape[:-1]))
+        jmouths = np.asarray(jmouths, dtype=np.intp)
+        imouths = np.asarray(imouths, dtype=np.intp)
+        rspreads = np.broadcast_to(np.asarray(rspreads), jmouths.shape)
+        rspreads = rspreads.astype(np.intp)
+        rivers = np.flatnonzero((jmouths >= 0) & (imouths >= 0))
+        iterations = np.zeros(len(rivers), dtype=np.intp)
+        converged = np.ones(len(rivers), dtype=bool)
+        if stats is not None:
+            stats['iterations'] = np.full(len(jmouths), -1, dtype=np.intp)
+            stats['converged'] = np.ones(len(jmouths), dtype=bool)
+        if len(rivers) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        seeds = self.nodes(jmouths[rivers] * nx + imouths[rivers])
+        if (seeds < 0).any():
+            raise ValueError('river mouths must be ocean cells')
+
+        # same windows and stacked visited buffer as the multisource
+        # engine. The fronts carry their window position and their node,
+        # the steps of the links are reversed above the fold, where the
+        # window sees the grid upside down.
+        jmin, imin, height, width = _window_bounds(
+            jmouths[rivers], imouths[rivers], rspreads[rivers], nrow, nx,
+            face_ny=face_ny, periodic=self.periodic, tripolar=self.tripolar)
+        around = self.periodic & (width == nx)
+        offset = np.zeros(len(rivers) + 1, dtype=np.intp)
+        np.cumsum(height * width, out=offset[1:])
+        visited = np.zeros(offset[-1], dtype=bool)
+
+        def expand(kr, jj, ii, nodes):
+            ''' new window positions reached from the fronts '''
+            start = self.indptr[nodes]
+            degree = (self.indptr[nodes + 1] - start).astype(np.intp)
+            first = np.cumsum(degree) - degree
+            links = np.repeat(start - first, degree) + \
+                np.arange(degree.sum())
+            kr = np.repeat(kr, degree)
+            jj = np.repeat(jj, degree)
+            ii = np.repeat(ii, degree)
+            sign = np.where(jmin[kr] + jj >= nrow, -1, 1)
+            nj = jj + sign * _jsteps[self.directions[links]]
+            ni = ii + sign * _isteps[self.directions[links]]
+            if self.periodic:
+                # windows going around the grid have no zonal edge
+                ni = np.where(around[kr], ni % width[kr], ni)
+            inside = (nj >= 0) & (nj < height[kr]) & \
+                     (ni >= 0) & (ni < width[kr])
+            kr, nj, ni = kr[inside], nj[inside], ni[inside]
+            nodes = self.indices[links[inside]]
+            key = offset[kr] + nj * width[kr] + ni
+            key, first = np.unique(key, return_index=True)
+            fresh = ~visited[key]
+            new = first[fresh]
+            return key[fresh], kr[new], nj[new], ni[new], nodes[new]
+
+        kr = np.arange(len(rivers))
+        jj = jmouths[rivers] - jmin
+        ii = imouths[rivers] - imin
+        nodes = seeds
+        visited[offset[kr] + jj * width + ii] = True
+        for kk in np.arange(nitermax):
+            key, kr, jj, ii, nodes = expand(kr, jj, ii, nodes)
+            if len(key) == 0:
+                break
+            visited[key] = True
+            iterations[kr] = kk + 1
+        else:
+            # WARNING: did not converge
+            unfinished = expand(kr, jj, ii, nodes)[1]
+            if len(unfinished) > 0:
+                converged[unfinished] = False
+                warnings.warn('plume spreading did not converge')
+        if stats is not None:
+            stats['iterations'][rivers] = iterations
+            stats['converged'][rivers] = converged
+
+        # go back from the stacked windows to the grid
+        key = np.flatnonzero(visited)
+        kr = np.searchsorted(offset, key, side='right') - 1
+        local = key - offset[kr]
+        jj, ii = _window_to_grid(jmin[kr] + local // width[kr],
+                                 imin[kr] + local % width[kr],
+                                 nrow, nx, periodic=self.periodic,
+                                 tripolar=self.tripolar)
+        cells = jj * nx + ii
+        if self.tripolar:
+            # cells above the fold may be in the window twice
+            ncell = nrow * nx
+            pairs = np.unique(rivers[kr].astype(np.int64) * ncell + cells)
+            return (pairs // ncell).astype(np.intp), (pairs % ncell)
+        return rivers[kr], cells
+
+    def save(self, filename):
+        """ write the topology to a npz file
+
+        Parameters
+        ----------
+        filename : string
+            output file
+        """
+        arrays = dict(version=_version, shape=np.array(self.shape),
+                      periodic=self.periodic, tripolar=self.tripolar,
+                      ocean_cells=self.ocean_cells, indptr=self.indptr,
+                      indices=self.indices, directions=self.directions,
+                      coastal=self.coastal)
+        if self.coastal_xyz is not None:
+            arrays['coastal_xyz'] = self.coastal_xyz
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+        return None
+
+    @classmethod
+    def load(cls, filename):
+        """ read a topology written by GridTopology.save
+
+        Parameters
+        ----------
+        filename : string
+            npz file
+        Returns
+        -------
+        topology : GridTopology
+        """
+        with np.load(filename) as content:
+            if int(content['version']) != _version:
+                raise IOError('%s was written by another version of '
+                              'dicrivers, rebuild it' % filename)
+            topology = cls.__new__(cls)
+            topology.shape = tuple(int(n) for n in content['shape'])
+            topology.periodic = bool(content['periodic'])
+            topology.tripolar = bool(content['tripolar'])
+            for name in ['ocean_cells', 'indptr', 'indices', 'directions',
+                         'coastal']:
+                setattr(topology, name, content[name])
+            topology.coastal_xyz = None
+            if 'coastal_xyz' in content:
+                topology.coastal_xyz = content['coastal_xyz']
+        topology._index = None
+        return topology
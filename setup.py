@@ -10,5 +10,8 @@ setuptools.setup(
     license="GPLv3",
     keywords="ocean forcing",
     url="https://github.com/raphaeldussin/DICRIVERS",
-    packages=['dicrivers']
+    packages=['dicrivers'],
+    entry_points={'console_scripts': [
+        'dicrivers = dicrivers.cli:main',
+        'dicrivers-submit = dicrivers.service:main']}
 )